@@ -10,17 +10,82 @@ sys.path.append(str(project_root))
 
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from typing import Optional
 from bson import ObjectId
 import logging
-from shared.database import knowledge_collection
+from shared.database import (
+    close_async_client,
+    ensure_indexes,
+    find_chatbot_by_api_key,
+    get_chatbot,
+    insert_chatbot,
+    list_chatbots,
+    promote_scrape,
+    save_retrieval_index,
+)
+from starlette.concurrency import run_in_threadpool
+from shared.retrieval import index_pages, index_scraped_data
+from shared.page_store import page_store
+from shared.cache import LRUCache
+from shared.rate_limit import create_rate_limiter
+from shared.metrics import install as install_metrics, observe_span, register_cache, request_id_headers, span
+from shared.responses import CompressionMiddleware, FastJSONResponse
 import datetime
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Upstream chat service and the pooled client used to reach it
+CHAT_SERVICE_URL = os.getenv("CHAT_SERVICE_URL", "http://localhost:8003")
+GATEWAY_MAX_CONNECTIONS = int(os.getenv("GATEWAY_MAX_CONNECTIONS", "200"))
+GATEWAY_MAX_KEEPALIVE = int(os.getenv("GATEWAY_MAX_KEEPALIVE", "50"))
+GATEWAY_CONNECT_TIMEOUT = float(os.getenv("GATEWAY_CONNECT_TIMEOUT", "5"))
+GATEWAY_READ_TIMEOUT = float(os.getenv("GATEWAY_READ_TIMEOUT", "60"))
+
+# api_key -> chatbot_id lookups; unknown keys are cached briefly as ""
+API_KEY_CACHE_MAX_ENTRIES = int(os.getenv("API_KEY_CACHE_MAX_ENTRIES", "100000"))
+API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", "600"))
+API_KEY_NEGATIVE_TTL = int(os.getenv("API_KEY_NEGATIVE_TTL", "30"))
+
+# Chatbot fields the dashboard listing may ask for; the crawl tree is never one of them
+CHATBOT_LIST_FIELDS = frozenset([
+    "chatbot_name", "website_url", "web_url", "api_key", "storage",
+    "page_count", "rate_limit", "created_at", "refreshed_at",
+])
+CHATBOT_LIST_DEFAULT_FIELDS = ("chatbot_name", "website_url", "page_count", "created_at")
+
+api_key_cache = LRUCache(max_entries=API_KEY_CACHE_MAX_ENTRIES, ttl=API_KEY_CACHE_TTL)
+http_client = None
+
+# Per-chatbot token buckets and quotas for the public widget endpoint
+rate_limiter = create_rate_limiter()
+
+app = FastAPI(default_response_class=FastJSONResponse)
+install_metrics(app, "api_gateway")
+register_cache("api_key", api_key_cache)
+app.add_middleware(CompressionMiddleware)
+
+@app.on_event("startup")
+async def startup():
+    global http_client
+    await ensure_indexes()
+    http_client = httpx.AsyncClient(
+        base_url=CHAT_SERVICE_URL,
+        limits=httpx.Limits(
+            max_connections=GATEWAY_MAX_CONNECTIONS,
+            max_keepalive_connections=GATEWAY_MAX_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(GATEWAY_READ_TIMEOUT, connect=GATEWAY_CONNECT_TIMEOUT),
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    await http_client.aclose()
+    close_async_client()
 
 # Configure CORS
 app.add_middleware(
@@ -35,37 +100,74 @@ class ChatbotCreationRequest(BaseModel):
     user_id: str
     chatbot_name: str
     website_url: str
-    scraped_data: dict
+    # Either the crawl tree, or the id of a scrape the ingestion service already stored page by page
+    scraped_data: Optional[dict] = None
+    scrape_id: Optional[str] = None
 
 class ExternalChatRequest(BaseModel):
     message: str
+    stream: bool = False
+    # Conversation state lives in the chat service; the widget only echoes the id back
+    session_id: Optional[str] = None
+    start_session: bool = False
 
 def generate_api_key():
     return secrets.token_urlsafe(32)
 
+async def lookup_chatbot(api_key: str):
+    """Resolve an API key to ``(chatbot_id, rate_limit)``, or None for unknown keys."""
+    cached = api_key_cache.get(api_key)
+    if cached is not None:
+        return cached or None
+
+    with span("gateway.api_key_lookup"):
+        chatbot = await find_chatbot_by_api_key(api_key, {"_id": 1, "rate_limit": 1})
+    if not chatbot:
+        api_key_cache.set(api_key, "", ttl=API_KEY_NEGATIVE_TTL)
+        return None
+    resolved = (str(chatbot["_id"]), chatbot.get("rate_limit"))
+    api_key_cache.set(api_key, resolved)
+    return resolved
+
 @app.post("/create-chatbot")
 async def create_chatbot(request: ChatbotCreationRequest):
+    if (request.scraped_data is None) == (request.scrape_id is None):
+        raise HTTPException(status_code=400, detail="Provide exactly one of scraped_data and scrape_id")
+    if request.scrape_id is not None:
+        return await create_chatbot_from_scrape(request)
     try:
         api_key = generate_api_key()
+        chatbot_id = ObjectId()
+
+        # One compressed record per page instead of the whole tree in this document
+        page_count = await run_in_threadpool(page_store.save_tree, chatbot_id, request.scraped_data)
+
         chatbot_data = {
-            "_id": ObjectId(),
+            "_id": chatbot_id,
             "user_id": request.user_id,
             "chatbot_name": request.chatbot_name,
             "website_url": request.website_url,
-            "scraped_data": request.scraped_data,
+            "storage": "pages",
+            "page_count": page_count,
             "api_key": api_key,
             "created_at": datetime.datetime.utcnow()
         }
 
-        result = knowledge_collection.insert_one(chatbot_data)
+        inserted_id = await insert_chatbot(chatbot_data)
         
-        if not result.inserted_id:
+        if not inserted_id:
             raise HTTPException(status_code=500, detail="Failed to create chatbot in database")
 
-        logger.info(f"Created chatbot with ID: {result.inserted_id}")
+        # Chunk and index the crawl once so /chat only has to rank chunks
+        index_doc = await run_in_threadpool(index_scraped_data, request.scraped_data)
+        await save_retrieval_index(inserted_id, index_doc)
+
+        api_key_cache.invalidate(api_key)
+
+        logger.info(f"Created chatbot with ID: {inserted_id} ({len(index_doc['chunks'])} chunks indexed)")
         return {
             "message": "Chatbot created successfully",
-            "chatbot_id": str(result.inserted_id),
+            "chatbot_id": str(inserted_id),
             "api_key": api_key
         }
 
@@ -73,58 +175,178 @@ async def create_chatbot(request: ChatbotCreationRequest):
         logger.error(f"Error creating chatbot: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def create_chatbot_from_scrape(request: ChatbotCreationRequest):
+    """Make a chatbot of a scrape whose pages are already in the page store."""
+    if not ObjectId.is_valid(request.scrape_id):
+        raise HTTPException(status_code=400, detail="Invalid id format")
+    api_key = generate_api_key()
+    chatbot = await promote_scrape(request.scrape_id, request.user_id, {
+        "chatbot_name": request.chatbot_name,
+        "website_url": request.website_url,
+        "api_key": api_key,
+        "created_at": datetime.datetime.utcnow(),
+    })
+    if not chatbot:
+        raise HTTPException(status_code=404, detail="Scrape not found or already used by a chatbot")
+    try:
+        index_doc = await run_in_threadpool(lambda: index_pages(page_store.iter_pages(chatbot["_id"])))
+        await save_retrieval_index(chatbot["_id"], index_doc)
+    except Exception as e:
+        # The chat service rebuilds a missing index from the stored pages on first use
+        logger.error(f"Error indexing chatbot {chatbot['_id']}: {str(e)}")
+        index_doc = {"chunks": []}
+
+    api_key_cache.invalidate(api_key)
+
+    logger.info(f"Created chatbot with ID: {chatbot['_id']} from a stored scrape ({len(index_doc['chunks'])} chunks indexed)")
+    return {
+        "message": "Chatbot created successfully",
+        "chatbot_id": str(chatbot["_id"]),
+        "api_key": api_key
+    }
+
+def serialize_page(record):
+    record["_id"] = str(record["_id"])
+    record["chatbot_id"] = str(record["chatbot_id"])
+    record.pop("body_id", None)
+    return record
+
+@app.get("/chatbots/{chatbot_id}/pages")
+async def get_chatbot_pages(chatbot_id: str, after: str = None, limit: int = 50, include_text: bool = False):
+    """Page through a chatbot's stored pages, oldest first."""
+    if not ObjectId.is_valid(chatbot_id) or (after and not ObjectId.is_valid(after)):
+        raise HTTPException(status_code=400, detail="Invalid id format")
+    limit = max(1, min(limit, 200))
+    records = await run_in_threadpool(page_store.list_pages, chatbot_id, after, limit, include_text)
+    pages = [serialize_page(record) for record in records]
+    return FastJSONResponse({
+        "pages": pages,
+        "next_after": pages[-1]["_id"] if len(pages) == limit else None
+    })
+
+@app.get("/chatbots/{chatbot_id}/usage")
+async def get_chatbot_usage(chatbot_id: str):
+    """Rate limits, quota usage and request counters for one chatbot."""
+    if not ObjectId.is_valid(chatbot_id):
+        raise HTTPException(status_code=400, detail="Invalid id format")
+    chatbot = await get_chatbot(chatbot_id, {"rate_limit": 1})
+    if not chatbot:
+        raise HTTPException(status_code=404, detail="Chatbot not found")
+    return await rate_limiter.usage(chatbot_id, chatbot.get("rate_limit"))
+
+def chatbot_list_projection(fields):
+    """Projection for a comma-separated ``fields`` query parameter."""
+    if not fields:
+        return {field: 1 for field in CHATBOT_LIST_DEFAULT_FIELDS}
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in CHATBOT_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return {field: 1 for field in requested}
+
+@app.get("/users/{user_id}/chatbots")
+async def get_user_chatbots(user_id: str, after: str = None, limit: int = 50, fields: str = None):
+    """Page through a user's chatbots, oldest first, with only the requested fields.
+
+    ``fields`` is a comma-separated subset of ``CHATBOT_LIST_FIELDS``;
+    ``api_key`` is only returned when asked for.
+    """
+    if after and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail="Invalid id format")
+    projection = chatbot_list_projection(fields)
+    limit = max(1, min(limit, 200))
+    chatbots = await list_chatbots(user_id, projection, after, limit)
+    return FastJSONResponse({
+        "chatbots": chatbots,
+        "next_after": str(chatbots[-1]["_id"]) if len(chatbots) == limit else None
+    })
+
 @app.get("/get-chatbots/{user_id}")
 async def get_chatbots(user_id: str):
+    """Every chatbot of a user in one array; ``/users/{user_id}/chatbots`` pages through them."""
     try:
-        chatbots = list(knowledge_collection.find({"user_id": user_id}))
+        # The listing never needs the crawl tree, which can be megabytes per chatbot
+        chatbots = await list_chatbots(user_id)
         if not chatbots:
             logger.warning(f"No chatbots found for user_id: {user_id}")
-            return []
-        
-        for chatbot in chatbots:
-            chatbot["_id"] = str(chatbot["_id"])
-        
+            return FastJSONResponse([])
+
         logger.info(f"Retrieved {len(chatbots)} chatbots for user_id: {user_id}")
-        return chatbots
+        return FastJSONResponse(chatbots)
 
     except Exception as e:
         logger.error(f"Error fetching chatbots: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def relay_chat_stream(chat_request: dict):
+    """Relay the chat service's Server-Sent Events chunk by chunk."""
+    start = time.perf_counter()
+    try:
+        async with http_client.stream("POST", "/chat", json=chat_request, headers=request_id_headers()) as response:
+            if response.status_code != 200:
+                logger.error(f"Chat service returned {response.status_code} for streamed chat")
+                yield 'event: error\ndata: {"detail": "Chat service error"}\n\n'
+                return
+            async for chunk in response.aiter_raw():
+                yield chunk
+    except httpx.HTTPError as e:
+        logger.error(f"Error relaying chat stream: {str(e)}")
+        yield 'event: error\ndata: {"detail": "Chat service error"}\n\n'
+    finally:
+        observe_span("gateway.chat_service_stream", time.perf_counter() - start)
+
 @app.post("/external-chat/{api_key}")
 async def external_chat(api_key: str, request: ExternalChatRequest):
     try:
         # Find the chatbot by API key
-        chatbot = knowledge_collection.find_one({"api_key": api_key})
+        chatbot = await lookup_chatbot(api_key)
         if not chatbot:
             raise HTTPException(status_code=404, detail="Chatbot not found")
+        chatbot_id, limits = chatbot
+
+        with span("gateway.rate_limit"):
+            limit = await rate_limiter.check(chatbot_id, limits)
+        if not limit.allowed:
+            detail = "Rate limit exceeded" if limit.reason == "rate" else "Usage quota exceeded"
+            raise HTTPException(status_code=429, detail=detail, headers=limit.headers())
 
         # Forward the request to the chat service
-        chat_service_url = "http://localhost:8003/chat"
-        
         chat_request = {
-            "chatbot_id": str(chatbot["_id"]),
-            "message": request.message
+            "chatbot_id": chatbot_id,
+            "message": request.message,
+            "stream": request.stream,
+            "session_id": request.session_id,
+            "start_session": request.start_session
         }
+
+        if request.stream:
+            return StreamingResponse(
+                relay_chat_stream(chat_request),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                chat_service_url,
-                json=chat_request
+        with span("gateway.chat_service"):
+            response = await http_client.post("/chat", json=chat_request, headers=request_id_headers())
+
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail="Chat service error"
             )
-            
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail="Chat service error"
-                )
-            
-            return response.json()
 
+        return response.json()
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in external chat: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"api_key_cache": api_key_cache.stats()}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,15 +1,39 @@
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from shared.utils import verify_token, create_token
-from shared.database import users_collection
-from bson import ObjectId
-import bcrypt
+from shared.utils import verify_token, create_token, set_token_metrics_hook, token_cache, token_cache_stats
+from shared.metrics import count_event, install as install_metrics, register_cache
+from shared.database import close_async_client, ensure_indexes, find_user_by_email, get_user_by_id, insert_user, update_user
+from pymongo.errors import DuplicateKeyError
+from passwords import PasswordHasher, PasswordHasherBusy
 app = FastAPI()
+install_metrics(app, "auth_service")
+register_cache("token", token_cache)
+set_token_metrics_hook(lambda event: count_event(f"token_cache_{event}"))
+
+# bcrypt costs 100-300 ms of CPU per call, so it never runs on the event loop
+password_hasher = PasswordHasher()
+
+def hasher_busy():
+    return HTTPException(
+        status_code=503,
+        detail="Authentication service is busy. Please retry shortly.",
+        headers={"Retry-After": "1"}
+    )
+
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes()
+
+@app.on_event("shutdown")
+async def shutdown():
+    password_hasher.shutdown()
+    close_async_client()
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,32 +54,47 @@ class UserLogin(BaseModel):
 
 @app.post("/register")
 async def register(user: UserRegister):
-    existing_user = users_collection.find_one({"email": user.email})
+    existing_user = await find_user_by_email(user.email, {"_id": 1})
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
+    try:
+        hashed_password = await password_hasher.hash(user.password)
+    except PasswordHasherBusy:
+        raise hasher_busy()
     new_user = {
         "email": user.email,
         "password": hashed_password,
         "company_name": user.company_name
     }
-    result = users_collection.insert_one(new_user)
-    return {"message": "User registered successfully", "user_id": str(result.inserted_id)}
+    try:
+        user_id = await insert_user(new_user)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration for the same email
+        raise HTTPException(status_code=400, detail="Email already registered")
+    return {"message": "User registered successfully", "user_id": str(user_id)}
 
 @app.post("/login")
 async def login(user: UserLogin):
-    db_user = users_collection.find_one({"email": user.email})
-    if not db_user or not bcrypt.checkpw(user.password.encode('utf-8'), db_user['password']):
+    db_user = await find_user_by_email(user.email, {"password": 1})
+    if not db_user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
-    
+    try:
+        if not await password_hasher.verify(user.password, db_user['password']):
+            raise HTTPException(status_code=401, detail="Invalid email or password")
+        # The password is known to be right here, so move it to the configured cost
+        if password_hasher.needs_rehash(db_user['password']):
+            await update_user(db_user['_id'], {"password": await password_hasher.hash(user.password)})
+    except PasswordHasherBusy:
+        raise hasher_busy()
+
     token = create_token({"user_id": str(db_user['_id'])})
     return {"token": token}
 
 @app.get("/user")
 async def get_user(token_payload: dict = Depends(verify_token)):
     user_id = token_payload["user_id"]
-    user = users_collection.find_one({"_id": ObjectId(user_id)})
+    user = await get_user_by_id(user_id, {"email": 1, "company_name": 1})
     if user:
         return {
             "user_id": str(user["_id"]),
@@ -64,6 +103,10 @@ async def get_user(token_payload: dict = Depends(verify_token)):
         }
     raise HTTPException(status_code=404, detail="User not found")
 
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"token_cache": token_cache_stats(), "password_hasher": {"rejected": password_hasher.rejected}}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,74 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from shared.metrics import observe_span
+
+# Cost factor for new hashes; stored hashes with another cost are rehashed at login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# bcrypt releases the GIL while hashing, so threads run hashes in parallel
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 4)))
+# Hashes allowed to wait for a worker before new requests are shed
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", str(PASSWORD_HASH_WORKERS * 8)))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "2"))
+
+
+class PasswordHasherBusy(Exception):
+    """Too many hashes are queued; the caller should retry later."""
+
+
+def hash_rounds(hashed):
+    """The cost factor stored in a bcrypt hash (``$2b$12$...``)."""
+    return int(hashed.split(b"$")[2])
+
+
+class PasswordHasher:
+    """bcrypt hashing and checking off the event loop, on a bounded thread pool.
+
+    At most ``workers`` hashes run at once and ``queue_size`` more may wait;
+    beyond that callers wait up to ``queue_timeout`` seconds for room and
+    then get ``PasswordHasherBusy``.
+    """
+
+    def __init__(
+        self,
+        rounds=BCRYPT_ROUNDS,
+        workers=PASSWORD_HASH_WORKERS,
+        queue_size=PASSWORD_HASH_QUEUE,
+        queue_timeout=PASSWORD_HASH_QUEUE_TIMEOUT,
+    ):
+        self.rounds = rounds
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = asyncio.Semaphore(workers + queue_size)
+
+    async def hash(self, password):
+        return await self._run("password.hash", bcrypt.hashpw, password.encode("utf-8"), bcrypt.gensalt(self.rounds))
+
+    async def verify(self, password, hashed):
+        return await self._run("password.verify", bcrypt.checkpw, password.encode("utf-8"), hashed)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, span_name, func, *args):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise PasswordHasherBusy(f"Password hashing queue full ({self.workers} workers)")
+        # Includes waiting for a worker, which is what a slow login actually feels
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            observe_span(span_name, time.perf_counter() - start)
+            self._slots.release()
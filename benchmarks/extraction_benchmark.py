@@ -0,0 +1,77 @@
+"""Compare the HTML extraction backends on a corpus of saved pages.
+
+    python benchmarks/extraction_benchmark.py path/to/pages --repeat 5
+
+Every ``*.html``/``*.htm`` file under the corpus directory is extracted by
+each backend; the report gives per-page timings and counts fields where the
+fast backend's output differs from the BeautifulSoup reference.
+"""
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "data_ingestion_service"))
+
+from extraction import LxmlExtractor, SoupExtractor, lxml_html  # noqa: E402
+
+FIELDS = ("title", "meta", "headings", "links", "images", "text")
+
+
+def load_corpus(directory):
+    paths = sorted(p for p in Path(directory).rglob("*") if p.suffix in (".html", ".htm"))
+    return [(p.resolve().as_uri(), p.read_text(encoding="utf-8", errors="replace")) for p in paths]
+
+
+def time_extractor(extractor, corpus, repeat):
+    timings = []
+    for _ in range(repeat):
+        for url, html in corpus:
+            start = time.perf_counter()
+            extractor.extract(html, url, url)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings, total_bytes, repeat):
+    total = sum(timings)
+    ms = sorted(t * 1000 for t in timings)
+    print(
+        f"{name:>5}: total {total:.3f}s  mean {statistics.mean(ms):.2f}ms  "
+        f"p50 {ms[len(ms) // 2]:.2f}ms  p95 {ms[int(len(ms) * 0.95)]:.2f}ms  "
+        f"{total_bytes * repeat / total / 1e6:.1f} MB/s"
+    )
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("corpus", help="directory of saved HTML pages")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if lxml_html is None:
+        sys.exit("lxml is not installed; nothing to compare against")
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        sys.exit(f"No .html files under {args.corpus}")
+    total_bytes = sum(len(html.encode("utf-8")) for _, html in corpus)
+    print(f"{len(corpus)} pages, {total_bytes / 1e6:.2f} MB, {args.repeat} rounds")
+
+    soup, fast = SoupExtractor(), LxmlExtractor()
+    soup_total = report(soup.name, time_extractor(soup, corpus, args.repeat), total_bytes, args.repeat)
+    fast_total = report(fast.name, time_extractor(fast, corpus, args.repeat), total_bytes, args.repeat)
+    print(f"speedup: {soup_total / fast_total:.1f}x")
+
+    mismatches = {field: 0 for field in FIELDS}
+    for url, html in corpus:
+        expected, actual = soup.extract(html, url, url), fast.extract(html, url, url)
+        for field in FIELDS:
+            if expected[field] != actual[field]:
+                mismatches[field] += 1
+    print("pages differing from the BeautifulSoup output: " + ", ".join(f"{k} {v}" for k, v in mismatches.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""Offline load test of the HTTP services against local stand-ins.
+
+    python benchmarks/load_test.py --concurrency 1 8 32 --requests 200 --output results.json
+    python benchmarks/load_test.py --output after.json --baseline results.json
+
+The gateway, chat, ingestion and auth apps run in this process, each on its
+own loopback port under uvicorn, next to a fake Cerebras completion server
+and a synthetic website (see ``standins.py``). MongoDB is an in-memory
+mongomock store unless ``--mongo-uri`` points at a real server.
+
+Each scenario is driven at every concurrency level with a fixed number of
+requests:
+
+- ``external-chat``: ``POST /external-chat/{api_key}`` through the gateway;
+- ``chat``: ``POST /chat`` on the chat service directly;
+- ``chat-stream``: ``POST /chat`` with ``stream: true``, read to the end;
+  also reports time to first token;
+- ``login``: ``POST /login``;
+- ``scrape``: ``POST /scrape`` on the synthetic site, polled until the job
+  finishes (``--scrape-concurrency`` and ``--scrape-jobs``).
+
+Throughput and p50/p95/p99 latency are printed and written as JSON; with
+``--baseline`` the run is compared against an earlier results file. A
+requested scenario whose service can't start fails the run.
+"""
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+sys.path.append(str(Path(__file__).resolve().parent))
+
+from standins import (  # noqa: E402
+    VOCABULARY,
+    FakeLLM,
+    SyntheticSite,
+    fake_llm_app,
+    install_mongo_standin,
+    synthetic_site_app,
+)
+
+SCENARIOS = ("external-chat", "chat", "chat-stream", "login", "scrape")
+SCRAPE_POLL_INTERVAL = 0.05
+LOGIN_PASSWORD = "load-test-password"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def load_app(service, module_name):
+    """Import ``<service>/main.py`` under a unique module name and return its app."""
+    path = ROOT / service / "main.py"
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module.app
+
+
+class ServerThread:
+    """Runs several ASGI apps under uvicorn on one event loop in a background thread."""
+
+    def __init__(self, apps):
+        import uvicorn
+
+        self.servers = {
+            name: uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+            for name, (app, port) in apps.items()
+        }
+        self.thread = threading.Thread(target=lambda: asyncio.run(self._serve()), name="load-test-servers", daemon=True)
+
+    async def _serve(self):
+        await asyncio.gather(*(server.serve() for server in self.servers.values()))
+
+    def start(self, timeout=30):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not all(server.started for server in self.servers.values()):
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError("Services did not start")
+            time.sleep(0.05)
+
+    def stop(self):
+        for server in self.servers.values():
+            server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def latency_summary(latencies):
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    if not latencies_ms:
+        return {"mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "mean": round(sum(latencies_ms) / len(latencies_ms), 2),
+        "p50": round(percentile(latencies_ms, 0.50), 2),
+        "p95": round(percentile(latencies_ms, 0.95), 2),
+        "p99": round(percentile(latencies_ms, 0.99), 2),
+        "max": round(latencies_ms[-1], 2),
+    }
+
+
+async def drive(name, concurrency, requests, send):
+    """Run ``requests`` calls of ``send(client, i)`` with ``concurrency`` workers.
+
+    ``send`` returns the response status, or ``(status, first_token_at)``
+    for streamed responses, ``first_token_at`` being a ``perf_counter``
+    reading or None if no token arrived.
+    """
+    latencies = []
+    first_token_latencies = []
+    statuses = {}
+    errors = 0
+    counter = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                start = time.perf_counter()
+                try:
+                    status = await send(client, i)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                if isinstance(status, tuple):
+                    status, first_token_at = status
+                    if first_token_at is not None:
+                        first_token_latencies.append(first_token_at - start)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                if status != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - start
+
+    result = {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "statuses": statuses,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(requests / duration, 2) if duration else None,
+        "latency_ms": latency_summary(latencies),
+    }
+    if first_token_latencies:
+        result["first_token_ms"] = latency_summary(first_token_latencies)
+    return result
+
+
+def make_senders(urls, seed, args):
+    # Numbered across the whole run, so no scenario or level repeats an earlier question
+    questions = itertools.count()
+
+    def question():
+        # Fresh questions keep the answer cache from short-circuiting the LLM path
+        n = next(questions)
+        rng = random.Random(n % 10 if args.repeat_questions else n)
+        return f"What does the site say about {rng.choice(VOCABULARY)} and {rng.choice(VOCABULARY)}?"
+
+    async def external_chat(client, i):
+        response = await client.post(
+            f"{urls['gateway']}/external-chat/{seed['api_key']}",
+            json={"message": question()},
+        )
+        return response.status_code
+
+    async def chat(client, i):
+        response = await client.post(
+            f"{urls['chat']}/chat",
+            json={"chatbot_id": seed["chatbot_id"], "message": question()},
+        )
+        return response.status_code
+
+    async def chat_stream(client, i):
+        first_token_at = None
+        async with client.stream(
+            "POST",
+            f"{urls['chat']}/chat",
+            json={"chatbot_id": seed["chatbot_id"], "message": question(), "stream": True},
+        ) as response:
+            if response.status_code != 200:
+                return response.status_code, None
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    if event == "error":
+                        return "stream-error", first_token_at
+                    if event is None and first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    event = None
+        return 200, first_token_at
+
+    async def login(client, i):
+        response = await client.post(
+            f"{urls['auth']}/login",
+            json={"email": seed["email"], "password": LOGIN_PASSWORD},
+        )
+        return response.status_code
+
+    async def scrape(client, i):
+        response = await client.post(
+            f"{urls['ingestion']}/scrape",
+            json={"user_id": "load-test", "website_url": urls["site"] + "/"},
+        )
+        if response.status_code != 202:
+            return response.status_code
+        job_id = response.json()["job_id"]
+        while True:
+            await asyncio.sleep(SCRAPE_POLL_INTERVAL)
+            job = (await client.get(f"{urls['ingestion']}/scrape/{job_id}")).json()
+            if job["status"] == "completed":
+                return 200
+            if job["status"] in ("failed", "cancelled"):
+                return job["status"]
+
+    return {"external-chat": external_chat, "chat": chat, "chat-stream": chat_stream, "login": login, "scrape": scrape}
+
+
+def seed_data(urls, site, run_id, auth_available):
+    """Create the chatbot and user the scenarios talk to."""
+    with httpx.Client(timeout=120) as client:
+        response = client.post(f"{urls['gateway']}/create-chatbot", json={
+            "user_id": "load-test",
+            "chatbot_name": "Load test",
+            "website_url": urls["site"] + "/",
+            "scraped_data": site.scraped_data(urls["site"]),
+        })
+        response.raise_for_status()
+        seed = response.json()
+        seed["email"] = f"load-test-{run_id}@example.com"
+        if auth_available:
+            client.post(f"{urls['auth']}/register", json={
+                "email": seed["email"],
+                "password": LOGIN_PASSWORD,
+                "company_name": "Load test",
+            }).raise_for_status()
+    return seed
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result):
+    latency = result["latency_ms"]
+    first_token = f"{result['first_token_ms']['p95']:>9.1f}" if "first_token_ms" in result else f"{'-':>9}"
+    print(
+        f"{result['scenario']:>14}  {result['concurrency']:>4}  {result['throughput_rps']:>9.1f}"
+        f"  {latency['p50']:>9.1f}  {latency['p95']:>9.1f}  {latency['p99']:>9.1f}  {first_token}  {result['errors']:>6}"
+    )
+
+
+def compare(results, baseline_path):
+    baseline = {
+        (result["scenario"], result["concurrency"]): result
+        for result in json.loads(Path(baseline_path).read_text())["results"]
+    }
+    print(f"\nChange against {baseline_path}:")
+    print(f"{'scenario':>14}  {'conc':>4}  {'rps':>9}  {'p95':>9}")
+    for result in results:
+        before = baseline.get((result["scenario"], result["concurrency"]))
+        if not before or not before["throughput_rps"] or not before["latency_ms"]["p95"]:
+            continue
+        rps = (result["throughput_rps"] / before["throughput_rps"] - 1) * 100
+        p95 = (result["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1) * 100
+        print(f"{result['scenario']:>14}  {result['concurrency']:>4}  {rps:>+8.1f}%  {p95:>+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--scrape-concurrency", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--scrape-jobs", type=int, default=4, help="scrape jobs per concurrency level")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake LLM seconds to first token")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=400)
+    parser.add_argument("--llm-tokens", type=int, default=60, help="tokens per fake completion")
+    parser.add_argument("--site-pages", type=int, default=50)
+    parser.add_argument("--site-fanout", type=int, default=5)
+    parser.add_argument("--site-page-bytes", type=int, default=8000)
+    parser.add_argument("--bcrypt-rounds", type=int, default=10)
+    parser.add_argument("--repeat-questions", action="store_true", help="cycle 10 questions so the answer cache hits")
+    parser.add_argument("--mongo-uri", help="use this MongoDB instead of the in-memory stand-in")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against a previous --output file")
+    parser.add_argument("--verbose", action="store_true", help="keep the services' INFO logs")
+    args = parser.parse_args()
+
+    run_id = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    ports = {name: free_port() for name in ("llm", "site", "gateway", "chat", "ingestion", "auth")}
+    urls = {name: f"http://127.0.0.1:{port}" for name, port in ports.items()}
+
+    # Services read their configuration at import time
+    os.environ.update({
+        "CEREBRAS_API_KEY": "load-test",
+        "CEREBRAS_BASE_URL": urls["llm"],
+        "CHAT_SERVICE_URL": urls["chat"],
+        "BCRYPT_ROUNDS": str(args.bcrypt_rounds),
+        "METRICS_SLOW_REQUEST_SECONDS": "0",
+    })
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+        os.environ.setdefault("MONGO_DB_NAME", "hypersales_load_test")
+    else:
+        install_mongo_standin()
+
+    llm = FakeLLM(args.llm_latency, args.llm_tokens_per_second, args.llm_tokens)
+    site = SyntheticSite(args.site_pages, args.site_fanout, args.site_page_bytes)
+    apps = {
+        "llm": (fake_llm_app(llm), ports["llm"]),
+        "site": (synthetic_site_app(site), ports["site"]),
+        "gateway": (load_app("api_gateway", "load_test_gateway"), ports["gateway"]),
+        "chat": (load_app("chat_service", "load_test_chat"), ports["chat"]),
+        "ingestion": (load_app("data_ingestion_service", "load_test_ingestion"), ports["ingestion"]),
+    }
+    if "login" in args.scenarios:
+        # Not caught: a scenario that can't run fails the run rather than going missing from it
+        apps["auth"] = (load_app("auth_service", "load_test_auth"), ports["auth"])
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    servers = ServerThread(apps)
+    servers.start()
+    results = []
+    try:
+        seed = seed_data(urls, site, run_id, "auth" in apps)
+        senders = make_senders(urls, seed, args)
+        print(
+            f"{'scenario':>14}  {'conc':>4}  {'req/s':>9}  {'p50 ms':>9}  {'p95 ms':>9}  {'p99 ms':>9}"
+            f"  {'ttft p95':>9}  {'errors':>6}"
+        )
+        for scenario in args.scenarios:
+            if scenario == "scrape":
+                levels, requests = args.scrape_concurrency, args.scrape_jobs
+            else:
+                levels, requests = args.concurrency, args.requests
+            for concurrency in levels:
+                result = asyncio.run(drive(scenario, concurrency, requests, senders[scenario]))
+                print_result(result)
+                results.append(result)
+    finally:
+        servers.stop()
+
+    report = {
+        "run_id": run_id,
+        "commit": git_commit(),
+        "cpu_count": os.cpu_count(),
+        "mongo": "external" if args.mongo_uri else "in-memory",
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "mongo_uri")},
+        "llm_requests": llm.requests,
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"\nWrote {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+    failed = sorted({result["scenario"] for result in results if result["errors"] == result["requests"]})
+    if failed:
+        sys.exit(f"No request succeeded in: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Measure login throughput of the auth service's password hasher per pool size.
+
+    python benchmarks/password_benchmark.py --rounds 10 --logins 64 --workers 1 2 4 8
+
+Each run verifies ``--logins`` passwords concurrently through a
+``PasswordHasher`` with the given worker count, and reports logins per
+second, latency percentiles and how long the event loop was blocked at
+most (it should stay near zero, since hashing happens off the loop).
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+sys.path.append(str(Path(__file__).resolve().parent.parent / "auth_service"))
+
+import bcrypt  # noqa: E402
+
+from passwords import PasswordHasher  # noqa: E402
+
+
+async def watch_loop(interval, stop):
+    """Return the longest gap between ticks that should be ``interval`` apart."""
+    worst = 0.0
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        worst = max(worst, now - last - interval)
+        last = now
+    return worst
+
+
+async def run(workers, rounds, logins, hashed):
+    hasher = PasswordHasher(rounds=rounds, workers=workers, queue_size=logins, queue_timeout=600)
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(0.005, stop))
+
+    async def login():
+        start = time.perf_counter()
+        assert await hasher.verify("correct horse battery staple", hashed)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    max_stall = await watcher
+    hasher.shutdown()
+
+    ms = sorted(t * 1000 for t in latencies)
+    print(
+        f"{workers:>7}  {logins / elapsed:>9.1f}  {statistics.median(ms):>8.1f}"
+        f"  {ms[int(len(ms) * 0.95) - 1]:>8.1f}  {max_stall * 1000:>9.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost factor")
+    parser.add_argument("--logins", type=int, default=64, help="concurrent logins per run")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="pool sizes to compare")
+    args = parser.parse_args()
+
+    hashed = bcrypt.hashpw(b"correct horse battery staple", bcrypt.gensalt(args.rounds))
+    print(f"bcrypt rounds={args.rounds}, {args.logins} logins per run, {os.cpu_count()} CPUs")
+    print(f"{'workers':>7}  {'logins/s':>9}  {'p50 ms':>8}  {'p95 ms':>8}  {'stall ms':>9}")
+    for workers in args.workers:
+        asyncio.run(run(workers, args.rounds, args.logins, hashed))
+
+
+if __name__ == "__main__":
+    main()
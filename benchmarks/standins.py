@@ -0,0 +1,237 @@
+"""Local stand-ins for the services' external dependencies, for offline benchmarks.
+
+- ``fake_llm_app``: an OpenAI/Cerebras-compatible ``/v1/chat/completions``
+  with a configurable time to first token and token rate, streamed or not.
+- ``synthetic_site_app``: a generated website of ``pages`` pages with a
+  given link fan-out and page size, plus ``robots.txt`` and a sitemap.
+- ``install_mongo_standin``: points ``shared.database`` at one in-memory
+  mongomock store shared by its synchronous and Motor clients. Needs the
+  ``mongomock`` and ``mongomock-motor`` packages and must run before
+  anything imports ``shared.database``.
+"""
+import asyncio
+import inspect
+import json
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+
+SYLLABLES = ("ka", "lo", "mi", "ren", "tu", "sa", "vel", "do", "ni", "qua", "por", "zen", "ta", "li", "mor", "es")
+NAV_PAGES = 5
+
+
+def make_vocabulary(size=2000, seed=7):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+VOCABULARY = make_vocabulary()
+
+
+def paragraph(rng, words=60):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words)).capitalize() + "."
+
+
+class SyntheticSite:
+    """Deterministic page content for a site of ``pages`` pages.
+
+    Page ``n`` links to pages ``n * fanout + 1 .. n * fanout + fanout``, so
+    the site is a tree rooted at page 0; every page also carries the same
+    navigation block, which the scraper should strip as boilerplate.
+    """
+
+    def __init__(self, pages=50, fanout=5, page_bytes=8000, seed=11):
+        self.pages = pages
+        self.fanout = fanout
+        self.page_bytes = page_bytes
+        self.seed = seed
+
+    @staticmethod
+    def path(n):
+        return "/" if n == 0 else f"/p/{n}"
+
+    def children(self, n):
+        first = n * self.fanout + 1
+        return range(first, min(first + self.fanout, self.pages))
+
+    def title(self, n):
+        return f"Synthetic page {n}"
+
+    def paragraphs(self, n):
+        rng = random.Random(self.seed * 100003 + n)
+        paragraphs = []
+        size = 0
+        while size < self.page_bytes:
+            paragraphs.append(paragraph(rng))
+            size += len(paragraphs[-1]) + 7
+        return paragraphs
+
+    def html(self, n):
+        nav = "".join(f'<li><a href="{self.path(i)}">{self.title(i)}</a></li>' for i in range(min(NAV_PAGES, self.pages)))
+        links = "".join(f'<li><a href="{self.path(i)}">{self.title(i)}</a></li>' for i in self.children(n))
+        body = "".join(f"<p>{text}</p>" for text in self.paragraphs(n))
+        return (
+            f"<!DOCTYPE html><html><head><title>{self.title(n)}</title>"
+            f'<meta name="description" content="Synthetic benchmark page {n}"></head>'
+            f"<body><nav><ul>{nav}</ul></nav><main><h1>{self.title(n)}</h1>{body}<ul>{links}</ul></main>"
+            f"<footer><p>Synthetic footer shown on every page.</p></footer></body></html>"
+        )
+
+    def sitemap(self, base_url):
+        urls = "".join(f"<url><loc>{base_url}{self.path(n)}</loc></url>" for n in range(self.pages))
+        return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'
+
+    def scraped_data(self, base_url):
+        """The crawl tree the scraper would produce, for seeding chatbots without a crawl."""
+        def page(n):
+            data = {
+                "url": base_url + self.path(n),
+                "title": self.title(n),
+                "meta": {"description": f"Synthetic benchmark page {n}"},
+                "headings": {"h1": [self.title(n)]},
+                "links": [],
+                "images": [],
+                "text": "\n".join([self.title(n)] + self.paragraphs(n)),
+            }
+            children = [page(child) for child in self.children(n)]
+            if children:
+                data["child_pages"] = children
+            return data
+        return page(0)
+
+
+def synthetic_site_app(site):
+    app = FastAPI()
+
+    @app.get("/robots.txt")
+    async def robots(request: Request):
+        return PlainTextResponse(f"User-agent: *\nAllow: /\nSitemap: {str(request.base_url).rstrip('/')}/sitemap.xml\n")
+
+    @app.get("/sitemap.xml")
+    async def sitemap(request: Request):
+        return Response(site.sitemap(str(request.base_url).rstrip("/")), media_type="application/xml")
+
+    @app.get("/")
+    async def root():
+        return Response(site.html(0), media_type="text/html")
+
+    @app.get("/p/{n}")
+    async def page(n: int):
+        if not 0 < n < site.pages:
+            return PlainTextResponse("Not found", status_code=404)
+        return Response(site.html(n), media_type="text/html")
+
+    return app
+
+
+class FakeLLM:
+    """Timing model of a completion backend: a fixed delay, then tokens at a fixed rate."""
+
+    def __init__(self, latency=0.2, tokens_per_second=400.0, completion_tokens=60):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.requests = 0
+
+    def tokens(self, max_tokens=None):
+        count = min(self.completion_tokens, max_tokens or self.completion_tokens)
+        rng = random.Random(self.requests)
+        return [rng.choice(VOCABULARY) + " " for _ in range(count)]
+
+
+def fake_llm_app(llm):
+    app = FastAPI()
+
+    @app.get("/v1/tcp_warming")
+    async def tcp_warming():
+        return PlainTextResponse("ok")
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        llm.requests += 1
+        tokens = llm.tokens(body.get("max_tokens"))
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in body.get("messages", []))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model", "fake")
+        # The Cerebras SDK only builds typed responses and chunks when this is present
+        system_fingerprint = "fp_load_test"
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+
+        if not body.get("stream"):
+            await asyncio.sleep(llm.latency + len(tokens) / llm.tokens_per_second)
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "system_fingerprint": system_fingerprint,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        async def events():
+            await asyncio.sleep(llm.latency)
+            for token in tokens:
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "system_fingerprint": system_fingerprint,
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(1 / llm.tokens_per_second)
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "system_fingerprint": system_fingerprint,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def install_mongo_standin():
+    """Make ``shared.database`` use one in-memory store for its sync and async clients."""
+    import mongomock
+    import mongomock.collection
+    import mongomock.gridfs
+    import motor.motor_asyncio
+    import pymongo
+    from mongomock_motor import AsyncMongoMockClient
+
+    mongomock.gridfs.enable_gridfs_integration()
+    # Newer pymongo passes UpdateOne's sort option to bulk builders; mongomock's doesn't take it
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+    if "sort" not in inspect.signature(add_update).parameters:
+        def add_update_without_sort(self, *args, sort=None, **kwargs):
+            return add_update(self, *args, **kwargs)
+        mongomock.collection.BulkOperationBuilder.add_update = add_update_without_sort
+    store = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: store
+    motor.motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: AsyncMongoMockClient(mock_mongo_client=store)
+    return store
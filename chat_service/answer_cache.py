@@ -0,0 +1,122 @@
+import os
+import re
+import threading
+
+from shared.cache import LRUCache
+from shared.retrieval import tokenize
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+# Jaccard similarity of question terms needed for a near-duplicate hit; 0 disables it
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.85"))
+# Recent questions per chatbot considered for near-duplicate matching
+ANSWER_CACHE_CANDIDATES = 256
+
+GREETING_KEY = "__greeting__"
+GREETING_RESPONSE = os.getenv("GREETING_RESPONSE", "Hello! How can I help you today?")
+
+GREETINGS = frozenset([
+    "hi", "hello", "hey", "hiya", "howdy", "greetings", "yo", "hola",
+    "hi there", "hello there", "hey there", "good morning", "good afternoon",
+    "good evening", "good day",
+])
+
+PUNCTUATION_RE = re.compile(r"[^\w\s]")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(text):
+    """Fold case, punctuation and whitespace so trivially different questions match."""
+    text = PUNCTUATION_RE.sub(" ", text.lower())
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+
+class AnswerCache:
+    """Caches answers per chatbot, keyed by normalized question.
+
+    Keys include the fingerprint of the chatbot's indexed chunks, so
+    re-scraped knowledge never serves answers computed from the old crawl.
+    """
+
+    def __init__(
+        self,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+        max_bytes=ANSWER_CACHE_MAX_BYTES,
+        ttl=ANSWER_CACHE_TTL,
+        similarity=ANSWER_CACHE_SIMILARITY,
+    ):
+        self.similarity = similarity
+        self.near_duplicate_hits = 0
+        self._cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        self._candidates = {}
+        self._lock = threading.Lock()
+
+    def get(self, chatbot_id, fingerprint, question):
+        question_key = self._question_key(question)
+        answer = self._cache.get((chatbot_id, fingerprint, question_key))
+        if answer is not None:
+            return answer
+        if question_key == GREETING_KEY:
+            # Greetings never need the knowledge base, so answer them without the LLM
+            self.set(chatbot_id, fingerprint, question, GREETING_RESPONSE)
+            return GREETING_RESPONSE
+        if self.similarity > 0:
+            return self._get_near_duplicate(chatbot_id, fingerprint, question)
+        return None
+
+    def set(self, chatbot_id, fingerprint, question, answer):
+        question_key = self._question_key(question)
+        self._cache.set(
+            (chatbot_id, fingerprint, question_key),
+            answer,
+            size=len(answer) + len(question_key) + 200,
+        )
+        terms = frozenset(tokenize(question_key))
+        if question_key == GREETING_KEY or not terms:
+            return
+        with self._lock:
+            if (chatbot_id, fingerprint) not in self._candidates:
+                # Questions asked against an older crawl can never match again
+                for key in [key for key in self._candidates if key[0] == chatbot_id]:
+                    del self._candidates[key]
+            candidates = self._candidates.setdefault((chatbot_id, fingerprint), {})
+            candidates.pop(question_key, None)
+            candidates[question_key] = terms
+            if len(candidates) > ANSWER_CACHE_CANDIDATES:
+                del candidates[next(iter(candidates))]
+
+    def invalidate_chatbot(self, chatbot_id):
+        with self._lock:
+            for key in [key for key in self._candidates if key[0] == chatbot_id]:
+                del self._candidates[key]
+        return self._cache.invalidate_where(lambda key: key[0] == chatbot_id)
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats["near_duplicate_hits"] = self.near_duplicate_hits
+        return stats
+
+    def _question_key(self, question):
+        normalized = normalize_question(question)
+        return GREETING_KEY if normalized in GREETINGS else normalized
+
+    def _get_near_duplicate(self, chatbot_id, fingerprint, question):
+        terms = frozenset(tokenize(normalize_question(question)))
+        if not terms:
+            return None
+        with self._lock:
+            candidates = list(self._candidates.get((chatbot_id, fingerprint), {}).items())
+
+        best_key, best_score = None, 0.0
+        for question_key, candidate_terms in candidates:
+            score = len(terms & candidate_terms) / len(terms | candidate_terms)
+            if score > best_score:
+                best_key, best_score = question_key, score
+        if best_key is None or best_score < self.similarity:
+            return None
+
+        answer = self._cache.get((chatbot_id, fingerprint, best_key), count=False)
+        if answer is not None:
+            self.near_duplicate_hits += 1
+        return answer
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+from cerebras.cloud.sdk import (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+from shared.metrics import llm_time_to_first_token_seconds, llm_tokens_per_second, observe_span
+
+logger = logging.getLogger(__name__)
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+# How long a request may wait for a free upstream slot before we shed it
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "5"))
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+
+class LLMBusyError(Exception):
+    """No upstream slot became free within the queue timeout."""
+
+
+class LLMError(Exception):
+    """The upstream completion failed after all retries."""
+
+
+class LLMClient:
+    """Async completion client with bounded concurrency and request coalescing.
+
+    At most ``max_concurrency`` upstream calls run at once; other callers
+    queue for up to ``queue_timeout`` seconds. Each attempt is limited to
+    ``request_timeout`` seconds and transient failures are retried with
+    exponential backoff. Concurrent ``complete`` calls that share a
+    ``coalesce_key`` wait on a single upstream call.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        queue_timeout=LLM_QUEUE_TIMEOUT,
+        request_timeout=LLM_REQUEST_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        retry_backoff=LLM_RETRY_BACKOFF,
+    ):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.coalesced = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight = {}
+
+    @property
+    def in_flight(self):
+        return self.max_concurrency - self._semaphore._value
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "coalesced": self.coalesced,
+        }
+
+    async def complete(self, messages, coalesce_key=None, **params):
+        """Return the completion text for ``messages``."""
+        if coalesce_key is None:
+            return await self._complete_with_retries(messages, params)
+
+        task = self._inflight.get(coalesce_key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._complete_with_retries(messages, params))
+            self._inflight[coalesce_key] = task
+            task.add_done_callback(lambda t: self._finish_coalesced(coalesce_key, t))
+        # Shield the shared call so one disconnecting caller doesn't cancel it for the rest
+        return await asyncio.shield(task)
+
+    async def stream(self, messages, **params):
+        """Yield completion tokens as they arrive.
+
+        Retries only happen before the first token; once output has been
+        sent to the caller a failure is raised as ``LLMError``.
+        """
+        await self._acquire()
+        try:
+            for attempt in range(self.max_retries + 1):
+                start = time.perf_counter()
+                try:
+                    stream = await asyncio.wait_for(
+                        self.client.chat.completions.create(messages=messages, stream=True, **params),
+                        self.request_timeout,
+                    )
+                    break
+                except RETRYABLE_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise LLMError(f"Streaming completion failed: {e}") from e
+                    await self._backoff(attempt, e)
+
+            first_token_at = None
+            tokens = 0
+            try:
+                async for chunk in stream:
+                    token = chunk.choices[0].delta.content if chunk.choices else None
+                    if token:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            llm_time_to_first_token_seconds.observe(first_token_at - start)
+                        # Each streamed chunk carries about one token
+                        tokens += 1
+                        yield token
+            except RETRYABLE_ERRORS as e:
+                raise LLMError(f"Streaming completion interrupted: {e}") from e
+            finished_at = time.perf_counter()
+            observe_span("llm.stream", finished_at - start)
+            if first_token_at is not None and tokens > 1 and finished_at > first_token_at:
+                llm_tokens_per_second.observe((tokens - 1) / (finished_at - first_token_at), "stream")
+        finally:
+            self._semaphore.release()
+
+    async def _complete_with_retries(self, messages, params):
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(
+                    self.client.chat.completions.create(messages=messages, **params),
+                    self.request_timeout,
+                )
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise LLMError(f"Completion failed after {attempt + 1} attempts: {e}") from e
+                error = e
+            else:
+                if not response or not response.choices:
+                    raise LLMError("Completion returned no choices")
+                self._observe_completion(response, time.perf_counter() - start)
+                return response.choices[0].message.content
+            finally:
+                self._semaphore.release()
+            # Back off without holding a slot so queued requests can proceed
+            await self._backoff(attempt, error)
+
+    def _observe_completion(self, response, elapsed):
+        observe_span("llm.complete", elapsed)
+        usage = getattr(response, "usage", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        if completion_tokens and elapsed > 0:
+            llm_tokens_per_second.observe(completion_tokens / elapsed, "complete")
+
+    async def _acquire(self):
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise LLMBusyError(
+                f"No LLM slot free within {self.queue_timeout}s ({self.max_concurrency} in flight)"
+            )
+
+    async def _backoff(self, attempt, error):
+        delay = self.retry_backoff * (2 ** attempt) * (1 + random.random())
+        logger.warning(f"LLM call failed ({error!r}); retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    def _finish_coalesced(self, key, task):
+        self._inflight.pop(key, None)
+        # Mark the exception as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
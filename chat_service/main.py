@@ -4,14 +4,32 @@ import os
 from dotenv import load_dotenv
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from shared.database import knowledge_collection
+from typing import Optional
+from shared.database import (
+    close_async_client,
+    ensure_indexes,
+    get_chatbot,
+    get_retrieval_index,
+    get_scraped_data,
+    save_retrieval_index,
+)
+from shared.retrieval import BM25Index, format_context, index_pages, index_scraped_data, INDEX_VERSION, TOP_K
+from shared.page_store import page_store
+from starlette.concurrency import run_in_threadpool
+from shared.cache import LRUCache
+from shared.metrics import install as install_metrics, register_cache, span
+from llm import LLMBusyError, LLMClient, LLMError
+from answer_cache import AnswerCache
+from sessions import SESSION_TURN_CONTEXT_TOKENS, SessionStore
+import json
 import logging
-from cerebras.cloud.sdk import Cerebras
-import textwrap
+from cerebras.cloud.sdk import AsyncCerebras
 from bson import ObjectId
 
 # Load environment variables from .env file
@@ -22,6 +40,15 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
+install_metrics(app, "chat_service")
+
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes()
+
+@app.on_event("shutdown")
+async def shutdown():
+    close_async_client()
 
 app.add_middleware(
     CORSMiddleware,
@@ -34,25 +61,233 @@ app.add_middleware(
 class ChatRequest(BaseModel):
     chatbot_id: str
     message: str
+    stream: bool = False
+    # Continue a conversation, or start one; unknown or expired ids start a new one
+    session_id: Optional[str] = None
+    start_session: bool = False
 
 CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY")
+# Any OpenAI-compatible completion server, e.g. the load test's stand-in; None uses Cerebras
+CEREBRAS_BASE_URL = os.getenv("CEREBRAS_BASE_URL")
 
-# Initialize Cerebras client
-client = Cerebras(api_key=CEREBRAS_API_KEY)
+# Initialize Cerebras client; retries and timeouts are handled by LLMClient
+client = AsyncCerebras(api_key=CEREBRAS_API_KEY, base_url=CEREBRAS_BASE_URL, max_retries=0)
+llm = LLMClient(client)
 
 # Log to verify the environment variables (without showing the API key)
 logger.info(f"Cerebras API Key set: {'Yes' if CEREBRAS_API_KEY else 'No'}")
 
-def preprocess_content(content, max_length: int = 8192) -> str:
-    if isinstance(content, dict):
-        content = content.get("text", "")
-    if not isinstance(content, str):
-        logger.error("Content is not a string. Cannot proceed with preprocessing.")
-        raise ValueError("Content must be a string.")
-    paragraphs = content.split('\n')
-    wrapped_paragraphs = [textwrap.shorten(paragraph, width=300, placeholder="...") for paragraph in paragraphs]
-    concise_content = " ".join(wrapped_paragraphs)
-    return concise_content[:max_length]
+COMPLETION_PARAMS = {
+    "model": "llama3.1-8b",
+    "max_tokens": 800,
+    "temperature": 0.7,
+    "top_p": 1,
+}
+
+# Tokens of retrieved website content allowed into the prompt, per model; the
+# rest of the window holds the instructions, the question and max_tokens of answer
+CONTEXT_TOKEN_BUDGETS = {
+    "llama3.1-8b": 3000,
+    "llama-3.3-70b": 3000,
+}
+CONTEXT_TOKEN_BUDGET = int(os.getenv(
+    "CONTEXT_TOKEN_BUDGET",
+    str(CONTEXT_TOKEN_BUDGETS.get(COMPLETION_PARAMS["model"], 2000)),
+))
+
+# "bm25" (default), "dense" or "hybrid" (reciprocal rank fusion of both)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "bm25")
+RRF_K = 60
+
+if RETRIEVAL_MODE != "bm25":
+    from shared.vector_index import VectorIndexStore, embed_query
+    vector_store = VectorIndexStore()
+
+# Hot chatbots keep their retrieval structures in memory between requests
+CHATBOT_CACHE_MAX_ENTRIES = int(os.getenv("CHATBOT_CACHE_MAX_ENTRIES", "512"))
+CHATBOT_CACHE_MAX_BYTES = int(os.getenv("CHATBOT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CHATBOT_CACHE_TTL = int(os.getenv("CHATBOT_CACHE_TTL", "300"))
+
+chatbot_cache = LRUCache(
+    max_entries=CHATBOT_CACHE_MAX_ENTRIES,
+    max_bytes=CHATBOT_CACHE_MAX_BYTES,
+    ttl=CHATBOT_CACHE_TTL,
+)
+
+# Answers to repeated questions, keyed by chatbot, knowledge fingerprint and question
+answer_cache = AnswerCache()
+
+# Multi-turn conversations, for requests that carry a session
+sessions = SessionStore()
+
+register_cache("chatbot", chatbot_cache)
+register_cache("answer", answer_cache)
+register_cache("session", sessions)
+
+class ChatbotKnowledge:
+    """Everything /chat needs about one chatbot, ready to rank against a question."""
+
+    def __init__(self, chatbot, index: BM25Index, vectors=None):
+        self.chatbot = chatbot
+        self.index = index
+        self.vectors = vectors
+
+    @property
+    def size(self):
+        return self.index.approximate_size() + 1024
+
+async def load_retrieval_index(chatbot_id: str, chatbot: dict):
+    """Load the chatbot's BM25 index, (re)building and storing it if it is missing or outdated."""
+    index_doc = await get_retrieval_index(chatbot_id)
+    if index_doc is None or index_doc.get("version") != INDEX_VERSION:
+        logger.info(f"Building missing or outdated retrieval index for chatbot {chatbot_id}")
+        if chatbot.get("storage") == "pages":
+            index_doc = await run_in_threadpool(lambda: index_pages(page_store.iter_pages(chatbot_id)))
+        else:
+            # Chatbots created before page storage keep the crawl tree in their document
+            scraped_data = await get_scraped_data(chatbot_id)
+            index_doc = await run_in_threadpool(index_scraped_data, scraped_data)
+        await save_retrieval_index(chatbot_id, index_doc)
+    return BM25Index(index_doc)
+
+async def get_chatbot_knowledge(chatbot_id: str):
+    """Return the chatbot's cached knowledge, loading it from MongoDB on a miss."""
+    knowledge = chatbot_cache.get(chatbot_id)
+    if knowledge is not None:
+        return knowledge
+
+    with span("chat.load_knowledge"):
+        # The crawl tree is only needed to backfill a missing index, so skip it here
+        chatbot = await get_chatbot(chatbot_id)
+        if not chatbot:
+            return None
+
+        index = await load_retrieval_index(chatbot_id, chatbot)
+        vectors = None
+        if RETRIEVAL_MODE != "bm25":
+            vectors = await run_in_threadpool(vector_store.get_or_build, chatbot_id, index.chunks, index.fingerprint)
+
+    knowledge = ChatbotKnowledge(chatbot, index, vectors)
+    chatbot_cache.set(chatbot_id, knowledge, size=knowledge.size)
+    return knowledge
+
+def rank_chunks(knowledge: ChatbotKnowledge, message: str, top_k: int):
+    index = knowledge.index
+    if RETRIEVAL_MODE == "bm25":
+        return index.rank(message, top_k)
+
+    dense_ranking = knowledge.vectors.rank(embed_query(message), top_k)
+    if RETRIEVAL_MODE == "dense":
+        return dense_ranking
+
+    fused = {}
+    for ranking in (index.rank(message, top_k), dense_ranking):
+        for position, chunk_id in enumerate(ranking):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (RRF_K + position)
+    return sorted(fused, key=fused.get, reverse=True)[:top_k]
+
+def retrieve_chunk_ids(knowledge: ChatbotKnowledge, message: str, top_k: int = TOP_K):
+    chunk_ids = rank_chunks(knowledge, message, top_k)
+    if not chunk_ids:
+        # Greetings and off-topic messages match nothing; fall back to the site's opening chunks
+        chunk_ids = list(range(min(top_k, len(knowledge.index.chunks))))
+    return chunk_ids
+
+def retrieve_context(knowledge: ChatbotKnowledge, message: str, top_k: int = TOP_K) -> str:
+    chunks = [knowledge.index.chunks[chunk_id] for chunk_id in retrieve_chunk_ids(knowledge, message, top_k)]
+    # Token counts and sentence boundaries were computed at ingestion, so this only picks spans
+    return format_context(chunks, CONTEXT_TOKEN_BUDGET)
+
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+async def stream_completion(messages, on_complete=None, done_fields=None):
+    """Yield Server-Sent Events for each token of a streamed completion."""
+    try:
+        parts = []
+        async for token in llm.stream(messages, **COMPLETION_PARAMS):
+            parts.append(token)
+            yield sse_event({"token": token})
+        chatbot_response = "".join(parts)
+        logger.info(f"Chatbot response (streamed): {chatbot_response}")
+        if on_complete:
+            on_complete(chatbot_response)
+        yield sse_event({"response": chatbot_response, **(done_fields or {})}, event="done")
+    except LLMBusyError as e:
+        logger.error(f"Streaming completion rejected: {str(e)}")
+        yield sse_event({"detail": "Chat service is busy. Please retry shortly."}, event="error")
+    except Exception as e:
+        logger.error(f"Streaming completion failed: {str(e)}")
+        yield sse_event({"detail": "Failed to get response from Cerebras API"}, event="error")
+
+async def stream_cached_answer(answer, done_fields=None):
+    yield sse_event({"token": answer})
+    yield sse_event({"response": answer, **(done_fields or {})}, event="done")
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+SYSTEM_PROMPT = (
+    "You are an intelligent and concise chatbot designed to assist users by answering their questions based on the provided website content. "
+    "You should always follow the rules strictly to ensure precision and relevance in your responses."
+)
+
+RESPONSE_RULES = """*Rules for your response:*  
+1. **If the user's input is a greeting (e.g., "Hi", "Hello"), respond politely in 1-2 sentences.**  
+2. **If the user's input is a question, answer in 2-3 sentences based on the scraped website content.**  
+3. **Use the context from the website content to provide precise and relevant information.**  
+4. **If the website content doesn't answer the question, respond with:** "I'm sorry, I couldn't find this information on the website. Can I help with something else?"  
+5. **Do not provide generic, unrelated, or overly long responses.**"""
+
+def build_messages(context: str, message: str):
+    """Prompt for a single, stateless question."""
+    user_prompt = f"""
+{RESPONSE_RULES}
+
+*Website Content (Knowledge Base):*  
+{context}
+
+*User Question:*  
+{message}
+
+*Your Response:*
+"""
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def session_system_content(context: str) -> str:
+    # Identical for every turn of a session, so it is the prefix the upstream can cache
+    return f"""{SYSTEM_PROMPT}
+
+{RESPONSE_RULES}
+6. **Use the earlier turns of the conversation to understand follow-up questions.**
+
+*Website Content (Knowledge Base):*
+{context}"""
+
+def build_session_messages(session, knowledge: ChatbotKnowledge, message: str):
+    """Prompt for the next turn of a session.
+
+    Returns the messages, the content to pin once the turn is answered
+    (None to keep the current pin) and any new content sent with the turn.
+    The session itself is left untouched until the answer arrives.
+    """
+    chunk_ids = retrieve_chunk_ids(knowledge, message)
+    chunks = knowledge.index.chunks
+    fingerprint = knowledge.index.fingerprint
+    if session.knowledge is None or not session.turns or session.fingerprint != fingerprint:
+        # No answered turn yet, or the site was re-scraped: pin fresh content at the start of the prompt
+        pin = (fingerprint, format_context([chunks[i] for i in chunk_ids], CONTEXT_TOKEN_BUDGET), chunk_ids)
+        system_content = session_system_content(pin[1])
+        new_ids, extra = [], ""
+    else:
+        pin = None
+        system_content = session_system_content(session.knowledge)
+        new_ids = [i for i in chunk_ids if i not in session.chunk_ids]
+        extra = format_context([chunks[i] for i in new_ids], SESSION_TURN_CONTEXT_TOKENS) if new_ids else ""
+    return session.messages(system_content, message, extra), pin, new_ids, extra
 
 @app.post("/chat")
 async def chat(request: ChatRequest):
@@ -64,72 +299,92 @@ async def chat(request: ChatRequest):
             logger.error("Invalid chatbot ID format.")
             raise HTTPException(status_code=400, detail="Invalid chatbot ID format")
 
-        chatbot = knowledge_collection.find_one({"_id": ObjectId(request.chatbot_id)})
+        knowledge = await get_chatbot_knowledge(request.chatbot_id)
         
-        if not chatbot:
+        if not knowledge:
             logger.error(f"Chatbot not found for id: {request.chatbot_id}")
             raise HTTPException(status_code=404, detail="Chatbot not found")
 
-        # Access the nested scraped_data correctly
-        scraped_data = chatbot.get("scraped_data", {})
-        if isinstance(scraped_data, dict) and "scraped_data" in scraped_data:
-            scraped_data = scraped_data["scraped_data"]
-        
-        # Get the text content
-        context = ""
-        if isinstance(scraped_data, dict):
-            context = scraped_data.get("text", "")
-        elif isinstance(scraped_data, str):
-            context = scraped_data
-
-        if not context:
+        if not len(knowledge.index):
             logger.error("Scraped content is empty. Cannot proceed with chat.")
             raise HTTPException(status_code=400, detail="Scraped content is empty. Cannot proceed with chat.")
 
-        # Preprocess content to make it concise
-        concise_context = preprocess_content(context)
+        session = None
+        if request.session_id or request.start_session:
+            if request.session_id:
+                session = sessions.get(request.session_id, request.chatbot_id)
+            if session is None:
+                session = sessions.create(request.chatbot_id)
+        # Returned with every answer so the widget can send the next turn
+        session_fields = {"session_id": session.session_id} if session else {}
 
-        # Prepare prompts for chat
-        system_prompt = (
-            "You are an intelligent and concise chatbot designed to assist users by answering their questions based on the provided website content. "
-    "You should always follow the rules strictly to ensure precision and relevance in your responses."
-        )
-        user_prompt = f"""
-*Rules for your response:*  
-1. **If the user's input is a greeting (e.g., "Hi", "Hello"), respond politely in 1-2 sentences.**  
-2. **If the user's input is a question, answer in 2-3 sentences based on the scraped website content.**  
-3. **Use the context from the website content to provide precise and relevant information.**  
-4. **If the website content doesn't answer the question, respond with:** "I'm sorry, I couldn't find this information on the website. Can I help with something else?"  
-5. **Do not provide generic, unrelated, or overly long responses.**
+        fingerprint = knowledge.index.fingerprint
+        # Follow-ups depend on the conversation, so only opening questions share cached answers
+        opening_question = session is None or not (session.turns or session.summary)
+        cached_answer = None
+        if opening_question:
+            cached_answer = answer_cache.get(request.chatbot_id, fingerprint, request.message)
+        if cached_answer is not None:
+            logger.info(f"Answer cache hit for chatbot {request.chatbot_id}")
+            if session:
+                # Nothing is pinned for a cached answer; the next question pins its own content
+                session.add_turn(request.message, "", [], cached_answer)
+                sessions.save(session)
+            if request.stream:
+                return StreamingResponse(
+                    stream_cached_answer(cached_answer, session_fields),
+                    media_type="text/event-stream",
+                    headers=SSE_HEADERS
+                )
+            return {"response": cached_answer, **session_fields}
 
-*Website Content (Knowledge Base):*  
-{concise_context}
+        if session:
+            with span("chat.retrieve_context"):
+                messages, pin, new_ids, extra = build_session_messages(session, knowledge, request.message)
+        else:
+            # Only the chunks most relevant to the question go into the prompt
+            with span("chat.retrieve_context"):
+                concise_context = retrieve_context(knowledge, request.message)
+            messages = build_messages(concise_context, request.message)
 
-*User Question:*  
-{request.message}
+        def remember_answer(answer):
+            if opening_question:
+                answer_cache.set(request.chatbot_id, fingerprint, request.message, answer)
+            if session:
+                if pin:
+                    session.pin(*pin)
+                session.add_turn(request.message, extra, new_ids, answer)
+                sessions.save(session)
 
-*Your Response:*
-"""
+        if request.stream:
+            return StreamingResponse(
+                stream_completion(messages, on_complete=remember_answer, done_fields=session_fields),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS
+            )
 
-        # Get response from Cerebras LLM
-        response = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            model="llama3.1-8b",
-            max_tokens=800,
-            temperature=0.7,
-            top_p=1
-        )
-
-        if response and response.choices:
-            chatbot_response = response.choices[0].message.content
-            logger.info(f"Chatbot response: {chatbot_response}")
-            return {"response": chatbot_response}
-        else:
-            logger.error("Failed to get response from Cerebras API")
+        # Get response from Cerebras LLM; identical in-flight questions share one call
+        try:
+            chatbot_response = await llm.complete(
+                messages,
+                # A session's answer depends on its history, so its turns never share a call
+                coalesce_key=None if session else (request.chatbot_id, request.message.strip()),
+                **COMPLETION_PARAMS
+            )
+        except LLMBusyError as e:
+            logger.error(f"Completion rejected: {str(e)}")
+            raise HTTPException(
+                status_code=503,
+                detail="Chat service is busy. Please retry shortly.",
+                headers={"Retry-After": "1"}
+            )
+        except LLMError as e:
+            logger.error(f"Failed to get response from Cerebras API: {str(e)}")
             raise HTTPException(status_code=500, detail="Failed to get response from Cerebras API")
+
+        logger.info(f"Chatbot response: {chatbot_response}")
+        remember_answer(chatbot_response)
+        return {"response": chatbot_response, **session_fields}
     except HTTPException as http_exc:
         logger.error(f"HTTP Exception occurred: {str(http_exc)}")
         raise http_exc
@@ -149,6 +404,23 @@ async def try_chatbot(request: ChatRequest):
         logger.error(f"Unexpected error occurred while testing chatbot: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+@app.post("/cache/invalidate/{chatbot_id}")
+async def invalidate_chatbot_cache(chatbot_id: str):
+    """Drop a chatbot's cached knowledge after it is re-created or re-scraped."""
+    invalidated = chatbot_cache.invalidate(chatbot_id)
+    answers_invalidated = answer_cache.invalidate_chatbot(chatbot_id)
+    logger.info(f"Invalidated cache for chatbot {chatbot_id}: {invalidated}, {answers_invalidated} answers")
+    return {"chatbot_id": chatbot_id, "invalidated": invalidated, "answers_invalidated": answers_invalidated}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        "chatbot_cache": chatbot_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "sessions": sessions.stats(),
+        "llm": llm.stats()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8003)
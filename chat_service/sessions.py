@@ -0,0 +1,140 @@
+import os
+import re
+import secrets
+
+from shared.cache import LRUCache
+from shared.retrieval import count_tokens
+
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+# Idle sessions expire this long after their last turn
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))
+# Verbatim turns kept in the prompt; past this, older turns are compacted into the summary
+SESSION_HISTORY_TOKENS = int(os.getenv("SESSION_HISTORY_TOKENS", "1500"))
+SESSION_SUMMARY_TOKENS = int(os.getenv("SESSION_SUMMARY_TOKENS", "300"))
+# Website content added for a follow-up question that the pinned content doesn't cover
+SESSION_TURN_CONTEXT_TOKENS = int(os.getenv("SESSION_TURN_CONTEXT_TOKENS", "600"))
+# Characters of an answer kept in its summary line
+SUMMARY_ANSWER_CHARS = 200
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s")
+
+
+class Session:
+    """One visitor's conversation with a chatbot.
+
+    The website content retrieved for the first question is pinned into the
+    system message, so the prompt prefix stays byte-identical from turn to
+    turn and upstream prefix caching applies. Later turns only append: a
+    follow-up that needs content the pinned context lacks carries it in its
+    own user message. Compaction rewrites the prefix, so it removes turns in
+    one large step (down to half the history budget) rather than one turn
+    at a time.
+    """
+
+    def __init__(self, session_id, chatbot_id):
+        self.session_id = session_id
+        self.chatbot_id = chatbot_id
+        self.fingerprint = None
+        self.knowledge = None
+        self.chunk_ids = set()
+        self.summary = []
+        self.turns = []
+        self.history_tokens = 0
+        self.compactions = 0
+
+    @property
+    def size(self):
+        text = len(self.knowledge or "") + sum(len(line) for line in self.summary)
+        text += sum(len(turn["question"]) + len(turn["context"]) + len(turn["answer"]) for turn in self.turns)
+        return text + 512
+
+    def pin(self, fingerprint, knowledge, chunk_ids):
+        """Fix the website content at the start of every prompt in this session."""
+        self.fingerprint = fingerprint
+        self.knowledge = knowledge
+        self.chunk_ids = set(chunk_ids)
+        for turn in self.turns:
+            self.chunk_ids.update(turn["chunk_ids"])
+
+    def messages(self, system_content, question, context=""):
+        """The chat messages for the next turn, oldest first."""
+        messages = [{"role": "system", "content": system_content}]
+        if self.summary:
+            messages.append({
+                "role": "system",
+                "content": "Summary of the earlier conversation:\n" + "\n".join(self.summary),
+            })
+        for turn in self.turns:
+            messages.append({"role": "user", "content": user_content(turn["question"], turn["context"])})
+            messages.append({"role": "assistant", "content": turn["answer"]})
+        messages.append({"role": "user", "content": user_content(question, context)})
+        return messages
+
+    def add_turn(self, question, context, chunk_ids, answer):
+        turn = {
+            "question": question,
+            "context": context,
+            "chunk_ids": list(chunk_ids),
+            "answer": answer,
+            "tokens": count_tokens(user_content(question, context)) + count_tokens(answer),
+        }
+        self.turns.append(turn)
+        self.chunk_ids.update(chunk_ids)
+        self.history_tokens += turn["tokens"]
+        if self.history_tokens > SESSION_HISTORY_TOKENS:
+            self.compact(SESSION_HISTORY_TOKENS // 2)
+
+    def compact(self, target_tokens):
+        """Fold the oldest turns into summary lines until the history fits ``target_tokens``."""
+        while self.turns and self.history_tokens > target_tokens:
+            turn = self.turns.pop(0)
+            self.history_tokens -= turn["tokens"]
+            # Content that arrived with a compacted turn is no longer in the prompt
+            self.chunk_ids.difference_update(turn["chunk_ids"])
+            self.summary.append(summary_line(turn["question"], turn["answer"]))
+        while len(self.summary) > 1 and count_tokens("\n".join(self.summary)) > SESSION_SUMMARY_TOKENS:
+            self.summary.pop(0)
+        self.compactions += 1
+
+
+def user_content(question, context):
+    if not context:
+        return question
+    return f"*Additional Website Content:*\n{context}\n\n*User Question:*\n{question}"
+
+
+def summary_line(question, answer):
+    first_sentence = SENTENCE_END_RE.split(answer.strip(), 1)[0]
+    if len(first_sentence) > SUMMARY_ANSWER_CHARS:
+        first_sentence = first_sentence[:SUMMARY_ANSWER_CHARS].rsplit(" ", 1)[0] + "..."
+    return f"- The user asked: {question.strip()} You answered: {first_sentence}"
+
+
+class SessionStore:
+    """Bounded, TTL-evicted conversation sessions, kept in process memory.
+
+    Sessions belong to one chatbot; looking one up with another chatbot's
+    id behaves as if it had expired.
+    """
+
+    def __init__(self, max_entries=SESSION_MAX_ENTRIES, max_bytes=SESSION_MAX_BYTES, ttl=SESSION_TTL):
+        self._cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+
+    def get(self, session_id, chatbot_id):
+        session = self._cache.get(session_id)
+        if session is None or session.chatbot_id != chatbot_id:
+            return None
+        return session
+
+    def create(self, chatbot_id):
+        session = Session(secrets.token_urlsafe(16), chatbot_id)
+        self.save(session)
+        return session
+
+    def save(self, session):
+        # Setting again refreshes the expiry and the size accounting
+        self._cache.set(session.session_id, session, size=session.size)
+
+    def stats(self):
+        return self._cache.stats()
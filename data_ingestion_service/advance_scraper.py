@@ -1,60 +1,54 @@
-import requests
+import asyncio
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse
+import logging
 import os
 import sys
 
 # Ensure that this script can be imported properly
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from crawler import CrawlEngine
+
+logger = logging.getLogger(__name__)
+
 class WebScraper:
-    def __init__(self, base_url, max_depth=2):
+    def __init__(self, base_url, max_depth=2, **crawl_options):
         self.base_url = base_url
         self.max_depth = max_depth
         self.visited_urls = set()
+        self.crawl_options = crawl_options
 
     def scrape_site(self):
         """Start scraping from the base URL."""
-        return self.scrape_page(self.base_url, 0)
-
-    def scrape_page(self, url, depth):
-        """Recursively scrape a page and follow links up to the specified depth."""
-        if depth > self.max_depth or url in self.visited_urls:
-            return None
-
-        self.visited_urls.add(url)
-        print(f"Scraping: {url} at depth {depth}")
-
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Scrape main content
-            page_data = {
-                "url": url,
-                "title": soup.title.string if soup.title else "No Title",
-                "meta": self.get_all_meta(soup),
-                "headings": self.get_all_headings(soup),
-                "links": [],
-                "images": self.get_all_images(soup),
-                "text": self.get_all_text(soup)
-            }
+        return asyncio.run(self.crawl())
 
-            # Process all links and recursively scrape
-            links = self.get_all_links(soup, url)
-            for link in links:
-                page_data["links"].append(link)
-                link_url = link['url']
-                if link_url not in self.visited_urls:
-                    child_data = self.scrape_page(link_url, depth + 1)
-                    if child_data:
-                        page_data.setdefault("child_pages", []).append(child_data)
+    async def crawl(self):
+        """Run the concurrent crawl engine and return the root page_data."""
+        engine = CrawlEngine(
+            self.base_url,
+            self.extract_page,
+            max_depth=self.max_depth,
+            **self.crawl_options
+        )
+        scraped_data = await engine.crawl()
+        self.visited_urls = engine.visited_urls
+        return scraped_data
 
-            return page_data
-        except requests.exceptions.RequestException as e:
-            print(f"Error while scraping {url}: {e}")
-            return None
+    def extract_page(self, html, url):
+        """Parse a fetched page into the page_data shape."""
+        logger.info(f"Scraping: {url}")
+        soup = BeautifulSoup(html, 'html.parser')
+        return {
+            "url": url,
+            "title": soup.title.string if soup.title else "No Title",
+            "meta": self.get_all_meta(soup),
+            "headings": self.get_all_headings(soup),
+            "links": self.get_all_links(soup, url),
+            "images": self.get_all_images(soup),
+            "text": self.get_all_text(soup)
+        }
 
     def get_all_meta(self, soup):
         meta_data = {}
@@ -98,7 +92,8 @@ class WebScraper:
         return " ".join(soup.stripped_strings)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     base_url = "https://example.com"
     scraper = WebScraper(base_url, max_depth=2)
     scraped_data = scraper.scrape_site()
-    print(scraped_data)
+    logger.info(f"Scraped data: {scraped_data}")
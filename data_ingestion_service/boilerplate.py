@@ -0,0 +1,135 @@
+import hashlib
+import os
+import re
+
+# A text block is boilerplate once it repeats on this share of a site's pages...
+BOILERPLATE_MIN_FRACTION = float(os.getenv("BOILERPLATE_MIN_FRACTION", "0.5"))
+# ...and on at least this many of them, so small sites keep their content
+BOILERPLATE_MIN_PAGES = int(os.getenv("BOILERPLATE_MIN_PAGES", "3"))
+# Pages whose 64-bit SimHashes differ in at most this many bits are near-duplicates
+SIMHASH_MAX_DISTANCE = int(os.getenv("SIMHASH_MAX_DISTANCE", "5"))
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+WORD_RE = re.compile(r"\w+")
+
+
+def block_hash(block):
+    return hashlib.sha1(" ".join(block.lower().split()).encode("utf-8")).hexdigest()[:16]
+
+
+def find_boilerplate(texts, min_fraction=BOILERPLATE_MIN_FRACTION, min_pages=BOILERPLATE_MIN_PAGES):
+    """Return hashes of the text blocks (lines) repeated across most of ``texts``."""
+    # Counts as it goes, so ``texts`` can stream pages one at a time
+    pages = 0
+    page_counts = {}
+    for text in texts:
+        pages += 1
+        for digest in {block_hash(block) for block in text.splitlines() if block.strip()}:
+            page_counts[digest] = page_counts.get(digest, 0) + 1
+    threshold = max(min_pages, min_fraction * pages)
+    return {digest for digest, count in page_counts.items() if count >= threshold}
+
+
+def strip_boilerplate(text, boilerplate):
+    if not boilerplate or not text:
+        return text
+    return "\n".join(block for block in text.splitlines() if block_hash(block) not in boilerplate)
+
+
+def simhash(text):
+    """64-bit SimHash of the text's word shingles."""
+    words = WORD_RE.findall(text.lower())
+    shingles = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))]
+    # Count byte values per digest position; bit majorities are read off the tables at the end
+    tables = [[0] * 256 for _ in range(SIMHASH_BITS // 8)]
+    for shingle in shingles:
+        digest = hashlib.blake2b(shingle.encode("utf-8"), digest_size=SIMHASH_BITS // 8).digest()
+        for table, byte in zip(tables, digest):
+            table[byte] += 1
+    fingerprint = 0
+    for position, table in enumerate(reversed(tables)):
+        for bit in range(8):
+            ones = sum(count for value, count in enumerate(table) if value >> bit & 1)
+            if ones * 2 > len(shingles):
+                fingerprint |= 1 << (position * 8 + bit)
+    return fingerprint
+
+
+class NearDuplicateIndex:
+    """Finds stored SimHashes within ``max_distance`` bits of a new one.
+
+    Fingerprints are split into ``max_distance + 1`` bands; any two within
+    the distance agree exactly on at least one band, so only fingerprints
+    sharing a band are compared.
+    """
+
+    def __init__(self, max_distance=SIMHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        self._band_bits = -(-SIMHASH_BITS // bands)
+        self._bands = [{} for _ in range(bands)]
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << self._band_bits) - 1
+        return [(fingerprint >> (i * self._band_bits)) & mask for i in range(len(self._bands))]
+
+    def add(self, key, fingerprint):
+        for band, band_key in zip(self._bands, self._band_keys(fingerprint)):
+            band.setdefault(band_key, []).append((key, fingerprint))
+
+    def find(self, fingerprint):
+        """Return the key of a near-duplicate fingerprint, or None."""
+        for band, band_key in zip(self._bands, self._band_keys(fingerprint)):
+            for key, other in band.get(band_key, ()):
+                if bin(fingerprint ^ other).count("1") <= self.max_distance:
+                    return key
+        return None
+
+
+def clean_tree(scraped_data, boilerplate=None):
+    """Strip boilerplate blocks and drop near-duplicate pages from a crawl tree, in place.
+
+    Boilerplate is learned from the tree itself unless ``boilerplate`` is
+    given. A dropped page's children move up to its parent; pages are
+    compared in breadth-first order, so the shallowest copy is the one kept.
+    Each kept page gets its ``simhash`` (hex). Returns the boilerplate
+    hashes and the URLs dropped as duplicates.
+    """
+    pages = [scraped_data]
+    for page in pages:
+        pages.extend(page.get("child_pages", []))
+    if boilerplate is None:
+        boilerplate = find_boilerplate(page.get("text") or "" for page in pages)
+
+    duplicates = NearDuplicateIndex()
+    dropped = []
+    for page in pages:
+        page["text"] = strip_boilerplate(page.get("text") or "", boilerplate)
+        fingerprint = simhash(page["text"])
+        if page is not scraped_data and page["text"] and duplicates.find(fingerprint) is not None:
+            page["duplicate"] = True
+            dropped.append(page.get("url"))
+            continue
+        duplicates.add(page.get("url"), fingerprint)
+        page["simhash"] = format(fingerprint, "016x")
+
+    _remove_duplicates(scraped_data)
+    return boilerplate, dropped
+
+
+def _remove_duplicates(page):
+    stack = [page]
+    while stack:
+        page = stack.pop()
+        children = []
+        pending = list(page.get("child_pages", []))
+        while pending:
+            child = pending.pop(0)
+            if child.pop("duplicate", False):
+                pending[:0] = child.get("child_pages", [])
+            else:
+                children.append(child)
+        if "child_pages" in page:
+            page["child_pages"] = children
+        stack.extend(children)
@@ -0,0 +1,356 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+import uuid
+
+from bson import Binary
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+from frontier import DEFAULT_PRIORITY, Frontier
+from shared.database import db
+from shared.page_store import compress_text, decompress_text
+
+logger = logging.getLogger(__name__)
+
+# Checkpoint full crawls so they survive worker restarts and can be shared between processes
+CRAWL_CHECKPOINTS = os.getenv("CRAWL_CHECKPOINTS", "0") == "1"
+# Finished pages are written once this many are buffered, or after the interval
+CRAWL_CHECKPOINT_BATCH = int(os.getenv("CRAWL_CHECKPOINT_BATCH", "20"))
+CRAWL_CHECKPOINT_INTERVAL = float(os.getenv("CRAWL_CHECKPOINT_INTERVAL", "5"))
+# A claimed URL returns to the queue if its worker doesn't check in for this long
+CRAWL_LEASE_SECONDS = int(os.getenv("CRAWL_LEASE_SECONDS", "120"))
+FRONTIER_POLL_INTERVAL = 0.5
+
+# Frontier entry states
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+
+# Crawl states; paused and stale running crawls can be resumed
+RUNNING = "running"
+PAUSED = "paused"
+COMPLETED = "completed"
+
+
+def new_crawl_id():
+    return uuid.uuid4().hex
+
+
+class CrawlCheckpoint:
+    """A crawl's frontier, visited set and fetched pages, stored in MongoDB.
+
+    Three collections: ``crawls`` (one document per crawl), ``crawl_frontier``
+    (one entry per discovered URL; its state is queued, leased or done) and
+    ``crawl_pages`` (page data of finished URLs). The crawl document counts
+    the URLs admitted to the frontier, so ``max_pages`` holds for the crawl
+    as a whole however many workers share it. Every method is a
+    synchronous database round trip; async callers run them in a thread.
+    """
+
+    def __init__(self, crawl_id, user_id=None, owner=True, database=db):
+        self.crawl_id = crawl_id
+        self.user_id = user_id
+        # Owners assemble and store the crawl when the frontier runs dry; helpers only fetch
+        self.owner = owner
+        self.worker_id = uuid.uuid4().hex
+        self.crawls = database["crawls"]
+        self.frontier = database["crawl_frontier"]
+        self.pages = database["crawl_pages"]
+
+    def start(self, root_url, max_depth, max_pages):
+        """Create the crawl document, or pick up an existing one; returns it."""
+        now = datetime.datetime.utcnow()
+        update = {
+            "$setOnInsert": {
+                "root_url": root_url,
+                "user_id": self.user_id,
+                "max_depth": max_depth,
+                "max_pages": max_pages,
+                "pages_fetched": 0,
+                "bytes_fetched": 0,
+                "urls_admitted": 0,
+                "created_at": now,
+            },
+            "$set": {"updated_at": now},
+        }
+        if self.owner:
+            update["$set"]["status"] = RUNNING
+        return self.crawls.find_one_and_update(
+            {"_id": self.crawl_id}, update, upsert=True, return_document=ReturnDocument.AFTER
+        )
+
+    def load(self):
+        return self.crawls.find_one({"_id": self.crawl_id})
+
+    def seen_urls(self):
+        return {entry["url"] for entry in self.frontier.find({"crawl_id": self.crawl_id}, {"url": 1})}
+
+    def claim(self):
+        """Lease the next URL to fetch (shallowest, then highest priority); None if none is free."""
+        now = datetime.datetime.utcnow()
+        return self.frontier.find_one_and_update(
+            {
+                "crawl_id": self.crawl_id,
+                "$or": [{"state": QUEUED}, {"state": LEASED, "lease_expires_at": {"$lt": now}}],
+            },
+            {"$set": {
+                "state": LEASED,
+                "worker": self.worker_id,
+                "lease_expires_at": now + datetime.timedelta(seconds=CRAWL_LEASE_SECONDS),
+            }},
+            sort=[("depth", 1), ("priority", -1), ("order", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def admit(self, entries):
+        """Reserve page budget for the entries not yet in the frontier.
+
+        Returns ``(admitted, dropped)``: the entries to write, in order, and
+        how many new ones the budget turned away. The reservation is a
+        compare-and-set on the crawl document's ``urls_admitted``. Two workers
+        that discover the same URL at once may both reserve a slot for it.
+        The crawl then stops short of ``max_pages``, but never goes over it.
+        """
+        known = {
+            entry["url"] for entry in self.frontier.find(
+                {"crawl_id": self.crawl_id, "url": {"$in": [entry["url"] for entry in entries]}}, {"url": 1}
+            )
+        }
+        new = [entry for entry in entries if entry["url"] not in known]
+        while new:
+            crawl = self.crawls.find_one({"_id": self.crawl_id}, {"max_pages": 1, "urls_admitted": 1})
+            admitted = crawl.get("urls_admitted")
+            # Crawls checkpointed before the counter existed start from their frontier's size
+            base = admitted if admitted is not None else self.frontier.count_documents({"crawl_id": self.crawl_id})
+            granted = max(0, min(len(new), crawl["max_pages"] - base))
+            if not granted:
+                break
+            result = self.crawls.update_one(
+                {"_id": self.crawl_id, "urls_admitted": admitted}, {"$set": {"urls_admitted": base + granted}}
+            )
+            if result.modified_count:
+                return new[:granted], len(new) - granted
+        return [], len(new)
+
+    def write(self, entries, pages, renew, pages_fetched, bytes_fetched):
+        """Persist one batch: newly discovered URLs, finished pages, and leases still held.
+
+        New entries are written before the pages that discovered them are
+        marked done, so a crash in between only causes a re-fetch. Returns
+        how many new entries the crawl's page budget dropped.
+        """
+        now = datetime.datetime.utcnow()
+        dropped = 0
+        if entries:
+            entries, dropped = self.admit(entries)
+        if entries:
+            self.frontier.bulk_write([
+                UpdateOne(
+                    {"crawl_id": self.crawl_id, "url": entry["url"]},
+                    {"$setOnInsert": {**entry, "crawl_id": self.crawl_id, "state": QUEUED}},
+                    upsert=True,
+                )
+                for entry in entries
+            ], ordered=False)
+        if pages:
+            self.pages.bulk_write([
+                UpdateOne({"crawl_id": self.crawl_id, "url": page["url"]}, {"$set": page}, upsert=True)
+                for page in pages
+            ], ordered=False)
+            self.frontier.update_many(
+                {"crawl_id": self.crawl_id, "url": {"$in": [page["url"] for page in pages]}},
+                {"$set": {"state": DONE}, "$unset": {"lease_expires_at": "", "worker": ""}},
+            )
+        if renew:
+            self.frontier.update_many(
+                {"crawl_id": self.crawl_id, "url": {"$in": renew}, "state": LEASED, "worker": self.worker_id},
+                {"$set": {"lease_expires_at": now + datetime.timedelta(seconds=CRAWL_LEASE_SECONDS)}},
+            )
+        self.crawls.update_one(
+            {"_id": self.crawl_id},
+            {"$inc": {"pages_fetched": pages_fetched, "bytes_fetched": bytes_fetched}, "$set": {"updated_at": now}},
+        )
+        return dropped
+
+    def entry(self, url):
+        return self.frontier.find_one({"crawl_id": self.crawl_id, "url": url})
+
+    def release(self, urls):
+        """Return this worker's unfinished leases to the queue."""
+        if urls:
+            self.frontier.update_many(
+                {"crawl_id": self.crawl_id, "url": {"$in": list(urls)}, "state": LEASED, "worker": self.worker_id},
+                {"$set": {"state": QUEUED}, "$unset": {"lease_expires_at": "", "worker": ""}},
+            )
+
+    def exhausted(self):
+        """True once no URL is queued or leased anywhere."""
+        return self.frontier.count_documents(
+            {"crawl_id": self.crawl_id, "state": {"$in": [QUEUED, LEASED]}}, limit=1
+        ) == 0
+
+    def load_pages(self):
+        """Yield ``(url, page_data or None, parent, depth, fetch_info)``, parents before children."""
+        cursor = self.pages.find({"crawl_id": self.crawl_id}).sort([("depth", 1), ("order", 1)])
+        for record in cursor:
+            page = record.get("page")
+            if page is not None:
+                page = dict(page, text=decompress_text(record["text_encoding"], record["text"]))
+            yield record["url"], page, record.get("parent"), record.get("depth", 0), record.get("fetch_info")
+
+    def pause(self):
+        self.crawls.update_one(
+            {"_id": self.crawl_id, "status": RUNNING},
+            {"$set": {"status": PAUSED, "updated_at": datetime.datetime.utcnow()}},
+        )
+
+    def complete(self):
+        """Mark the crawl completed and drop its working state; False if already completed."""
+        result = self.crawls.update_one(
+            {"_id": self.crawl_id, "status": {"$ne": COMPLETED}},
+            {"$set": {"status": COMPLETED, "updated_at": datetime.datetime.utcnow()}},
+        )
+        self.frontier.delete_many({"crawl_id": self.crawl_id})
+        self.pages.delete_many({"crawl_id": self.crawl_id})
+        return result.modified_count == 1
+
+    def status(self):
+        crawl = self.load()
+        if crawl is None:
+            return None
+        counts = {QUEUED: 0, LEASED: 0, DONE: 0}
+        for row in self.frontier.aggregate([
+            {"$match": {"crawl_id": self.crawl_id}},
+            {"$group": {"_id": "$state", "count": {"$sum": 1}}},
+        ]):
+            counts[row["_id"]] = row["count"]
+        crawl["crawl_id"] = crawl.pop("_id")
+        crawl["frontier"] = counts
+        return crawl
+
+    @staticmethod
+    def page_record(url, page_data, entry, fetch_info):
+        record = {
+            "url": url,
+            "parent": entry.get("parent"),
+            "depth": entry.get("depth", 0),
+            "order": entry.get("order", 0),
+            "fetch_info": fetch_info,
+            "page": None,
+        }
+        if page_data is not None:
+            encoding, data = compress_text(page_data.get("text") or "")
+            record["page"] = {key: value for key, value in page_data.items() if key not in ("text", "child_pages")}
+            record["text_encoding"] = encoding
+            record["text"] = Binary(data)
+        return record
+
+
+class SharedFrontier(Frontier):
+    """A ``Frontier`` kept in a ``CrawlCheckpoint`` and shared by every worker of the crawl.
+
+    Discovered URLs and finished pages are buffered and written in batches.
+    ``get`` leases URLs from the stored frontier, so processes working on the
+    same crawl never fetch the same URL twice while their leases are live.
+    ``max_pages`` is checked against the crawl's shared count when a batch
+    is written, not only against this worker's ``seen`` set.
+    ``stop`` is polled; once it returns True no more URLs are claimed and
+    ``join`` returns, leaving the rest of the frontier for a later resume.
+    """
+
+    def __init__(
+        self, checkpoint, root_url, max_pages, user_agent, robots=None, priorities=None, stop=None, fetched=(0, 0)
+    ):
+        super().__init__(root_url, max_pages, user_agent, robots, priorities)
+        self.checkpoint = checkpoint
+        self.stop = stop or (lambda: False)
+        self.seen = checkpoint.seen_urls()
+        self.in_flight = 0
+        self._entries = []
+        self._finished = []
+        self._claimed = {}
+        self._last_write = time.monotonic()
+        # (pages, bytes) fetched as of the last write, so each write adds only the difference
+        self._reported = tuple(fetched)
+
+    def _push(self, url, depth, priority, parent):
+        self._entries.append({
+            "url": url,
+            "depth": depth,
+            "priority": priority,
+            "parent": parent,
+            "order": time.time(),
+        })
+
+    async def get(self):
+        while True:
+            if not self.stop():
+                try:
+                    if self._entries:
+                        await self.checkpoint_now()
+                    entry = await asyncio.to_thread(self.checkpoint.claim)
+                except PyMongoError as e:
+                    logger.warning(f"Could not claim from crawl {self.checkpoint.crawl_id}: {str(e)}")
+                    entry = None
+                if entry is not None:
+                    self._claimed[entry["url"]] = entry
+                    self.in_flight += 1
+                    return entry["url"], entry["depth"]
+            await asyncio.sleep(FRONTIER_POLL_INTERVAL)
+
+    def task_done(self):
+        self.in_flight -= 1
+
+    def page_done(self, url, page_data, fetch_info):
+        entry = self._claimed.pop(url, None)
+        if entry is None:
+            # Every fetched URL was claimed first; without its entry the page would lose its place in the tree
+            logger.warning(f"Crawl {self.checkpoint.crawl_id} finished unclaimed {url}; loading its frontier entry")
+            entry = self.checkpoint.entry(url) or {"url": url, "depth": 0, "priority": DEFAULT_PRIORITY}
+        self._finished.append(CrawlCheckpoint.page_record(url, page_data, entry, fetch_info))
+
+    @property
+    def checkpoint_due(self):
+        return (
+            len(self._entries) + len(self._finished) >= CRAWL_CHECKPOINT_BATCH
+            or time.monotonic() - self._last_write >= CRAWL_CHECKPOINT_INTERVAL
+        )
+
+    async def checkpoint_now(self, pages_fetched=None, bytes_fetched=None):
+        # Swap the buffers on the loop thread; only the database writes run in a worker thread
+        entries, self._entries = self._entries, []
+        pages, self._finished = self._finished, []
+        pages_fetched = self._reported[0] if pages_fetched is None else pages_fetched
+        bytes_fetched = self._reported[1] if bytes_fetched is None else bytes_fetched
+        deltas = (pages_fetched - self._reported[0], bytes_fetched - self._reported[1])
+        self._reported = (pages_fetched, bytes_fetched)
+        self._last_write = time.monotonic()
+        try:
+            dropped = await asyncio.to_thread(self.checkpoint.write, entries, pages, list(self._claimed), *deltas)
+        except BaseException:
+            # Keep the batch for the next write; every step of it is safe to repeat
+            self._entries[:0] = entries
+            self._finished[:0] = pages
+            self._reported = (self._reported[0] - deltas[0], self._reported[1] - deltas[1])
+            raise
+        if dropped:
+            self.truncated = True
+
+    async def join(self):
+        while True:
+            await asyncio.sleep(FRONTIER_POLL_INTERVAL)
+            if self.stop():
+                return
+            if self.in_flight == 0:
+                await self.checkpoint_now()
+                if await asyncio.to_thread(self.checkpoint.exhausted):
+                    return
+
+    async def close(self, pages_fetched, bytes_fetched):
+        """Write what is buffered and hand unfinished leases back to the queue."""
+        await self.checkpoint_now(pages_fetched, bytes_fetched)
+        released, self._claimed = list(self._claimed), {}
+        await asyncio.to_thread(self.checkpoint.release, released)
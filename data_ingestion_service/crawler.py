@@ -0,0 +1,403 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import httpx
+
+from frontier import (
+    CRAWL_RESPECT_ROBOTS,
+    CRAWL_USE_SITEMAP,
+    Frontier,
+    canonicalize_url,
+    load_robots,
+    load_sitemap,
+)
+from parse_pool import CRAWL_PARSE_QUEUE
+from shared.metrics import observe_span, span
+
+logger = logging.getLogger(__name__)
+
+# Crawl budgets, overridable per deployment
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", "300"))
+CRAWL_MAX_BYTES = int(os.getenv("CRAWL_MAX_BYTES", str(50 * 1024 * 1024)))
+CRAWL_MAX_PAGE_BYTES = int(os.getenv("CRAWL_MAX_PAGE_BYTES", str(5 * 1024 * 1024)))
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "16"))
+CRAWL_PER_HOST_CONCURRENCY = int(os.getenv("CRAWL_PER_HOST_CONCURRENCY", "4"))
+CRAWL_TIMEOUT = float(os.getenv("CRAWL_TIMEOUT", "10"))
+CRAWL_USER_AGENT = os.getenv("CRAWL_USER_AGENT", "HyperSalesBot/1.0")
+
+# Returned by _fetch instead of (body, encoding) when a conditional request comes back 304
+NOT_MODIFIED = object()
+# Returned by _visit when the budget ran out or the crawl was cancelled before the fetch
+ABORTED = object()
+
+
+def fetch_validators(fetch_info):
+    """The fields of a page's fetch info that page records keep for conditional refreshes."""
+    fetch_info = fetch_info or {}
+    return {
+        "etag": fetch_info.get("etag"),
+        "last_modified": fetch_info.get("last_modified"),
+        "body_hash": fetch_info.get("body_hash"),
+    }
+
+
+class CrawlEngine:
+    """Concurrent crawler that works through a prioritized frontier.
+
+    ``extract_page(html, url)`` turns a fetched document into a ``page_data``
+    dict whose ``links`` entries drive the crawl. URLs are canonicalized and
+    filtered by robots.txt before they are queued; sitemap URLs are seeded
+    one level below the root, and shallower URLs are fetched first. Pages
+    are reassembled into the nested ``child_pages`` tree the recursive
+    scraper used to return.
+
+    ``known_pages`` maps URLs to their stored page records for incremental
+    re-crawls: requests carry ``If-None-Match``/``If-Modified-Since`` from the
+    record, and pages that come back 304 or with an identical body hash are
+    not parsed again. They are listed in ``unchanged_urls`` and their stored
+    links keep driving the crawl.
+
+    With a ``checkpoint`` the frontier, visited set and fetched pages live in
+    the database instead (see ``checkpoint.SharedFrontier``): the crawl picks
+    up where an earlier run of the same crawl stopped, other processes can
+    fetch from the same frontier, and an owning checkpoint reassembles the
+    tree from every stored page once nothing is left to fetch, unless
+    ``assemble_tree`` is off and the caller streams the pages out of the
+    checkpoint itself. A cancelled checkpointed crawl returns None and stays
+    resumable. Checkpointed pages are not kept in memory.
+
+    ``parse_document(body, encoding, url)``, when given, is an async
+    replacement for ``extract_page`` that parses off the event loop (in a
+    process pool). At most ``parse_queue`` fetched pages wait for it; fetch
+    workers hold off until a slot frees, which bounds memory while the
+    other workers keep fetching.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        extract_page,
+        max_depth=2,
+        max_pages=CRAWL_MAX_PAGES,
+        max_bytes=CRAWL_MAX_BYTES,
+        max_page_bytes=CRAWL_MAX_PAGE_BYTES,
+        concurrency=CRAWL_CONCURRENCY,
+        per_host_concurrency=CRAWL_PER_HOST_CONCURRENCY,
+        timeout=CRAWL_TIMEOUT,
+        user_agent=CRAWL_USER_AGENT,
+        progress_callback=None,
+        cancel_event=None,
+        known_pages=None,
+        respect_robots=CRAWL_RESPECT_ROBOTS,
+        use_sitemap=CRAWL_USE_SITEMAP,
+        checkpoint=None,
+        assemble_tree=True,
+        parse_document=None,
+        parse_queue=CRAWL_PARSE_QUEUE,
+    ):
+        self.base_url = canonicalize_url(base_url)
+        self.extract_page = extract_page
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.max_page_bytes = max_page_bytes
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event
+        self.known_pages = known_pages or {}
+        self.respect_robots = respect_robots
+        self.use_sitemap = use_sitemap
+        self.checkpoint = checkpoint
+        self.assemble_tree = assemble_tree
+        self.parse_document = parse_document
+        self.parse_queue = parse_queue
+
+        self.visited_urls = set()
+        self.pages_fetched = 0
+        self.bytes_fetched = 0
+        self.errors = 0
+
+        # Per-URL crawl results, filled in as pages complete
+        self.pages = {}
+        self.parents = {}
+        self.depths = {}
+        self.fetch_info = {}
+        self.unchanged_urls = set()
+        self.failed_urls = {}
+
+        self._children = defaultdict(list)
+        self._host_limits = {}
+        self._host_next_fetch = {}
+        self._global_limit = None
+        self._parse_slots = None
+        self.frontier = None
+
+    @property
+    def budget_exhausted(self):
+        return self.bytes_fetched >= self.max_bytes
+
+    @property
+    def truncated(self):
+        """Whether the byte budget or the page cap left reachable pages uncrawled."""
+        return self.budget_exhausted or (self.frontier is not None and self.frontier.truncated)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def _report_progress(self):
+        if self.progress_callback:
+            self.progress_callback(self.pages_fetched, self.bytes_fetched, self.errors)
+
+    async def crawl(self):
+        """Crawl from ``base_url`` and return the root ``page_data`` or None."""
+        self._global_limit = asyncio.Semaphore(self.concurrency)
+        self._parse_slots = asyncio.Semaphore(self.parse_queue)
+        limits = httpx.Limits(
+            max_connections=self.concurrency,
+            max_keepalive_connections=self.concurrency,
+        )
+        async with httpx.AsyncClient(
+            limits=limits,
+            timeout=httpx.Timeout(self.timeout),
+            follow_redirects=True,
+            headers={"User-Agent": self.user_agent},
+        ) as client:
+            robots = await load_robots(client, self.base_url) if self.respect_robots else None
+            priorities = {}
+            if self.use_sitemap and self.max_depth >= 1:
+                priorities = await load_sitemap(client, self.base_url, robots)
+            if self.checkpoint is not None:
+                await self._start_checkpoint(robots, priorities)
+            else:
+                self.frontier = Frontier(self.base_url, self.max_pages, self.user_agent, robots, priorities)
+            self.visited_urls = self.frontier.seen
+            if self.frontier.crawl_delay:
+                logger.info(f"Honoring a crawl delay of {self.frontier.crawl_delay}s")
+
+            self._enqueue(self.base_url, 0, None)
+            for url in sorted(priorities, key=priorities.get, reverse=True):
+                self._enqueue(url, 1, self.base_url)
+
+            workers = [asyncio.create_task(self._worker(client)) for _ in range(self.concurrency)]
+            await self.frontier.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        if self.checkpoint is not None:
+            return await self._finish_checkpoint()
+        return self._assemble(self.base_url)
+
+    async def _start_checkpoint(self, robots, priorities):
+        # Imported here so crawls without a checkpoint never touch the database modules
+        from checkpoint import SharedFrontier
+
+        crawl = await asyncio.to_thread(self.checkpoint.start, self.base_url, self.max_depth, self.max_pages)
+        # Budgets cover the whole crawl, including earlier runs and other workers
+        self.pages_fetched = crawl.get("pages_fetched", 0)
+        self.bytes_fetched = crawl.get("bytes_fetched", 0)
+        self.frontier = SharedFrontier(
+            self.checkpoint, self.base_url, self.max_pages, self.user_agent, robots, priorities,
+            stop=lambda: self.budget_exhausted or self.cancelled,
+            fetched=(self.pages_fetched, self.bytes_fetched),
+        )
+        if self.frontier.seen:
+            logger.info(f"Resuming crawl {self.checkpoint.crawl_id} with {len(self.frontier.seen)} known URLs")
+
+    async def _finish_checkpoint(self):
+        await self.frontier.close(self.pages_fetched, self.bytes_fetched)
+        if self.cancelled:
+            if self.checkpoint.owner:
+                await asyncio.to_thread(self.checkpoint.pause)
+            return None
+        if not self.checkpoint.owner or not self.assemble_tree:
+            return None
+        records = await asyncio.to_thread(lambda: list(self.checkpoint.load_pages()))
+        self._children = defaultdict(list)
+        for url, page_data, parent, depth, fetch_info in records:
+            self.parents[url] = parent
+            self.depths[url] = depth
+            if fetch_info:
+                self.fetch_info[url] = fetch_info
+            if page_data is not None:
+                self.pages[url] = page_data
+            if parent is not None:
+                self._children[parent].append(url)
+        return self._assemble(self.base_url)
+
+    def _enqueue(self, url, depth, parent):
+        url = self.frontier.add(url, depth, parent)
+        if url is None:
+            return
+        self.parents[url] = parent
+        self.depths[url] = depth
+        if parent is not None:
+            self._children[parent].append(url)
+
+    async def _worker(self, client):
+        while True:
+            url, depth = await self.frontier.get()
+            page_data = None
+            # Set once the URL's outcome is final; aborted URLs stay leased and are requeued on close
+            finished = False
+            try:
+                # Once the budget is spent or the job cancelled, just drain the queue
+                if self.budget_exhausted or self.cancelled:
+                    continue
+                page_data = await self._visit(client, url)
+                if page_data is ABORTED:
+                    continue
+                finished = True
+                if page_data is None:
+                    continue
+                if self.checkpoint is None:
+                    self.pages[url] = page_data
+                if depth + 1 <= self.max_depth:
+                    for link in page_data["links"]:
+                        self._enqueue(link["url"], depth + 1, url)
+            except Exception as e:
+                finished = True
+                self.errors += 1
+                logger.error(f"Error crawling {url}: {str(e)}")
+            finally:
+                if finished and self.checkpoint is not None:
+                    await self._checkpoint_page(url, page_data)
+                self.frontier.task_done()
+
+    async def _checkpoint_page(self, url, page_data):
+        # Failed pages are recorded too, so resuming doesn't fetch them again
+        self.frontier.page_done(url, page_data, self.fetch_info.get(url))
+        if self.frontier.checkpoint_due:
+            try:
+                await self.frontier.checkpoint_now(self.pages_fetched, self.bytes_fetched)
+            except Exception as e:
+                # The batch stays buffered and goes out with the next write
+                self.errors += 1
+                logger.error(f"Error checkpointing crawl {self.checkpoint.crawl_id}: {str(e)}")
+
+    def _host_limit(self, url):
+        host = urlparse(url).netloc
+        if host not in self._host_limits:
+            # A crawl delay means one request at a time, spaced by the delay
+            limit = 1 if self.frontier.crawl_delay else self.per_host_concurrency
+            self._host_limits[host] = asyncio.Semaphore(limit)
+        return self._host_limits[host]
+
+    async def _wait_for_crawl_delay(self, url):
+        delay = self.frontier.crawl_delay
+        if not delay:
+            return
+        host = urlparse(url).netloc
+        wait = self._host_next_fetch.get(host, 0) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._host_next_fetch[host] = time.monotonic() + delay
+
+    async def _visit(self, client, url):
+        async with self._host_limit(url):
+            await self._wait_for_crawl_delay(url)
+            async with self._global_limit:
+                if self.budget_exhausted or self.cancelled:
+                    return ABORTED
+                fetched = await self._fetch(client, url)
+        if fetched is None:
+            return None
+        known = self.known_pages.get(url)
+        if fetched is NOT_MODIFIED or (known and known.get("body_hash") == self.fetch_info[url]["body_hash"]):
+            return self._reuse_known_page(url)
+        return await self._parse(*fetched, url)
+
+    async def _parse(self, body, encoding, url):
+        if self.parse_document is None:
+            with span("scrape.parse"):
+                return self.extract_page(body.decode(encoding or "utf-8", errors="replace"), url)
+        async with self._parse_slots:
+            with span("scrape.parse"):
+                return await self.parse_document(body, encoding, url)
+
+    def _reuse_known_page(self, url):
+        self.unchanged_urls.add(url)
+        known = self.known_pages[url]
+        return {
+            "url": url,
+            "title": known.get("title", ""),
+            "meta": known.get("meta", {}),
+            "headings": known.get("headings", {}),
+            "links": known.get("links", []),
+            "images": known.get("images", []),
+            "text": None,
+        }
+
+    def _conditional_headers(self, url):
+        known = self.known_pages.get(url)
+        headers = {}
+        if known and known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known and known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
+        return headers
+
+    async def _fetch(self, client, url):
+        start = time.perf_counter()
+        try:
+            async with client.stream("GET", url, headers=self._conditional_headers(url)) as response:
+                if response.status_code == 304:
+                    known = self.known_pages[url]
+                    self.fetch_info[url] = {
+                        "etag": response.headers.get("etag", known.get("etag")),
+                        "last_modified": response.headers.get("last-modified", known.get("last_modified")),
+                        "body_hash": known.get("body_hash"),
+                    }
+                    return NOT_MODIFIED
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", "")
+                if content_type and "html" not in content_type and "xml" not in content_type:
+                    logger.info(f"Skipping {url}: unsupported content type {content_type}")
+                    return None
+
+                chunks = []
+                size = 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > self.max_page_bytes:
+                        logger.warning(f"Truncating {url}: exceeds {self.max_page_bytes} bytes")
+                        break
+                    chunks.append(chunk)
+
+                body = b"".join(chunks)
+                self.fetch_info[url] = {
+                    "etag": response.headers.get("etag"),
+                    "last_modified": response.headers.get("last-modified"),
+                    "body_hash": hashlib.sha256(body).hexdigest(),
+                }
+                self.pages_fetched += 1
+                self.bytes_fetched += size
+                observe_span("scrape.fetch", time.perf_counter() - start)
+                self._report_progress()
+                return body, response.encoding
+        except httpx.HTTPError as e:
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            self.failed_urls[url] = status
+            self.errors += 1
+            self._report_progress()
+            logger.error(f"Error while scraping {url}: {e}")
+            return None
+
+    def _assemble(self, url):
+        page_data = self.pages.get(url)
+        if page_data is None:
+            return None
+        for child_url in self._children.get(url, []):
+            child_data = self._assemble(child_url)
+            if child_data:
+                page_data.setdefault("child_pages", []).append(child_data)
+        return page_data
@@ -0,0 +1,244 @@
+import logging
+import os
+from urllib.parse import urljoin, urlparse
+
+from bs4 import BeautifulSoup, CData, NavigableString, Tag
+
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:  # BeautifulSoup's html.parser is always available
+    lxml_html = None
+
+logger = logging.getLogger(__name__)
+
+# "auto" uses lxml when installed; "soup" forces the BeautifulSoup path
+HTML_EXTRACTOR = os.getenv("HTML_EXTRACTOR", "auto")
+
+HEADING_TAGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+INVISIBLE_TAGS = frozenset(["script", "style"])
+# Elements that start a new line of page text, so repeated blocks can be recognised
+BLOCK_TAGS = frozenset("""
+address article aside blockquote body br dd details div dl dt fieldset figcaption
+figure footer form h1 h2 h3 h4 h5 h6 head header hr html li main nav ol p pre
+section summary table td th title tr ul
+""".split())
+
+# Pushed on the soup walk's stack to mark where a block element closes
+_BLOCK_END = object()
+
+
+def empty_headings():
+    return {tag: [] for tag in HEADING_TAGS}
+
+
+class TextBlocks:
+    """Accumulates stripped text strings, one line per block element."""
+
+    def __init__(self):
+        self.blocks = []
+        self.current = []
+
+    def add(self, value):
+        value = value.strip()
+        if value:
+            self.current.append(value)
+
+    def flush(self):
+        if self.current:
+            self.blocks.append(" ".join(self.current))
+            self.current = []
+
+    def text(self):
+        self.flush()
+        return "\n".join(self.blocks)
+
+
+class SoupExtractor:
+    """The original extraction path: BeautifulSoup with ``html.parser``.
+
+    Walks the tree once per field; kept as the fallback and as the
+    reference output for the fast extractor.
+    """
+
+    name = "soup"
+
+    def extract(self, html, url, base_url):
+        soup = BeautifulSoup(html, "html.parser")
+        return {
+            "url": url,
+            "title": soup.title.string if soup.title else "No Title",
+            "meta": self.get_all_meta(soup),
+            "headings": self.get_all_headings(soup),
+            "links": self.get_all_links(soup, url, base_url),
+            "images": self.get_all_images(soup, base_url),
+            "text": self.get_all_text(soup),
+        }
+
+    def get_all_meta(self, soup):
+        meta_data = {}
+        for tag in soup.find_all("meta"):
+            if tag.get("name"):
+                meta_data[tag.get("name")] = tag.get("content", "")
+            elif tag.get("property"):
+                meta_data[tag.get("property")] = tag.get("content", "")
+        return meta_data
+
+    def get_all_headings(self, soup):
+        headings = {}
+        for tag in HEADING_TAGS:
+            headings[tag] = [h.get_text(strip=True) for h in soup.find_all(tag)]
+        return headings
+
+    def get_all_links(self, soup, page_url, base_url):
+        links = []
+        for link in soup.find_all("a", href=True):
+            full_url = urljoin(page_url, link["href"])
+            if urlparse(full_url).netloc == urlparse(base_url).netloc:  # Compare against base_url
+                links.append({
+                    "text": link.get_text(strip=True),
+                    "url": full_url
+                })
+        return links
+
+    def get_all_images(self, soup, base_url):
+        images = []
+        for img in soup.find_all("img", src=True):
+            images.append({
+                "src": urljoin(base_url, img["src"]),  # Ensure absolute URL for images
+                "alt": img.get("alt", "No alt text")
+            })
+        return images
+
+    def get_all_text(self, soup):
+        text = TextBlocks()
+        stack = [soup]
+        while stack:
+            node = stack.pop()
+            if node is _BLOCK_END:
+                text.flush()
+            elif isinstance(node, Tag):
+                if node.name in INVISIBLE_TAGS:
+                    continue
+                if node.name in BLOCK_TAGS:
+                    text.flush()
+                    stack.append(_BLOCK_END)
+                stack.extend(reversed(node.contents))
+            elif type(node) in (NavigableString, CData):  # not comments or doctypes
+                text.add(node)
+        return text.text()
+
+
+class LxmlExtractor:
+    """Collects every page field in a single walk over an lxml tree.
+
+    Produces the same ``page_data`` shape as ``SoupExtractor``; documents
+    lxml cannot parse are handed to the soup path.
+    """
+
+    name = "lxml"
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or SoupExtractor()
+
+    def extract(self, html, url, base_url):
+        try:
+            # lxml rejects str input that carries an XML encoding declaration
+            root = lxml_html.fromstring(html.encode("utf-8") if isinstance(html, str) else html)
+        except (etree.ParserError, ValueError) as e:
+            logger.debug(f"lxml could not parse {url} ({e}); using BeautifulSoup")
+            return self.fallback.extract(html, url, base_url)
+
+        base_netloc = urlparse(base_url).netloc
+        title = "No Title"
+        has_title = False
+        meta = {}
+        headings = empty_headings()
+        links = []
+        images = []
+        text = TextBlocks()
+        hidden = 0
+
+        for event, element in etree.iterwalk(root, events=("start", "end", "comment", "pi")):
+            tag = element.tag
+            if event in ("comment", "pi"):
+                # Only their tail is page text
+                if element.tail and not hidden:
+                    text.add(element.tail)
+                continue
+            if event == "end":
+                if tag in INVISIBLE_TAGS:
+                    hidden -= 1
+                if tag in BLOCK_TAGS:
+                    text.flush()
+                if element.tail and not hidden:
+                    text.add(element.tail)
+                continue
+
+            if tag in INVISIBLE_TAGS:
+                hidden += 1
+                continue
+            if tag in BLOCK_TAGS:
+                text.flush()
+            if element.text and not hidden:
+                text.add(element.text)
+
+            if tag == "title" and not has_title:
+                # Matches BeautifulSoup's ``title.string``, which is None for an empty title
+                title, has_title = element.text, True
+            elif tag == "meta":
+                key = element.get("name") or element.get("property")
+                if key:
+                    meta[key] = element.get("content", "")
+            elif tag in headings:
+                headings[tag].append(self._stripped_text(element))
+            elif tag == "a":
+                href = element.get("href")
+                if href is not None:
+                    full_url = urljoin(url, href)
+                    if urlparse(full_url).netloc == base_netloc:
+                        links.append({"text": self._stripped_text(element), "url": full_url})
+            elif tag == "img":
+                src = element.get("src")
+                if src is not None:
+                    images.append({"src": urljoin(base_url, src), "alt": element.get("alt", "No alt text")})
+
+        return {
+            "url": url,
+            "title": title,
+            "meta": meta,
+            "headings": headings,
+            "links": links,
+            "images": images,
+            "text": text.text(),
+        }
+
+    @staticmethod
+    def _stripped_text(element):
+        """Text of ``element`` like soup's ``get_text(strip=True)``: no script, style or comment text."""
+        parts = []
+        stack = [element]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str):
+                parts.append(node.strip())
+                continue
+            if node.text and isinstance(node.tag, str):
+                parts.append(node.text.strip())
+            for child in reversed(node):
+                # Pushed first, so a child's tail follows its own text
+                if child.tail:
+                    stack.append(child.tail)
+                if isinstance(child.tag, str) and child.tag not in INVISIBLE_TAGS:
+                    stack.append(child)
+        return "".join(parts)
+
+
+def get_extractor(name=HTML_EXTRACTOR):
+    """Return the extractor for ``name``, falling back to BeautifulSoup without lxml."""
+    if name == "soup":
+        return SoupExtractor()
+    if lxml_html is None:
+        if name == "lxml":
+            logger.warning("lxml is not installed; using the BeautifulSoup extractor")
+        return SoupExtractor()
+    return LxmlExtractor()
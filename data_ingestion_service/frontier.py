@@ -0,0 +1,190 @@
+import asyncio
+import gzip
+import itertools
+import logging
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+CRAWL_RESPECT_ROBOTS = os.getenv("CRAWL_RESPECT_ROBOTS", "1") == "1"
+CRAWL_USE_SITEMAP = os.getenv("CRAWL_USE_SITEMAP", "1") == "1"
+CRAWL_MAX_SITEMAPS = int(os.getenv("CRAWL_MAX_SITEMAPS", "10"))
+# Longer Crawl-delay values are clamped so one site can't stall a worker for minutes
+CRAWL_MAX_CRAWL_DELAY = float(os.getenv("CRAWL_MAX_CRAWL_DELAY", "10"))
+
+DEFAULT_PRIORITY = 0.5
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+TRACKING_PARAMS = frozenset([
+    "gclid", "dclid", "fbclid", "msclkid", "yclid", "igshid",
+    "mc_cid", "mc_eid", "_ga", "_gl", "ref_src",
+])
+TRACKING_PREFIXES = ("utm_",)
+
+# Links to these are never HTML, so don't spend a fetch finding that out
+SKIPPED_EXTENSIONS = frozenset("""
+7z avi css csv doc docx exe gif gz ico jpeg jpg js json m4a mov mp3 mp4 pdf png ppt
+pptx rar svg tar tgz tif tiff wav webm webp woff woff2 xls xlsx zip
+""".split())
+
+MULTIPLE_SLASHES_RE = re.compile(r"/{2,}")
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def canonicalize_url(url):
+    """Normalize a URL so trivially different spellings of a page compare equal.
+
+    Lowercases scheme and host, drops default ports, fragments, tracking
+    parameters and trailing slashes, and sorts the remaining query
+    parameters. Returns None for URLs that can't be parsed.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else f"{host}:{port}"
+
+    path = MULTIPLE_SLASHES_RE.sub("/", parts.path) or "/"
+    if len(path) > 1:
+        path = path.rstrip("/") or "/"
+    query = urlencode(sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not is_tracking_param(name)
+    ))
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+async def load_robots(client, root_url):
+    """Fetch and parse the site's robots.txt; None when there isn't a usable one."""
+    robots_url = urljoin(root_url, "/robots.txt")
+    try:
+        response = await client.get(robots_url)
+    except httpx.HTTPError as e:
+        logger.warning(f"Could not fetch {robots_url}: {str(e)}")
+        return None
+    if response.status_code != 200:
+        return None
+    robots = RobotFileParser(robots_url)
+    robots.parse(response.text.splitlines())
+    return robots
+
+
+async def load_sitemap(client, root_url, robots=None, max_sitemaps=CRAWL_MAX_SITEMAPS):
+    """Return ``{url: priority}`` from the site's sitemaps, following sitemap indexes."""
+    pending = list((robots.site_maps() if robots else None) or [urljoin(root_url, "/sitemap.xml")])
+    seen = set()
+    priorities = {}
+    while pending and len(seen) < max_sitemaps:
+        sitemap_url = pending.pop(0)
+        if sitemap_url in seen:
+            continue
+        seen.add(sitemap_url)
+        try:
+            response = await client.get(sitemap_url)
+            if response.status_code != 200:
+                continue
+            body = response.content
+            if body[:2] == b"\x1f\x8b":
+                body = gzip.decompress(body)
+            root = ElementTree.fromstring(body)
+        except (httpx.HTTPError, ElementTree.ParseError, OSError) as e:
+            logger.warning(f"Could not read sitemap {sitemap_url}: {str(e)}")
+            continue
+
+        for entry in root:
+            fields = {child.tag.rsplit("}", 1)[-1]: (child.text or "").strip() for child in entry}
+            if not fields.get("loc"):
+                continue
+            if entry.tag.endswith("sitemap"):
+                pending.append(fields["loc"])
+            else:
+                try:
+                    priority = float(fields.get("priority") or DEFAULT_PRIORITY)
+                except ValueError:
+                    priority = DEFAULT_PRIORITY
+                priorities[fields["loc"]] = priority
+    return priorities
+
+
+class Frontier:
+    """Deduplicated, prioritized queue of URLs still to crawl.
+
+    URLs are canonicalized before the seen check and restricted to the
+    root's host, robots.txt rules and ``max_pages``. Shallower URLs come
+    first; within a depth, higher sitemap priority wins.
+    """
+
+    def __init__(self, root_url, max_pages, user_agent, robots=None, priorities=None):
+        self.host = urlsplit(root_url).netloc
+        self.max_pages = max_pages
+        self.user_agent = user_agent
+        self.robots = robots
+        self.priorities = {}
+        self.seen = set()
+        self.skipped = 0
+        self.truncated = False
+        self._queue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        for url, priority in (priorities or {}).items():
+            url = canonicalize_url(url)
+            if url:
+                self.priorities[url] = priority
+
+    @property
+    def crawl_delay(self):
+        delay = self.robots.crawl_delay(self.user_agent) if self.robots else None
+        return min(float(delay), CRAWL_MAX_CRAWL_DELAY) if delay else 0.0
+
+    def allowed(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in DEFAULT_PORTS or parts.netloc != self.host:
+            return False
+        name = parts.path.rsplit("/", 1)[-1]
+        if "." in name and name.rsplit(".", 1)[-1].lower() in SKIPPED_EXTENSIONS:
+            return False
+        return self.robots is None or self.robots.can_fetch(self.user_agent, url)
+
+    def add(self, url, depth, parent=None):
+        """Queue ``url`` unless it was already seen or isn't allowed; returns its canonical form or None."""
+        url = canonicalize_url(url)
+        if url is None or url in self.seen:
+            return None
+        if not self.allowed(url):
+            self.skipped += 1
+            return None
+        if len(self.seen) >= self.max_pages:
+            # The crawl no longer reaches every page, which refreshes need to know
+            self.truncated = True
+            return None
+        self.seen.add(url)
+        self._push(url, depth, self.priorities.get(url, DEFAULT_PRIORITY), parent)
+        return url
+
+    def _push(self, url, depth, priority, parent):
+        self._queue.put_nowait((depth, -priority, next(self._order), url))
+
+    async def get(self):
+        depth, _, _, url = await self._queue.get()
+        return url, depth
+
+    def task_done(self):
+        self._queue.task_done()
+
+    async def join(self):
+        await self._queue.join()
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SCRAPE_WORKERS = int(os.getenv("SCRAPE_WORKERS", "4"))
+# Finished jobs (and their results) are kept this long for polling
+SCRAPE_JOB_TTL = int(os.getenv("SCRAPE_JOB_TTL", "3600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = {COMPLETED, FAILED, CANCELLED}
+
+
+class ScrapeJob:
+    """State and progress of one background scrape.
+
+    Jobs with a ``chatbot_id`` incrementally refresh that chatbot's pages and
+    their result is the refresh report rather than the crawl tree. Jobs with
+    a ``crawl_id`` checkpoint their crawl under it; ``helper`` jobs only
+    fetch from that crawl's frontier and report, leaving the assembling and
+    storing to the job that owns it. ``streamed`` jobs stored their pages
+    as the crawl went; their result is a storage report, not the tree.
+    """
+
+    def __init__(self, user_id, website_url, chatbot_id=None, crawl_id=None, helper=False):
+        self.job_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.website_url = website_url
+        self.chatbot_id = chatbot_id
+        self.crawl_id = crawl_id
+        self.helper = helper
+        self.streamed = False
+        self.status = QUEUED
+        self.pages_fetched = 0
+        self.bytes_fetched = 0
+        self.errors = 0
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def update_progress(self, pages_fetched, bytes_fetched, errors):
+        self.pages_fetched = pages_fetched
+        self.bytes_fetched = bytes_fetched
+        self.errors = errors
+
+    def to_dict(self, include_result=False):
+        job = {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "website_url": self.website_url,
+            "chatbot_id": self.chatbot_id,
+            "crawl_id": self.crawl_id,
+            "status": self.status,
+            "progress": {
+                "pages_fetched": self.pages_fetched,
+                "bytes_fetched": self.bytes_fetched,
+                "errors": self.errors,
+            },
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if include_result and self.status == COMPLETED:
+            job["report" if self.chatbot_id or self.helper or self.streamed else "scraped_data"] = self.result
+        return job
+
+
+class ScrapeJobManager:
+    """Runs scrape jobs on a thread pool and tracks them for polling.
+
+    Each worker thread drives the async crawl on its own event loop, so the
+    service's event loop only ever enqueues jobs and reports on them. Job
+    state is per process; polling must reach the worker that accepted it.
+    """
+
+    def __init__(self, scraper_factory, max_workers=SCRAPE_WORKERS, job_ttl=SCRAPE_JOB_TTL):
+        self.scraper_factory = scraper_factory
+        self.job_ttl = job_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scrape")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, website_url, chatbot_id=None, crawl_id=None, helper=False):
+        job = ScrapeJob(user_id, website_url, chatbot_id, crawl_id, helper)
+        with self._lock:
+            self._prune()
+            self._jobs[job.job_id] = job
+        self._executor.submit(self._run, job)
+        logger.info(f"Queued scrape job {job.job_id} for {website_url}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        if job.status == QUEUED:
+            self._finish(job, CANCELLED)
+        return job
+
+    def shutdown(self):
+        with self._lock:
+            for job in self._jobs.values():
+                job.cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job):
+        if job.cancel_event.is_set():
+            return
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            scraper = self.scraper_factory(
+                job.website_url,
+                job.user_id,
+                progress_callback=job.update_progress,
+                cancel_event=job.cancel_event,
+            )
+            if job.chatbot_id:
+                result = asyncio.run(scraper.refresh(job.chatbot_id))
+            elif job.helper:
+                result = asyncio.run(scraper.help_crawl(job.crawl_id))
+            elif job.crawl_id and scraper.streams_pages:
+                job.streamed = True
+                result = asyncio.run(scraper.ingest(job.crawl_id))
+            else:
+                result = asyncio.run(scraper.crawl(job.crawl_id))
+            if job.cancel_event.is_set():
+                self._finish(job, CANCELLED)
+                return
+            if not result:
+                job.error = "Failed to scrape the website"
+                self._finish(job, FAILED)
+                return
+            if not job.chatbot_id and not job.helper and not job.streamed:
+                scraper.store_data(result)
+                if job.crawl_id:
+                    scraper.finish_crawl(job.crawl_id)
+            job.result = result
+            self._finish(job, COMPLETED)
+        except Exception as e:
+            logger.error(f"Scrape job {job.job_id} failed: {str(e)}")
+            job.error = str(e)
+            self._finish(job, FAILED)
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished_at = time.time()
+        logger.info(f"Scrape job {job.job_id} {status}")
+
+    def _prune(self):
+        cutoff = time.time() - self.job_ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -1,22 +1,54 @@
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+import asyncio
+import datetime
+import logging
 import os
 import sys
-from pymongo import MongoClient
+
+if __name__ == "__main__":
+    # Parse pool workers are spawned, and spawned processes re-run the __main__ script before
+    # anything else. Serving through uvicorn's own entry point leaves them nothing of the
+    # service to re-run, so they only import what parsing needs.
+    service_dir = os.path.dirname(os.path.abspath(__file__))
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--app-dir", service_dir, "--host", "0.0.0.0", "--port", "8002",
+    ])
+
+import httpx
 from bson import ObjectId
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-# MongoDB Connection
-MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-client = MongoClient(MONGODB_URI)
-db = client["chatbot_db"]
-knowledge_collection = db["knowledge"]
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from starlette.concurrency import run_in_threadpool
+
+from boilerplate import NearDuplicateIndex, clean_tree, find_boilerplate, simhash, strip_boilerplate
+from checkpoint import CRAWL_CHECKPOINTS, CRAWL_LEASE_SECONDS, COMPLETED, RUNNING, CrawlCheckpoint, new_crawl_id
+from crawler import CrawlEngine, fetch_validators
+from extraction import get_extractor
+from frontier import canonicalize_url
+from jobs import ScrapeJobManager
+from parse_pool import CRAWL_PARSE_PROCESSES, ParsePool
+# Scrape jobs store results from worker threads, so they use the synchronous client
+from shared.database import ensure_indexes, get_chatbot, knowledge_collection, retrieval_index_collection
+from shared.page_store import page_store
+from shared.retrieval import INDEX_VERSION, index_pages, update_index
+from shared.metrics import install as install_metrics
+
+logger = logging.getLogger(__name__)
+
+# Told to drop its cached knowledge when a refresh changes a chatbot's index
+CHAT_SERVICE_URL = os.getenv("CHAT_SERVICE_URL", "http://localhost:8003")
+
+# Status codes that mean a previously crawled page is gone
+REMOVED_STATUS_CODES = {404, 410}
 
 # Define FastAPI app
 app = FastAPI()
+install_metrics(app, "data_ingestion_service")
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,121 +62,382 @@ class ScrapeRequest(BaseModel):
     user_id: str
     website_url: str
 
-@app.post("/scrape")
+# Set, scrapes parse pages in worker processes and stream checkpointed crawls into storage
+parse_pool = ParsePool() if CRAWL_PARSE_PROCESSES else None
+
+def create_scraper(website_url, user_id, **crawl_options):
+    return WebScraper(base_url=website_url, user_id=user_id, parse_pool=parse_pool, **crawl_options)
+
+scrape_jobs = ScrapeJobManager(create_scraper)
+
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes()
+
+@app.on_event("shutdown")
+def shutdown_scrape_jobs():
+    # Cancelled checkpointed crawls hand their leases back and can be resumed
+    scrape_jobs.shutdown()
+    if parse_pool is not None:
+        parse_pool.shutdown()
+
+@app.post("/scrape", status_code=202)
 async def scrape_website(request: ScrapeRequest):
-    """Endpoint to scrape a website and store the data."""
-    scraper = WebScraper(base_url=request.website_url, user_id=request.user_id)
-    scraped_data = scraper.scrape_site()
+    """Queue a background scrape of the website and return its job id."""
+    crawl_id = new_crawl_id() if CRAWL_CHECKPOINTS else None
+    job = scrape_jobs.submit(request.user_id, request.website_url, crawl_id=crawl_id)
+    return {"message": "Scrape job queued", "job_id": job.job_id, "crawl_id": crawl_id, "status": job.status}
 
-    if not scraped_data:
-        raise HTTPException(status_code=500, detail="Failed to scrape the website")
+@app.get("/scrape/{job_id}")
+async def get_scrape_job(job_id: str):
+    """Report a scrape job's progress, including the scraped data once completed."""
+    job = scrape_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Scrape job not found")
+    return job.to_dict(include_result=True)
 
-    return {"message": "Website scraped successfully", "scraped_data": scraped_data}
+@app.post("/refresh/{chatbot_id}", status_code=202)
+async def refresh_chatbot(chatbot_id: str):
+    """Queue an incremental re-crawl of a chatbot's website."""
+    if not ObjectId.is_valid(chatbot_id):
+        raise HTTPException(status_code=400, detail="Invalid chatbot ID format")
+    chatbot = await get_chatbot(chatbot_id, {"user_id": 1, "website_url": 1, "web_url": 1})
+    if not chatbot:
+        raise HTTPException(status_code=404, detail="Chatbot not found")
+    website_url = chatbot.get("website_url") or chatbot.get("web_url")
+    job = scrape_jobs.submit(chatbot.get("user_id"), website_url, chatbot_id=chatbot_id)
+    return {"message": "Refresh job queued", "job_id": job.job_id, "status": job.status}
+
+async def load_crawl(crawl_id):
+    crawl = await run_in_threadpool(CrawlCheckpoint(crawl_id).status)
+    if not crawl:
+        raise HTTPException(status_code=404, detail="Crawl not found")
+    return crawl
+
+@app.get("/crawls/{crawl_id}")
+async def get_crawl(crawl_id: str):
+    """Report a checkpointed crawl's status and how much of its frontier is done."""
+    return await load_crawl(crawl_id)
+
+@app.post("/crawls/{crawl_id}/resume", status_code=202)
+async def resume_crawl(crawl_id: str):
+    """Queue a job that continues an interrupted crawl from its last checkpoint and stores it."""
+    crawl = await load_crawl(crawl_id)
+    if crawl["status"] == COMPLETED:
+        raise HTTPException(status_code=409, detail="Crawl already completed")
+    idle = (datetime.datetime.utcnow() - crawl["updated_at"]).total_seconds()
+    if crawl["status"] == RUNNING and idle < CRAWL_LEASE_SECONDS:
+        raise HTTPException(status_code=409, detail="Crawl is still running; add workers instead")
+    job = scrape_jobs.submit(crawl["user_id"], crawl["root_url"], crawl_id=crawl_id)
+    return {"message": "Resume job queued", "job_id": job.job_id, "crawl_id": crawl_id, "status": job.status}
+
+@app.post("/crawls/{crawl_id}/workers", status_code=202)
+async def add_crawl_worker(crawl_id: str):
+    """Queue a job that fetches from a running crawl's frontier alongside its other workers."""
+    crawl = await load_crawl(crawl_id)
+    if crawl["status"] != RUNNING:
+        raise HTTPException(status_code=409, detail=f"Crawl is {crawl['status']}")
+    job = scrape_jobs.submit(crawl["user_id"], crawl["root_url"], crawl_id=crawl_id, helper=True)
+    return {"message": "Crawl worker queued", "job_id": job.job_id, "crawl_id": crawl_id, "status": job.status}
+
+@app.post("/scrape/{job_id}/cancel")
+async def cancel_scrape_job(job_id: str):
+    """Cancel a queued or running scrape job."""
+    job = scrape_jobs.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Scrape job not found")
+    return job.to_dict()
 
 class WebScraper:
-    def __init__(self, base_url, max_depth=2, user_id=None):
-        self.base_url = base_url
+    def __init__(self, base_url, max_depth=2, user_id=None, extractor=None, parse_pool=None, **crawl_options):
+        # Page URLs are stored canonicalized, so the root has to match them
+        self.base_url = canonicalize_url(base_url) or base_url
         self.max_depth = max_depth
         self.visited_urls = set()
+        # Validators of the last crawl's pages, stored with them so the first refresh can skip unchanged ones
+        self.fetch_info = {}
         self.user_id = user_id
+        self.extractor = extractor or get_extractor()
+        self.parse_pool = parse_pool
+        self.crawl_options = crawl_options
+
+    @property
+    def streams_pages(self):
+        """Whether checkpointed scrapes go through ``ingest`` rather than ``crawl`` and ``store_data``."""
+        return self.parse_pool is not None
+
+    def create_engine(self, **options):
+        return CrawlEngine(
+            self.base_url,
+            self.extract_page,
+            max_depth=self.max_depth,
+            parse_document=self.parse_in_pool if self.parse_pool else None,
+            **options,
+            **self.crawl_options
+        )
 
     def scrape_site(self):
         """Start scraping from the base URL."""
-        scraped_data = self.scrape_page(self.base_url, 0)
+        return asyncio.run(self.scrape_site_async())
+
+    async def scrape_site_async(self):
+        """Crawl the site breadth-first and store the resulting page tree."""
+        scraped_data = await self.crawl()
         if scraped_data:
             self.store_data(scraped_data)
         return scraped_data
 
-    def scrape_page(self, url, depth):
-        """Recursively scrape a page and follow links up to the specified depth."""
-        if depth > self.max_depth or url in self.visited_urls:
+    async def crawl(self, crawl_id=None):
+        """Run the concurrent crawl engine and return the root page_data.
+
+        With a ``crawl_id`` the crawl is checkpointed under that id and
+        continues from any earlier checkpoint of it.
+        """
+        engine = self.create_engine(
+            checkpoint=CrawlCheckpoint(crawl_id, user_id=self.user_id) if crawl_id else None,
+        )
+        scraped_data = await engine.crawl()
+        self.visited_urls = engine.visited_urls
+        self.fetch_info = {url: fetch_validators(info) for url, info in engine.fetch_info.items()}
+        if scraped_data:
+            # Drop nav/footer text repeated across the site and near-duplicate pages before anything stores them
+            boilerplate, duplicates = clean_tree(scraped_data)
+            scraped_data["boilerplate_blocks"] = sorted(boilerplate)
+            if duplicates:
+                logger.info(f"Dropped {len(duplicates)} near-duplicate pages.")
+        return scraped_data
+
+    async def help_crawl(self, crawl_id):
+        """Fetch pages from another job's checkpointed crawl until its frontier is empty."""
+        engine = self.create_engine(checkpoint=CrawlCheckpoint(crawl_id, owner=False))
+        await engine.crawl()
+        self.visited_urls = engine.visited_urls
+        if engine.cancelled:
             return None
+        # Totals for the whole crawl, not just this worker
+        crawl = await asyncio.to_thread(engine.checkpoint.load)
+        return {"crawl_id": crawl_id, "pages_fetched": crawl["pages_fetched"], "bytes_fetched": crawl["bytes_fetched"]}
 
-        self.visited_urls.add(url)
-        print(f"Scraping: {url} at depth {depth}")
+    async def ingest(self, crawl_id):
+        """Checkpointed crawl whose pages are stored one at a time, never as one tree.
 
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Scrape main content
-            page_data = {
-                "url": url,
-                "title": soup.title.string if soup.title else "No Title",
-                "meta": self.get_all_meta(soup),
-                "headings": self.get_all_headings(soup),
-                "links": [],
-                "images": self.get_all_images(soup),
-                "text": self.get_all_text(soup)
-            }
-
-            # Process all links and recursively scrape
-            links = self.get_all_links(soup, url)
-            for link in links:
-                page_data["links"].append(link)
-                link_url = link['url']
-                if link_url not in self.visited_urls:
-                    child_data = self.scrape_page(link_url, depth + 1)
-                    if child_data:
-                        page_data.setdefault("child_pages", []).append(child_data)
-
-            return page_data
-        except requests.exceptions.RequestException as e:
-            print(f"Error while scraping {url}: {e}")
+        Fetching and parsing overlap (pages are parsed in ``parse_pool``) and
+        finished pages go to the checkpoint in batches as they complete; the
+        boilerplate and near-duplicate passes then stream them from there
+        into the page store. Returns a storage report, or None if cancelled.
+        """
+        engine = self.create_engine(
+            checkpoint=CrawlCheckpoint(crawl_id, user_id=self.user_id),
+            assemble_tree=False,
+        )
+        await engine.crawl()
+        self.visited_urls = engine.visited_urls
+        if engine.cancelled:
+            return None
+        report = await asyncio.to_thread(self.store_crawl, crawl_id)
+        if report is None:
+            raise RuntimeError(f"Failed to fetch {self.base_url}")
+        report.update(pages_fetched=engine.pages_fetched, bytes_fetched=engine.bytes_fetched)
+        self.finish_crawl(crawl_id)
+        return report
+
+    def finish_crawl(self, crawl_id):
+        """Mark a stored crawl completed and drop its checkpoint."""
+        CrawlCheckpoint(crawl_id).complete()
+
+    async def refresh(self, chatbot_id):
+        """Re-crawl a chatbot's site, re-parsing and re-indexing only what changed.
+
+        Stored ETag/Last-Modified validators make unchanged pages cheap 304s,
+        and pages whose body hash matches are not parsed again. Returns a
+        report of added, changed and removed URLs, or None if cancelled.
+        """
+        known_pages = {
+            record["url"]: record
+            for record in page_store.iter_pages(chatbot_id, include_text=False)
+        }
+        engine = self.create_engine(known_pages=known_pages)
+        await engine.crawl()
+        self.visited_urls = engine.visited_urls
+        if engine.cancelled:
             return None
+        if self.base_url not in engine.pages:
+            raise RuntimeError(f"Failed to fetch {self.base_url}")
+        return self.apply_refresh(chatbot_id, engine, known_pages)
+
+    def refresh_boilerplate(self, engine, known_pages):
+        """Boilerplate hashes learned at the original scrape, kept on the root page record."""
+        stored = known_pages.get(self.base_url, {}).get("boilerplate_blocks")
+        if stored is not None:
+            return set(stored)
+        if engine.unchanged_urls:
+            return set()
+        # Nothing stored and every page was parsed again, so learn it now
+        return find_boilerplate(page.get("text") or "" for page in engine.pages.values())
+
+    def apply_refresh(self, chatbot_id, engine, known_pages):
+        """Store the pages a refresh crawl found and update the chatbot's index."""
+        boilerplate = self.refresh_boilerplate(engine, known_pages)
+        near_duplicates = NearDuplicateIndex()
+        for url in engine.unchanged_urls:
+            if known_pages[url].get("simhash"):
+                near_duplicates.add(url, int(known_pages[url]["simhash"], 16))
+
+        added, changed, unchanged, reparsed, duplicates = [], [], 0, [], []
+        for url, page in engine.pages.items():
+            validators = fetch_validators(engine.fetch_info.get(url))
+            known = known_pages.get(url)
+            if url in engine.unchanged_urls:
+                unchanged += 1
+                if any(known.get(field) != value for field, value in validators.items()):
+                    page_store.update_page(chatbot_id, url, **validators)
+                continue
+
+            page["text"] = strip_boilerplate(page.get("text") or "", boilerplate)
+            fingerprint = simhash(page["text"])
+            if url != self.base_url and page["text"] and near_duplicates.find(fingerprint) is not None:
+                duplicates.append(url)
+                continue
+            near_duplicates.add(url, fingerprint)
+            page["simhash"] = format(fingerprint, "016x")
+            if url == self.base_url:
+                page["boilerplate_blocks"] = sorted(boilerplate)
+
+            record = page_store.save_page(chatbot_id, page, engine.parents.get(url), engine.depths.get(url, 0), **validators)
+            if known is None:
+                added.append(url)
+            elif known.get("content_hash") != record["content_hash"]:
+                changed.append(url)
+            else:
+                # The markup changed but the extracted text did not
+                unchanged += 1
+                continue
+            reparsed.append(page)
+
+        removed = [
+            url for url, status in engine.failed_urls.items()
+            if url in known_pages and status in REMOVED_STATUS_CODES
+        ]
+        removed += [url for url in duplicates if url in known_pages]
+        # Pages no longer linked from the site are only known to be gone if the crawl ran to completion
+        if not engine.truncated:
+            removed += [url for url in known_pages if url not in engine.visited_urls]
+        for url in removed:
+            page_store.delete_page(chatbot_id, url)
+
+        stale_urls = set(added) | set(changed) | set(removed)
+        if stale_urls:
+            # A missing index is rebuilt from the stored pages by the chat service on first use
+            index_doc = retrieval_index_collection.find_one({"_id": ObjectId(chatbot_id)})
+            if index_doc is not None:
+                if index_doc.get("version") == INDEX_VERSION:
+                    index_doc = update_index(index_doc, reparsed, stale_urls)
+                else:
+                    # Chunks in an older layout can't be reused; rebuild from the stored pages
+                    index_doc = index_pages(page_store.iter_pages(chatbot_id))
+                index_doc["_id"] = ObjectId(chatbot_id)
+                retrieval_index_collection.replace_one({"_id": index_doc["_id"]}, index_doc, upsert=True)
+
+        page_count = len(known_pages) + len(added) - len(removed)
+        knowledge_collection.update_one(
+            {"_id": ObjectId(chatbot_id)},
+            {
+                "$set": {"storage": "pages", "page_count": page_count, "refreshed_at": datetime.datetime.utcnow()},
+                "$unset": {"scraped_data": ""},
+            },
+        )
+        if stale_urls:
+            self.invalidate_chat_cache(chatbot_id)
+
+        logger.info(f"Refreshed {chatbot_id}: {len(added)} added, {len(changed)} changed, {len(removed)} removed.")
+        return {
+            "chatbot_id": chatbot_id,
+            "added": added,
+            "changed": changed,
+            "removed": removed,
+            "unchanged": unchanged,
+            "duplicates": duplicates,
+            "skipped_parsing": len(engine.unchanged_urls),
+            "failed": [url for url in engine.failed_urls if url not in removed],
+            "pages_fetched": engine.pages_fetched,
+            "bytes_fetched": engine.bytes_fetched,
+            "truncated": engine.truncated,
+        }
+
+    def invalidate_chat_cache(self, chatbot_id):
+        try:
+            httpx.post(f"{CHAT_SERVICE_URL}/cache/invalidate/{chatbot_id}", timeout=5)
+        except httpx.HTTPError as e:
+            # Cached answers are keyed by index fingerprint, so they go stale on their own
+            logger.warning(f"Could not invalidate chat cache for {chatbot_id}: {str(e)}")
+
+    def extract_page(self, html, url):
+        """Parse a fetched page into the page_data shape."""
+        logger.info(f"Scraping: {url}")
+        return self.extractor.extract(html, url, self.base_url)
+
+    async def parse_in_pool(self, body, encoding, url):
+        logger.info(f"Scraping: {url}")
+        return await self.parse_pool.extract(self.extractor.name, body, encoding, url, self.base_url)
 
     def store_data(self, scraped_data):
-        """Store the scraped data in the knowledge collection."""
+        """Store the crawl as one knowledge entry plus one compressed record per page."""
         knowledge_entry = {
             "user_id": self.user_id,
             "web_url": self.base_url,
-            "scraped_data": scraped_data
+            "storage": "pages"
         }
-        knowledge_collection.insert_one(knowledge_entry)
-        print("Scraped data stored successfully.")
-
-    def get_all_meta(self, soup):
-        meta_data = {}
-        for tag in soup.find_all("meta"):
-            if tag.get("name"):
-                meta_data[tag.get("name")] = tag.get("content", "")
-            elif tag.get("property"):
-                meta_data[tag.get("property")] = tag.get("content", "")
-        return meta_data
-
-    def get_all_headings(self, soup):
-        headings = {}
-        for level in range(1, 7):
-            tag = f"h{level}"
-            headings[tag] = [h.get_text(strip=True) for h in soup.find_all(tag)]
-        return headings
-
-    def get_all_links(self, soup, base_url):
-        links = []
-        for link in soup.find_all("a", href=True):
-            full_url = urljoin(base_url, link["href"])
-            if urlparse(full_url).netloc == urlparse(self.base_url).netloc:  # Compare against base_url
-                links.append({
-                    "text": link.get_text(strip=True),
-                    "url": full_url
-                })
-        return links
-
-    def get_all_images(self, soup):
-        images = []
-        for img in soup.find_all("img", src=True):
-            images.append({
-                "src": urljoin(self.base_url, img["src"]),  # Ensure absolute URL for images
-                "alt": img.get("alt", "No alt text")
-            })
-        return images
-
-    def get_all_text(self, soup):
-        for script_or_style in soup(["script", "style"]):
-            script_or_style.decompose()
-        return " ".join(soup.stripped_strings)
+        result = knowledge_collection.insert_one(knowledge_entry)
+        page_count = page_store.save_tree(result.inserted_id, scraped_data, self.fetch_info)
+        knowledge_collection.update_one({"_id": result.inserted_id}, {"$set": {"page_count": page_count}})
+        logger.info(f"Scraped data stored successfully ({page_count} pages).")
 
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8002)
+    def store_crawl(self, crawl_id):
+        """Store a checkpointed crawl page by page, as ``clean_tree`` and ``store_data`` would.
+
+        Two passes over the stored pages: one learns the boilerplate, the
+        other strips it, drops near-duplicates (moving their children up to
+        their parent) and saves each page. Returns None if the root page
+        was never fetched.
+        """
+        checkpoint = CrawlCheckpoint(crawl_id)
+        boilerplate = find_boilerplate(
+            page.get("text") or "" for _, page, _, _, _ in checkpoint.load_pages() if page is not None
+        )
+        chatbot_id = None
+        near_duplicates = NearDuplicateIndex()
+        # Stored depth of each saved page; a dropped duplicate maps to the parent that adopts its children
+        depths = {}
+        adopted_by = {}
+        duplicates = []
+        for url, page, parent, _, fetch_info in checkpoint.load_pages():
+            parent = adopted_by.get(parent, parent)
+            # Pages under a page that failed aren't part of the tree either
+            if page is None or (parent is not None and parent not in depths):
+                continue
+            if parent is None and url != self.base_url:
+                continue
+            page["text"] = strip_boilerplate(page.get("text") or "", boilerplate)
+            fingerprint = simhash(page["text"])
+            if parent is not None and page["text"] and near_duplicates.find(fingerprint) is not None:
+                adopted_by[url] = parent
+                duplicates.append(url)
+                continue
+            near_duplicates.add(url, fingerprint)
+            page["simhash"] = format(fingerprint, "016x")
+            if chatbot_id is None:
+                page["boilerplate_blocks"] = sorted(boilerplate)
+                result = knowledge_collection.insert_one(
+                    {"user_id": self.user_id, "web_url": self.base_url, "storage": "pages"}
+                )
+                chatbot_id = result.inserted_id
+            depths[url] = depths[parent] + 1 if parent is not None else 0
+            page_store.save_page(chatbot_id, page, parent, depths[url], **fetch_validators(fetch_info))
+
+        if chatbot_id is None:
+            return None
+        knowledge_collection.update_one({"_id": chatbot_id}, {"$set": {"page_count": len(depths)}})
+        if duplicates:
+            logger.info(f"Dropped {len(duplicates)} near-duplicate pages.")
+        logger.info(f"Scraped data stored successfully ({len(depths)} pages).")
+        return {"chatbot_id": str(chatbot_id), "page_count": len(depths), "duplicates": duplicates}
@@ -0,0 +1,63 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from extraction import get_extractor
+
+# Processes parsing fetched pages; 0 parses on the crawl's own event loop
+CRAWL_PARSE_PROCESSES = int(os.getenv("CRAWL_PARSE_PROCESSES", "0"))
+# Fetched pages waiting for or in a parse, per crawl; fetch workers wait once it is full
+CRAWL_PARSE_QUEUE = int(os.getenv("CRAWL_PARSE_QUEUE", str(max(1, CRAWL_PARSE_PROCESSES) * 4)))
+
+# Extractors created in a pool process, by name
+_extractors = {}
+
+
+def extract_document(extractor_name, body, encoding, url, base_url):
+    """Decode and extract one page; runs in a pool process."""
+    extractor = _extractors.get(extractor_name)
+    if extractor is None:
+        extractor = _extractors[extractor_name] = get_extractor(extractor_name)
+    html = body.decode(encoding or "utf-8", errors="replace")
+    return extractor.extract(html, url, base_url)
+
+
+class ParsePool:
+    """Process pool for HTML extraction, shared by every crawl in the service.
+
+    Crawls run on several job threads, each with its own event loop, so
+    the pool itself is unbounded and each crawl bounds its own queue (see
+    ``CrawlEngine``). Processes are spawned rather than forked, since the
+    service is multi-threaded, and started on first use. A spawned process
+    re-runs the parent's ``__main__`` script, so the service must not be
+    that script (see the top of ``main.py``); workers then import only this
+    module and ``extraction``.
+    """
+
+    def __init__(self, processes=CRAWL_PARSE_PROCESSES):
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    async def extract(self, extractor_name, body, encoding, url, base_url):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(), extract_document, extractor_name, body, encoding, url, base_url
+        )
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -81,14 +81,33 @@ const Dashboard = () => {
 
   const fetchChatbots = async (userId) => {
     try {
-      const response = await axios.get(`http://localhost:8000/get-chatbots/${userId}`);
-      setChatbots(response.data);
+      const chatbots = [];
+      let after = null;
+      do {
+        const response = await axios.get(`http://localhost:8000/users/${userId}/chatbots`, {
+          params: { fields: 'chatbot_name,website_url,api_key', limit: 200, after },
+        });
+        chatbots.push(...response.data.chatbots);
+        after = response.data.next_after;
+      } while (after);
+      setChatbots(chatbots);
     } catch (error) {
       console.error('Error fetching chatbots:', error);
       alert('Error fetching chatbots. Please try again.');
     }
   };
 
+  const waitForScrapeJob = async (jobId) => {
+    while (true) {
+      const response = await axios.get(`http://localhost:8002/scrape/${jobId}`);
+      const job = response.data;
+      if (['completed', 'failed', 'cancelled'].includes(job.status)) {
+        return job;
+      }
+      await new Promise(resolve => setTimeout(resolve, 2000));
+    }
+  };
+
   const handleScrape = async () => {
     if (!websiteUrl) {
       alert('Please enter a valid website URL');
@@ -101,7 +120,14 @@ const Dashboard = () => {
         website_url: websiteUrl,
         company_name: user.displayName || 'Unknown Company'
       });
-      setScrapedData(response.data);
+      const job = await waitForScrapeJob(response.data.job_id);
+      if (job.status !== 'completed') {
+        throw new Error(job.error || `Scrape job ${job.status}`);
+      }
+      // Pipelined scrapes store their pages as they go and report the stored scrape's id instead
+      setScrapedData(job.report
+        ? { message: 'Website scraped successfully', scrape_id: job.report.chatbot_id }
+        : { message: 'Website scraped successfully', scraped_data: job.scraped_data });
       alert('Website scraped successfully!');
     } catch (error) {
       console.error('Error scraping website:', error);
@@ -122,7 +148,7 @@ const Dashboard = () => {
         user_id: user.uid,
         chatbot_name: chatbotName,
         website_url: websiteUrl,
-        scraped_data: scrapedData
+        ...(scrapedData.scrape_id ? { scrape_id: scrapedData.scrape_id } : { scraped_data: scrapedData })
       });
       if (response.status === 200) {
         alert(`Chatbot "${chatbotName}" created successfully!`);
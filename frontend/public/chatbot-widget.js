@@ -134,6 +134,30 @@
   let chatWindow = null;
   let messagesContainer = null;
   let isProcessing = false;
+  // The chat service keeps the conversation under this id; sent back with every turn
+  let sessionId = null;
+
+  function sessionStorageKey() {
+    return `chatbot-session-${apiKey}`;
+  }
+
+  function loadSessionId() {
+    try {
+      return window.sessionStorage.getItem(sessionStorageKey());
+    } catch (e) {
+      // Storage can be blocked for embedded pages; the session then lasts until reload
+      return null;
+    }
+  }
+
+  function saveSessionId(id) {
+    sessionId = id;
+    try {
+      window.sessionStorage.setItem(sessionStorageKey(), id);
+    } catch (e) {
+      // Kept in memory only
+    }
+  }
 
   function createChatInterface() {
     const container = document.createElement('div');
@@ -232,6 +256,7 @@
     messageDiv.textContent = content;
     messagesContainer.appendChild(messageDiv);
     messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    return messageDiv;
 }
 
 async function sendMessage(content) {
@@ -254,23 +279,46 @@ async function sendMessage(content) {
           headers: {
               'Content-Type': 'application/json'
           },
-          body: JSON.stringify({ message: content })
+          body: JSON.stringify(sessionId
+              ? { message: content, stream: true, session_id: sessionId }
+              : { message: content, stream: true, start_session: true })
       });
 
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
           throw new Error('Failed to get response');
       }
 
-      const data = await response.json();
-      
-      // Add bot's response to the chat
-      if (data && data.response) {
-          // Small delay to make the conversation feel more natural
-          setTimeout(() => {
-              addMessage(data.response, false);
-          }, 500);
-      } else {
-          throw new Error('Invalid response format');
+      // Render tokens as the Server-Sent Events arrive
+      const botMessage = addMessage('', false);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+
+          const events = buffer.split('\n\n');
+          buffer = events.pop();
+          for (const rawEvent of events) {
+              const lines = rawEvent.split('\n');
+              const eventType = (lines.find(line => line.startsWith('event: ')) || 'event: message').slice(7);
+              const dataLine = lines.find(line => line.startsWith('data: '));
+              if (!dataLine) continue;
+              const data = JSON.parse(dataLine.slice(6));
+
+              if (eventType === 'error') {
+                  throw new Error(data.detail || 'Failed to get response');
+              } else if (eventType === 'done') {
+                  botMessage.textContent = data.response;
+                  // A new id replaces one the service no longer had
+                  if (data.session_id) saveSessionId(data.session_id);
+              } else if (data.token) {
+                  botMessage.textContent += data.token;
+              }
+              messagesContainer.scrollTop = messagesContainer.scrollHeight;
+          }
       }
   } catch (error) {
       console.error('Error:', error);
@@ -285,6 +333,7 @@ async function sendMessage(content) {
 
   window.initChatbot = function(config) {
     apiKey = config.apiKey;
+    sessionId = loadSessionId();
     createChatInterface();
     addMessage('Hello! How can I help you today?');
   };
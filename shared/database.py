@@ -1,14 +1,161 @@
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument
+from pymongo.errors import PyMongoError
+from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+import logging
 import os
 
+from shared.metrics import MongoCommandMetrics
+
+logger = logging.getLogger(__name__)
+
 # MongoDB connection string
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+MONGO_URI = os.getenv("MONGO_URI", os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "chatbot_db")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+
+# Both clients report command round trips to the metrics module
+mongo_metrics = MongoCommandMetrics()
 
-# Create a new client and connect to the server
-client = MongoClient(MONGO_URI)
+# Synchronous client, for worker threads and scripts that run outside an event loop
+client = MongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE, event_listeners=[mongo_metrics])
 
 # Access the database
-db = client["chatbot_db"]
+db = client[MONGO_DB_NAME]
 
 # Access the collections
 knowledge_collection = db["knowledge"]
+users_collection = db["users"]
+
+# Per-chatbot BM25 retrieval indexes, keyed by the chatbot's _id
+retrieval_index_collection = db["retrieval_index"]
+
+# Chatbot fields needed to serve chat and dashboard requests; excludes the crawl tree
+CHATBOT_SUMMARY_PROJECTION = {"scraped_data": 0}
+
+_async_client = None
+
+
+def get_async_db():
+    """Return the process-wide Motor database, creating its pooled client on first use."""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncIOMotorClient(
+            MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE, event_listeners=[mongo_metrics]
+        )
+    return _async_client[MONGO_DB_NAME]
+
+
+def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        _async_client.close()
+        _async_client = None
+
+
+async def ensure_indexes():
+    """Create the indexes the services query by. Safe to run on every startup."""
+    adb = get_async_db()
+    indexes = [
+        # Scrape results share the collection but have no api_key, hence partial
+        (adb.knowledge, [("api_key", ASCENDING)], {
+            "unique": True,
+            "partialFilterExpression": {"api_key": {"$type": "string"}},
+        }),
+        (adb.knowledge, [("user_id", ASCENDING)], {}),
+        # Cursor pagination of a user's chatbots
+        (adb.knowledge, [("user_id", ASCENDING), ("_id", ASCENDING)], {}),
+        (adb.users, [("email", ASCENDING)], {"unique": True}),
+        (adb.pages, [("chatbot_id", ASCENDING), ("url", ASCENDING)], {"unique": True}),
+        # Shared rate limiter state expires on its own
+        (adb.rate_limit_buckets, [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+        (adb.rate_limit_quotas, [("expires_at", ASCENDING)], {"expireAfterSeconds": 0}),
+        # Checkpointed crawls: one entry per URL, claimed in depth and priority order
+        (adb.crawl_frontier, [("crawl_id", ASCENDING), ("url", ASCENDING)], {"unique": True}),
+        (adb.crawl_frontier, [
+            ("crawl_id", ASCENDING), ("state", ASCENDING), ("depth", ASCENDING),
+            ("priority", DESCENDING), ("order", ASCENDING),
+        ], {}),
+        (adb.crawl_pages, [("crawl_id", ASCENDING), ("url", ASCENDING)], {"unique": True}),
+        (adb.crawl_pages, [("crawl_id", ASCENDING), ("depth", ASCENDING), ("order", ASCENDING)], {}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            await collection.create_index(keys, **options)
+        except PyMongoError as e:
+            logger.error(f"Failed to create index {keys} on {collection.name}: {str(e)}")
+
+
+# Chatbots
+
+async def insert_chatbot(chatbot):
+    result = await get_async_db().knowledge.insert_one(chatbot)
+    return result.inserted_id
+
+
+async def promote_scrape(scrape_id, user_id, fields):
+    """Turn a user's stored scrape into a chatbot by setting ``fields`` on it.
+
+    Returns the updated entry, or None if there is no such scrape or it
+    already became a chatbot; the api_key check makes this one-shot.
+    """
+    return await get_async_db().knowledge.find_one_and_update(
+        {"_id": ObjectId(scrape_id), "user_id": user_id, "api_key": {"$exists": False}},
+        {"$set": fields},
+        projection=CHATBOT_SUMMARY_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def get_chatbot(chatbot_id, projection=CHATBOT_SUMMARY_PROJECTION):
+    return await get_async_db().knowledge.find_one({"_id": ObjectId(chatbot_id)}, projection)
+
+
+async def find_chatbot_by_api_key(api_key, projection=None):
+    return await get_async_db().knowledge.find_one({"api_key": api_key}, projection)
+
+
+async def list_chatbots(user_id, projection=CHATBOT_SUMMARY_PROJECTION, after=None, limit=None):
+    """Return a user's chatbots ordered by _id, starting after ``after``; all of them without a ``limit``."""
+    query = {"user_id": user_id}
+    if after:
+        query["_id"] = {"$gt": ObjectId(after)}
+    cursor = get_async_db().knowledge.find(query, projection).sort("_id", ASCENDING)
+    if limit:
+        cursor = cursor.limit(limit)
+    return await cursor.to_list(length=limit)
+
+
+async def get_scraped_data(chatbot_id):
+    chatbot = await get_async_db().knowledge.find_one({"_id": ObjectId(chatbot_id)}, {"scraped_data": 1})
+    return chatbot.get("scraped_data", {}) if chatbot else {}
+
+
+# Retrieval indexes
+
+async def get_retrieval_index(chatbot_id):
+    return await get_async_db().retrieval_index.find_one({"_id": ObjectId(chatbot_id)})
+
+
+async def save_retrieval_index(chatbot_id, index_doc):
+    index_doc["_id"] = ObjectId(chatbot_id)
+    await get_async_db().retrieval_index.replace_one({"_id": index_doc["_id"]}, index_doc, upsert=True)
+
+
+# Users
+
+async def find_user_by_email(email, projection=None):
+    return await get_async_db().users.find_one({"email": email}, projection)
+
+
+async def get_user_by_id(user_id, projection=None):
+    return await get_async_db().users.find_one({"_id": ObjectId(user_id)}, projection)
+
+
+async def insert_user(user):
+    result = await get_async_db().users.insert_one(user)
+    return result.inserted_id
+
+
+async def update_user(user_id, fields):
+    await get_async_db().users.update_one({"_id": ObjectId(user_id)}, {"$set": fields})
@@ -0,0 +1,319 @@
+import bisect
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this log their span breakdown with the request id; 0 disables it
+METRICS_SLOW_REQUEST_SECONDS = float(os.getenv("METRICS_SLOW_REQUEST_SECONDS", "2"))
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Latency buckets in seconds, from a cache lookup up to a slow LLM answer
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800, 1600, 3200)
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+# Spans recorded while serving the current request, for the slow-request log
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus exposition format."""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        label_names = self.labels + ("le",)
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = format_labels(label_names, label_values + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics, rendered on demand for ``/metrics``.
+
+    Collectors are callables returning exposition lines; they read values
+    that are kept elsewhere (cache statistics, for instance) at scrape time.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        return self._register(name, lambda: Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(name, lambda: Histogram(name, help, labels, buckets))
+
+    def add_collector(self, name, collector):
+        with self._lock:
+            self._collectors[name] = collector
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                lines.extend(collector())
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, name, factory):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory()
+            return self._metrics[name]
+
+
+registry = MetricsRegistry()
+
+span_seconds = registry.histogram("span_seconds", "Duration of named hot-path spans.", ["span"])
+http_request_seconds = registry.histogram(
+    "http_request_seconds",
+    "HTTP request duration, until the last byte of the response.",
+    ["service", "method", "route", "status"],
+)
+mongo_command_seconds = registry.histogram(
+    "mongo_command_seconds", "MongoDB command round trips.", ["command", "outcome"],
+)
+llm_time_to_first_token_seconds = registry.histogram(
+    "llm_time_to_first_token_seconds", "Time from sending a streamed completion to its first token.",
+)
+llm_tokens_per_second = registry.histogram(
+    "llm_tokens_per_second", "Completion tokens generated per second.", ["mode"],
+    buckets=TOKENS_PER_SECOND_BUCKETS,
+)
+events_total = registry.counter("events_total", "Counted events, such as token cache hits.", ["event"])
+
+
+def observe_span(name, seconds):
+    """Record a span whose duration was measured by the caller."""
+    span_seconds.observe(seconds, name)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as span ``name``; works in sync and async code."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_span(name, time.perf_counter() - start)
+
+
+def count_event(event):
+    events_total.inc(event)
+
+
+def current_request_id():
+    return request_id_var.get()
+
+
+def request_id_headers():
+    """Headers that carry the current request id to another service."""
+    request_id = request_id_var.get()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+
+# name -> object with an ``LRUCache``-style ``stats()``
+_caches = {}
+
+CACHE_METRICS = (
+    ("cache_hits_total", "counter", "hits"),
+    ("cache_misses_total", "counter", "misses"),
+    ("cache_evictions_total", "counter", "evictions"),
+    ("cache_entries", "gauge", "entries"),
+    ("cache_bytes", "gauge", "bytes"),
+)
+
+
+def register_cache(name, cache):
+    """Export a cache's ``stats()`` as cache metrics labelled ``cache=name``."""
+    _caches[name] = cache
+
+
+def _collect_caches():
+    stats = {name: cache.stats() for name, cache in sorted(_caches.items())}
+    lines = []
+    for metric, kind, field in CACHE_METRICS:
+        if stats:
+            lines.append(f"# TYPE {metric} {kind}")
+        for name, values in stats.items():
+            lines.append(f"{metric}{format_labels(('cache',), (name,))} {values.get(field, 0)}")
+    return lines
+
+
+registry.add_collector("caches", _collect_caches)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command a MongoDB client sends; pass it as ``event_listeners``."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event, "ok")
+
+    def failed(self, event):
+        self._observe(event, "error")
+
+    def _observe(self, event, outcome):
+        seconds = event.duration_micros / 1e6
+        mongo_command_seconds.observe(seconds, event.command_name, outcome)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((f"mongo.{event.command_name}", seconds))
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each request and assigning it a request id.
+
+    The id comes from the incoming ``X-Request-ID`` header or is generated,
+    is echoed on the response and is available to ``request_id_headers``
+    for calls to other services. Streamed responses are timed until their
+    last chunk.
+    """
+
+    def __init__(self, app, service):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        id_token = request_id_var.set(request_id)
+        spans = []
+        spans_token = _request_spans.set(spans)
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (REQUEST_ID_HEADER.lower().encode("latin-1"), request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            # The route template keeps ids and API keys out of the label values
+            path = getattr(route, "path", None) or "unmatched"
+            http_request_seconds.observe(elapsed, self.service, scope["method"], path, str(status))
+            if METRICS_SLOW_REQUEST_SECONDS and elapsed >= METRICS_SLOW_REQUEST_SECONDS:
+                breakdown = ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in spans)
+                logger.warning(
+                    f"Slow request {request_id}: {scope['method']} {path} took {elapsed * 1000:.1f}ms"
+                    f" ({breakdown or 'no spans'})"
+                )
+            _request_spans.reset(spans_token)
+            request_id_var.reset(id_token)
+
+
+def install(app, service):
+    """Add request timing and a Prometheus ``/metrics`` endpoint to a FastAPI app."""
+    from fastapi.responses import PlainTextResponse
+
+    app.add_middleware(MetricsMiddleware, service=service)
+
+    async def metrics():
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
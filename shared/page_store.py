@@ -0,0 +1,176 @@
+import datetime
+import hashlib
+import os
+import zlib
+
+import gridfs
+from bson import Binary, ObjectId
+from pymongo import ASCENDING
+
+from shared.database import db
+
+try:
+    import zstandard
+except ImportError:  # zlib is always available
+    zstandard = None
+
+# Compressed bodies larger than this go to GridFS instead of the page record
+PAGE_INLINE_MAX_BYTES = int(os.getenv("PAGE_INLINE_MAX_BYTES", str(512 * 1024)))
+PAGE_BATCH_SIZE = int(os.getenv("PAGE_BATCH_SIZE", "100"))
+
+# Everything but the body; what listings and lazy readers fetch
+PAGE_METADATA_PROJECTION = {"text": 0}
+
+
+def compress_text(text):
+    """Return ``(encoding, data)`` for a page body, preferring zstd when installed."""
+    raw = text.encode("utf-8")
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=6).compress(raw)
+    return "zlib", zlib.compress(raw, 6)
+
+
+def decompress_text(encoding, data):
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Page was stored with zstd but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    if encoding == "zlib":
+        return zlib.decompress(data).decode("utf-8")
+    return data.decode("utf-8")
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def iter_tree(scraped_data):
+    """Yield ``(page, parent_url, depth)`` for every page of a nested crawl tree."""
+    # Chatbots created from the /scrape response wrap the tree once more
+    if isinstance(scraped_data, dict) and "scraped_data" in scraped_data:
+        scraped_data = scraped_data["scraped_data"]
+    if not isinstance(scraped_data, dict):
+        return
+    stack = [(scraped_data, None, 0)]
+    while stack:
+        page, parent_url, depth = stack.pop()
+        yield page, parent_url, depth
+        for child in reversed(page.get("child_pages", [])):
+            stack.append((child, page.get("url"), depth + 1))
+
+
+class PageStore:
+    """One compressed record per crawled page, pointing back to its chatbot.
+
+    Uses the synchronous client: writers are scrape worker threads, and
+    async handlers call it through the threadpool since (de)compression is
+    CPU work anyway.
+    """
+
+    def __init__(self, database=db):
+        self.pages = database["pages"]
+        self.bodies = gridfs.GridFS(database, collection="page_bodies")
+
+    def save_page(self, chatbot_id, page, parent_url=None, depth=0, **extra):
+        """Insert or replace the record for ``page["url"]`` and return it."""
+        chatbot_id = ObjectId(chatbot_id)
+        text = page.get("text") or ""
+        encoding, data = compress_text(text)
+        record = {
+            "chatbot_id": chatbot_id,
+            "url": page.get("url", ""),
+            "title": page.get("title") or "",
+            "meta": page.get("meta", {}),
+            "headings": page.get("headings", {}),
+            "links": page.get("links", []),
+            "images": page.get("images", []),
+            "parent_url": parent_url,
+            "depth": depth,
+            "content_hash": content_hash(text),
+            "encoding": encoding,
+            "text_length": len(text),
+            "compressed_length": len(data),
+            "updated_at": datetime.datetime.utcnow(),
+        }
+        # Set by ingestion's boilerplate pass; the site's boilerplate rides on the root page
+        for field in ("simhash", "boilerplate_blocks"):
+            if field in page:
+                record[field] = page[field]
+        record.update(extra)
+        if len(data) > PAGE_INLINE_MAX_BYTES:
+            record["body_id"] = self.bodies.put(data, chatbot_id=chatbot_id, url=record["url"])
+        else:
+            record["text"] = Binary(data)
+
+        previous = self.pages.find_one_and_replace(
+            {"chatbot_id": chatbot_id, "url": record["url"]},
+            record,
+            projection={"body_id": 1},
+            upsert=True,
+        )
+        if previous and previous.get("body_id"):
+            self.bodies.delete(previous["body_id"])
+        return record
+
+    def update_page(self, chatbot_id, url, **fields):
+        """Set metadata fields on a stored page without touching its body."""
+        self.pages.update_one({"chatbot_id": ObjectId(chatbot_id), "url": url}, {"$set": fields})
+
+    def save_tree(self, chatbot_id, scraped_data, fetch_info=None):
+        """Store every page of a nested crawl tree; returns the page count.
+
+        ``fetch_info`` maps page URLs to extra fields saved with those pages,
+        such as the validators a refresh sends with its conditional requests.
+        """
+        fetch_info = fetch_info or {}
+        count = 0
+        for page, parent_url, depth in iter_tree(scraped_data):
+            self.save_page(chatbot_id, page, parent_url, depth, **fetch_info.get(page.get("url"), {}))
+            count += 1
+        return count
+
+    def load_text(self, record):
+        if "body_id" in record:
+            data = self.bodies.get(record["body_id"]).read()
+        elif "text" in record:
+            data = record["text"]
+        else:
+            data = self.pages.find_one({"_id": record["_id"]}, {"text": 1})["text"]
+        return decompress_text(record.get("encoding"), bytes(data))
+
+    def iter_pages(self, chatbot_id, include_text=True, batch_size=PAGE_BATCH_SIZE):
+        """Lazily yield a chatbot's pages, decompressing one batch at a time."""
+        projection = None if include_text else PAGE_METADATA_PROJECTION
+        cursor = self.pages.find({"chatbot_id": ObjectId(chatbot_id)}, projection).batch_size(batch_size)
+        for record in cursor:
+            if include_text:
+                record["text"] = self.load_text(record)
+            yield record
+
+    def list_pages(self, chatbot_id, after=None, limit=PAGE_BATCH_SIZE, include_text=False):
+        """Return one page of records ordered by _id, starting after ``after``."""
+        query = {"chatbot_id": ObjectId(chatbot_id)}
+        if after:
+            query["_id"] = {"$gt": ObjectId(after)}
+        projection = None if include_text else PAGE_METADATA_PROJECTION
+        records = list(self.pages.find(query, projection).sort("_id", ASCENDING).limit(limit))
+        if include_text:
+            for record in records:
+                record["text"] = self.load_text(record)
+        return records
+
+    def delete_page(self, chatbot_id, url):
+        record = self.pages.find_one_and_delete(
+            {"chatbot_id": ObjectId(chatbot_id), "url": url}, projection={"body_id": 1}
+        )
+        if record and record.get("body_id"):
+            self.bodies.delete(record["body_id"])
+
+    def delete_pages(self, chatbot_id):
+        chatbot_id = ObjectId(chatbot_id)
+        for record in self.pages.find({"chatbot_id": chatbot_id, "body_id": {"$exists": True}}, {"body_id": 1}):
+            self.bodies.delete(record["body_id"])
+        return self.pages.delete_many({"chatbot_id": chatbot_id}).deleted_count
+
+
+page_store = PageStore()
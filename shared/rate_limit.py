@@ -0,0 +1,246 @@
+import datetime
+import math
+import os
+import threading
+import time
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Defaults per chatbot; a chatbot document's ``rate_limit`` field overrides any of them.
+# A chatbot's widget visitors all share its api_key, so there is no rate limit unless one is set.
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "0"))  # sustained requests per second; 0 disables it
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_DAILY_QUOTA = int(os.getenv("RATE_LIMIT_DAILY_QUOTA", "0"))  # 0 disables the quota
+RATE_LIMIT_MONTHLY_QUOTA = int(os.getenv("RATE_LIMIT_MONTHLY_QUOTA", "0"))
+# "memory" keeps limits per process; "mongo" shares them between gateway workers
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+# Attempts at the compare-and-set in the shared backend before giving up and allowing
+RATE_LIMIT_MAX_CAS_ATTEMPTS = 5
+
+DEFAULT_LIMITS = {
+    "rate": RATE_LIMIT_RATE,
+    "burst": RATE_LIMIT_BURST,
+    "daily_quota": RATE_LIMIT_DAILY_QUOTA,
+    "monthly_quota": RATE_LIMIT_MONTHLY_QUOTA,
+}
+
+
+class RateLimitResult:
+    def __init__(self, allowed, limit, remaining, retry_after=0.0, reason=None):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.retry_after = retry_after
+        self.reason = reason
+
+    def headers(self):
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(max(0, self.remaining)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+def gcra(tat, now, rate, burst):
+    """One step of the generic cell rate algorithm, i.e. a token bucket kept as one timestamp.
+
+    ``tat`` is the theoretical arrival time of the next request. Returns
+    ``(allowed, new_tat, remaining, retry_after)``.
+    """
+    interval = 1.0 / rate
+    new_tat = max(tat or now, now) + interval
+    allowance = burst * interval
+    if new_tat - now > allowance:
+        return False, tat, 0, new_tat - now - allowance
+    return True, new_tat, int((allowance - (new_tat - now)) / interval), 0.0
+
+
+def quota_periods(limits, now=None):
+    """``(period_key, limit, seconds_until_reset)`` for each enabled quota, in UTC."""
+    now = now or datetime.datetime.utcnow()
+    periods = []
+    if limits.get("daily_quota"):
+        reset = datetime.datetime(now.year, now.month, now.day) + datetime.timedelta(days=1)
+        periods.append((f"day:{now:%Y-%m-%d}", limits["daily_quota"], (reset - now).total_seconds()))
+    if limits.get("monthly_quota"):
+        reset = datetime.datetime(now.year + now.month // 12, now.month % 12 + 1, 1)
+        periods.append((f"month:{now:%Y-%m}", limits["monthly_quota"], (reset - now).total_seconds()))
+    return periods
+
+
+class RateLimitBackend:
+    """Storage for bucket state and quota counters.
+
+    Implementations must make each call atomic for their scope: per process
+    for ``MemoryBackend``, across every gateway worker for shared ones.
+    """
+
+    async def take(self, key, rate, burst):
+        """Consume one request from ``key``'s bucket; returns ``(allowed, remaining, retry_after)``."""
+        raise NotImplementedError
+
+    async def count(self, key, period, limit, ttl):
+        """Count one request against a quota period unless it is used up; returns ``(allowed, used)``."""
+        raise NotImplementedError
+
+    async def usage(self, key, periods):
+        """Return ``{period: used}`` for the given period keys."""
+        raise NotImplementedError
+
+
+class MemoryBackend(RateLimitBackend):
+    def __init__(self):
+        self._tats = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    async def take(self, key, rate, burst):
+        with self._lock:
+            allowed, tat, remaining, retry_after = gcra(self._tats.get(key), time.monotonic(), rate, burst)
+            self._tats[key] = tat
+        return allowed, remaining, retry_after
+
+    async def count(self, key, period, limit, ttl):
+        with self._lock:
+            counts = self._counts.setdefault(key, {})
+            if period not in counts:
+                # A new day or month has started; drop the finished one of the same kind
+                kind = period.split(":", 1)[0]
+                for old in [old for old in counts if old.split(":", 1)[0] == kind]:
+                    del counts[old]
+            used = counts.get(period, 0)
+            if used >= limit:
+                return False, used
+            counts[period] = used + 1
+            return True, used + 1
+
+    async def usage(self, key, periods):
+        with self._lock:
+            counts = self._counts.get(key, {})
+            return {period: counts.get(period, 0) for period in periods}
+
+
+class MongoBackend(RateLimitBackend):
+    """Shares limits between processes through two MongoDB collections.
+
+    Buckets are updated with a compare-and-set on their timestamp; quota
+    counters with a conditional upsert. Both expire through TTL indexes
+    created by ``shared.database.ensure_indexes``.
+    """
+
+    def __init__(self, database):
+        self.buckets = database["rate_limit_buckets"]
+        self.quotas = database["rate_limit_quotas"]
+
+    async def take(self, key, rate, burst):
+        for _ in range(RATE_LIMIT_MAX_CAS_ATTEMPTS):
+            bucket = await self.buckets.find_one({"_id": key})
+            old_tat = bucket["tat"] if bucket else None
+            allowed, tat, remaining, retry_after = gcra(old_tat, time.time(), rate, burst)
+            if not allowed:
+                return False, remaining, retry_after
+            expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=tat - time.time() + 60)
+            if bucket is None:
+                try:
+                    await self.buckets.insert_one({"_id": key, "tat": tat, "expires_at": expires_at})
+                    return True, remaining, 0.0
+                except DuplicateKeyError:
+                    continue
+            result = await self.buckets.update_one(
+                {"_id": key, "tat": old_tat},
+                {"$set": {"tat": tat, "expires_at": expires_at}},
+            )
+            if result.modified_count:
+                return True, remaining, 0.0
+        # Heavy contention on one key; let the request through rather than fail it
+        return True, 0, 0.0
+
+    async def count(self, key, period, limit, ttl):
+        try:
+            doc = await self.quotas.find_one_and_update(
+                {"_id": f"{key}:{period}", "used": {"$lt": limit}},
+                {
+                    "$inc": {"used": 1},
+                    "$setOnInsert": {"expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The counter exists but is already at the limit, so the filter didn't match
+            return False, limit
+        return True, doc["used"]
+
+    async def usage(self, key, periods):
+        ids = [f"{key}:{period}" for period in periods]
+        docs = await self.quotas.find({"_id": {"$in": ids}}).to_list(length=None)
+        used = {doc["_id"]: doc["used"] for doc in docs}
+        return {period: used.get(f"{key}:{period}", 0) for period in periods}
+
+
+class RateLimiter:
+    """Token-bucket rate limits and daily/monthly quotas per key.
+
+    ``limits`` passed to ``check`` override ``DEFAULT_LIMITS`` per key.
+    Counters of allowed and rejected requests are kept per process.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def effective_limits(self, limits=None):
+        return {**DEFAULT_LIMITS, **{k: v for k, v in (limits or {}).items() if v is not None}}
+
+    async def check(self, key, limits=None):
+        limits = self.effective_limits(limits)
+        remaining = limits["burst"]
+        if limits["rate"]:
+            allowed, remaining, retry_after = await self.backend.take(key, limits["rate"], limits["burst"])
+            if not allowed:
+                self._count(key, "rate_limited")
+                return RateLimitResult(False, limits["burst"], 0, retry_after, reason="rate")
+
+        for period, limit, ttl in quota_periods(limits):
+            allowed, _ = await self.backend.count(key, period, limit, ttl)
+            if not allowed:
+                self._count(key, "quota_exceeded")
+                return RateLimitResult(False, limits["burst"], 0, ttl, reason="quota")
+
+        self._count(key, "allowed")
+        return RateLimitResult(True, limits["burst"], remaining)
+
+    async def usage(self, key, limits=None):
+        limits = self.effective_limits(limits)
+        periods = quota_periods(limits)
+        used = await self.backend.usage(key, [period for period, _, _ in periods])
+        with self._lock:
+            counters = dict(self._counters.get(key, {}))
+        return {
+            "limits": limits,
+            "quotas": [
+                {"period": period, "used": used[period], "limit": limit, "resets_in": int(ttl)}
+                for period, limit, ttl in periods
+            ],
+            "requests": {
+                "allowed": counters.get("allowed", 0),
+                "rate_limited": counters.get("rate_limited", 0),
+                "quota_exceeded": counters.get("quota_exceeded", 0),
+            },
+        }
+
+    def _count(self, key, outcome):
+        with self._lock:
+            counters = self._counters.setdefault(key, {})
+            counters[outcome] = counters.get(outcome, 0) + 1
+
+
+def create_rate_limiter(backend=RATE_LIMIT_BACKEND):
+    if backend == "mongo":
+        from shared.database import get_async_db
+        return RateLimiter(MongoBackend(get_async_db()))
+    return RateLimiter()
@@ -0,0 +1,274 @@
+import bisect
+import hashlib
+import math
+import os
+import re
+from collections import Counter
+
+try:
+    import tiktoken
+except ImportError:  # fall back to an estimate that errs on the high side
+    tiktoken = None
+
+# Chunk sizes are in model tokens; overlap carries whole sentences into the next chunk
+CHUNK_SIZE = int(os.getenv("RETRIEVAL_CHUNK_SIZE", "200"))
+CHUNK_OVERLAP = int(os.getenv("RETRIEVAL_CHUNK_OVERLAP", "40"))
+TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+
+# Bumped whenever the stored chunk layout changes, so old index documents get rebuilt
+INDEX_VERSION = 2
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+# Estimate: words count one token per six characters, punctuation one each
+TOKEN_ESTIMATE_RE = re.compile(r"\w{1,6}|[^\w\s]")
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in is it
+its me my of on or our so that the their them there these this to us was we
+what when where which who why will with you your
+""".split())
+
+
+def tokenize(text):
+    """Lowercase word tokens with stopwords removed."""
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+_encoding = tiktoken.get_encoding("cl100k_base") if tiktoken is not None else None
+
+
+def count_tokens(text):
+    """Model tokens in ``text``; exact with tiktoken, otherwise a close overestimate."""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(TOKEN_ESTIMATE_RE.findall(text))
+
+
+def split_sentences(text, max_tokens=CHUNK_SIZE):
+    """Split page text into sentences, one block (line) at a time.
+
+    Sentences longer than ``max_tokens`` are cut into word windows so every
+    piece fits in a chunk. Returns ``(sentence, tokens)`` pairs.
+    """
+    sentences = []
+    for block in text.splitlines():
+        for sentence in SENTENCE_END_RE.split(" ".join(block.split())):
+            if not sentence:
+                continue
+            tokens = count_tokens(sentence)
+            if tokens <= max_tokens:
+                sentences.append((sentence, tokens))
+                continue
+            words = sentence.split()
+            step = max(1, len(words) * max_tokens // tokens)
+            for start in range(0, len(words), step):
+                piece = " ".join(words[start:start + step])
+                sentences.append((piece, count_tokens(piece)))
+    return sentences
+
+
+def iter_pages(scraped_data):
+    """Yield every page of a crawl tree, including nested child_pages."""
+    # Chatbots created from the /scrape response wrap the tree once more
+    if isinstance(scraped_data, dict) and "scraped_data" in scraped_data:
+        scraped_data = scraped_data["scraped_data"]
+    if isinstance(scraped_data, str):
+        yield {"url": "", "title": "", "text": scraped_data}
+        return
+    if not isinstance(scraped_data, dict):
+        return
+
+    stack = [scraped_data]
+    while stack:
+        page = stack.pop()
+        yield page
+        stack.extend(reversed(page.get("child_pages", [])))
+
+
+def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Pack whole sentences into chunks of at most ``chunk_size`` tokens.
+
+    Consecutive chunks share up to ``overlap`` tokens of trailing sentences.
+    Each chunk is ``(text, sentence_ends, sentence_tokens)``: the character
+    offset where each sentence ends and the running token count after it,
+    so a chunk can later be cut at a sentence boundary without re-tokenizing.
+    """
+    sentences = split_sentences(text, chunk_size)
+    chunks = []
+    start = 0
+    while start < len(sentences):
+        end, tokens = start, 0
+        while end < len(sentences) and (end == start or tokens + sentences[end][1] <= chunk_size):
+            tokens += sentences[end][1]
+            end += 1
+        chunks.append(_pack_sentences(sentences[start:end]))
+        if end == len(sentences):
+            break
+        # Step back over trailing sentences worth at most ``overlap`` tokens
+        next_start, carried = end, 0
+        while next_start - 1 > start and carried + sentences[next_start - 1][1] <= overlap:
+            next_start -= 1
+            carried += sentences[next_start][1]
+        start = next_start
+    return chunks
+
+
+def _pack_sentences(sentences):
+    text, ends, running = "", [], []
+    total = 0
+    for sentence, tokens in sentences:
+        text = f"{text} {sentence}" if text else sentence
+        total += tokens
+        ends.append(len(text))
+        running.append(total)
+    return text, ends, running
+
+
+def build_chunks(scraped_data, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Chunk every page of a nested crawl tree."""
+    return build_chunks_from_pages(iter_pages(scraped_data), chunk_size, overlap)
+
+
+def build_chunks_from_pages(pages, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Chunk an iterable of pages, skipping chunks already seen on another page."""
+    chunks = []
+    seen = set()
+    for page in pages:
+        text = page.get("text") or ""
+        title = page.get("title") or ""
+        for chunk, sentence_ends, sentence_tokens in chunk_text(text, chunk_size, overlap):
+            if chunk in seen:
+                continue
+            seen.add(chunk)
+            chunks.append({
+                "url": page.get("url", ""),
+                "title": title,
+                "text": chunk,
+                "tokens": sentence_tokens[-1],
+                "header_tokens": count_tokens(section_header(title, page.get("url"))) + 2,
+                "sentence_ends": sentence_ends,
+                "sentence_tokens": sentence_tokens,
+            })
+    return chunks
+
+
+def build_index(chunks):
+    """Build a BM25 inverted index document that can be stored in MongoDB."""
+    postings = {}
+    doc_lengths = []
+    for chunk_id, chunk in enumerate(chunks):
+        terms = Counter(tokenize(chunk["text"]))
+        doc_lengths.append(sum(terms.values()))
+        for term, tf in terms.items():
+            postings.setdefault(term, []).append([chunk_id, tf])
+    fingerprint = hashlib.sha1()
+    for chunk in chunks:
+        fingerprint.update(chunk["text"].encode("utf-8"))
+    return {
+        "version": INDEX_VERSION,
+        "chunks": chunks,
+        "fingerprint": fingerprint.hexdigest(),
+        "postings": postings,
+        "doc_lengths": doc_lengths,
+        "avgdl": sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0,
+    }
+
+
+def index_scraped_data(scraped_data):
+    """Chunk a crawl tree and build its BM25 index document."""
+    return build_index(build_chunks(scraped_data))
+
+
+def index_pages(pages):
+    """Chunk stored pages and build their BM25 index document."""
+    return build_index(build_chunks_from_pages(pages))
+
+
+def update_index(index_doc, pages, stale_urls):
+    """Rebuild an index document after a refresh, re-chunking only ``pages``.
+
+    Chunks from ``stale_urls`` (changed or removed pages) are dropped and
+    every other chunk is kept as is; ``pages`` are the new versions of the
+    changed and added pages.
+    """
+    chunks = [chunk for chunk in index_doc.get("chunks", []) if chunk["url"] not in stale_urls]
+    seen = {chunk["text"] for chunk in chunks}
+    chunks.extend(chunk for chunk in build_chunks_from_pages(pages) if chunk["text"] not in seen)
+    return build_index(chunks)
+
+
+class BM25Index:
+    """Ranks the chunks of one chatbot's knowledge against a question."""
+
+    def __init__(self, index_doc):
+        self.chunks = index_doc.get("chunks", [])
+        self.fingerprint = index_doc.get("fingerprint")
+        self.postings = index_doc.get("postings", {})
+        self.doc_lengths = index_doc.get("doc_lengths", [])
+        self.avgdl = index_doc.get("avgdl") or 1.0
+
+    @classmethod
+    def from_scraped_data(cls, scraped_data):
+        return cls(index_scraped_data(scraped_data))
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def approximate_size(self):
+        """Rough in-memory footprint in bytes, used for cache accounting."""
+        text_bytes = sum(len(chunk["text"]) + len(chunk.get("url", "")) for chunk in self.chunks)
+        posting_count = sum(len(postings) for postings in self.postings.values())
+        return 2 * text_bytes + 120 * posting_count + 100 * len(self.postings)
+
+    def search(self, query, top_k=TOP_K):
+        """Return up to ``top_k`` chunks ordered by BM25 score."""
+        return [self.chunks[chunk_id] for chunk_id in self.rank(query, top_k)]
+
+    def rank(self, query, top_k=TOP_K):
+        """Return the ids of the ``top_k`` best matching chunks."""
+        n = len(self.chunks)
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[chunk_id] / self.avgdl)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+
+def section_header(title, url=None):
+    return f"[{title or url or 'Website'}]"
+
+
+def format_context(chunks, token_budget=None):
+    """Render retrieved chunks as the knowledge section of the prompt.
+
+    With a ``token_budget`` chunks are packed in order until it is spent;
+    the first chunk that doesn't fit is cut at the last sentence that does,
+    using the token counts stored at ingestion.
+    """
+    sections = []
+    remaining = token_budget
+    for chunk in chunks:
+        header = section_header(chunk.get("title"), chunk.get("url"))
+        text = chunk["text"]
+        if remaining is not None:
+            header_tokens = chunk.get("header_tokens") or count_tokens(header) + 2
+            tokens = chunk.get("tokens")
+            if tokens is None:
+                tokens = count_tokens(text)
+            if header_tokens + tokens > remaining:
+                fitting = bisect.bisect_right(chunk.get("sentence_tokens", []), remaining - header_tokens)
+                if fitting:
+                    sections.append(f"{header}\n{text[:chunk['sentence_ends'][fitting - 1]]}")
+                break
+            remaining -= header_tokens + tokens
+        sections.append(f"{header}\n{text}")
+    return "\n\n".join(sections)
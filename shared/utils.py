@@ -1,12 +1,32 @@
 import firebase_admin
 from firebase_admin import credentials, auth
 from fastapi import HTTPException, Request
+from google.auth import exceptions as google_auth_exceptions
+from google.auth import jwt as google_jwt
+from starlette.concurrency import run_in_threadpool
+import hashlib
+import httpx
+import jwt
 import logging
+import os
+import re
+import secrets
+import threading
+import time
+
+from shared.cache import LRUCache
+
+FIREBASE_CREDENTIALS = os.getenv("FIREBASE_CREDENTIALS", "path/to/your/serviceAccountKey.json")
+FIREBASE_PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID")
 
 # Initialize Firebase Admin SDK
 try:
-    cred = credentials.Certificate("path/to/your/serviceAccountKey.json")
-    firebase_admin.initialize_app(cred)
+    if os.path.exists(FIREBASE_CREDENTIALS):
+        firebase_admin.initialize_app(credentials.Certificate(FIREBASE_CREDENTIALS))
+    else:
+        # ID tokens can still be verified against Google's public keys; only the project id is needed
+        logging.warning(f"Firebase credentials not found at {FIREBASE_CREDENTIALS}; using application defaults")
+        firebase_admin.initialize_app(options={"projectId": FIREBASE_PROJECT_ID} if FIREBASE_PROJECT_ID else None)
 except ValueError:
     # App already initialized
     pass
@@ -14,6 +34,169 @@ except Exception as e:
     logging.error(f"Failed to initialize Firebase: {str(e)}")
     raise
 
+# Tokens issued by /login are signed with this key; without one they only last as long as the process
+AUTH_TOKEN_SECRET = os.getenv("AUTH_TOKEN_SECRET") or secrets.token_urlsafe(32)
+if not os.getenv("AUTH_TOKEN_SECRET"):
+    logging.warning("AUTH_TOKEN_SECRET is not set; login tokens won't survive a restart")
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", "3600"))
+AUTH_TOKEN_ISSUER = "hypersales-auth"
+# Google's published signing certificates for Firebase ID tokens
+FIREBASE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+# Refresh the key set in the background once it is this close to expiring
+FIREBASE_KEYS_REFRESH_MARGIN = 300
+FIREBASE_KEYS_DEFAULT_MAX_AGE = 3600
+# Minimum spacing of forced refreshes for tokens signed with a key we don't have
+FIREBASE_KEYS_MIN_FORCED_INTERVAL = 60
+
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+# Upper bound on how long a verified token is trusted without re-checking it
+TOKEN_CACHE_MAX_TTL = int(os.getenv("TOKEN_CACHE_MAX_TTL", "300"))
+
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+# Called as hook(event) with "hit", "miss" or "invalid"; see set_token_metrics_hook
+token_metrics_hook = None
+
+
+def set_token_metrics_hook(hook):
+    global token_metrics_hook
+    token_metrics_hook = hook
+
+
+def _record(event):
+    if token_metrics_hook is not None:
+        token_metrics_hook(event)
+
+
+class FirebaseKeySet:
+    """Locally cached Firebase signing certificates.
+
+    Keys are fetched once and kept for the ``max-age`` Google sends; when
+    they are close to expiring, a background thread fetches the next set
+    while requests keep verifying against the current one.
+    """
+
+    def __init__(self, url=FIREBASE_CERTS_URL, refresh_margin=FIREBASE_KEYS_REFRESH_MARGIN):
+        self.url = url
+        self.refresh_margin = refresh_margin
+        self.refreshes = 0
+        self._certs = None
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self, force=False):
+        """Return ``{kid: certificate}``, fetching synchronously only when there is none usable.
+
+        ``force`` refetches right away (at most once a minute), for tokens
+        signed with a key Google rotated in before our copy expired.
+        """
+        remaining = self._expires_at - time.time()
+        if force and time.time() - self._fetched_at >= FIREBASE_KEYS_MIN_FORCED_INTERVAL:
+            with self._lock:
+                self._refresh()
+        elif self._certs is None or remaining <= 0:
+            with self._lock:
+                if self._certs is None or self._expires_at <= time.time():
+                    self._refresh()
+        elif remaining < self.refresh_margin and not self._refreshing:
+            self._refreshing = True
+            threading.Thread(target=self._background_refresh, name="firebase-keys", daemon=True).start()
+        return self._certs
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                self._refresh()
+        except Exception as e:
+            # Keep verifying with the current keys; the next request tries again
+            logging.warning(f"Background Firebase key refresh failed: {str(e)}")
+        finally:
+            self._refreshing = False
+
+    def _refresh(self):
+        response = httpx.get(self.url, timeout=10)
+        response.raise_for_status()
+        match = MAX_AGE_RE.search(response.headers.get("cache-control", ""))
+        max_age = int(match.group(1)) if match else FIREBASE_KEYS_DEFAULT_MAX_AGE
+        self._certs = response.json()
+        self._fetched_at = time.time()
+        self._expires_at = self._fetched_at + max_age
+        self.refreshes += 1
+
+
+firebase_keys = FirebaseKeySet()
+token_cache = LRUCache(max_entries=TOKEN_CACHE_MAX_ENTRIES)
+
+
+def _project_id():
+    if FIREBASE_PROJECT_ID:
+        return FIREBASE_PROJECT_ID
+    try:
+        return firebase_admin.get_app().project_id
+    except ValueError:
+        return None
+
+
+def _verify_locally(token):
+    """Verify an ID token's signature and claims against the cached key set.
+
+    Performs the same checks as ``auth.verify_id_token`` without revocation
+    checking, which ``verify_token`` never requested.
+    """
+    project_id = _project_id()
+    certs = firebase_keys.get()
+    try:
+        if google_jwt.decode_header(token).get("kid") not in certs:
+            certs = firebase_keys.get(force=True)
+        claims = google_jwt.decode(token, certs=certs, audience=project_id)
+    except (ValueError, google_auth_exceptions.GoogleAuthError) as e:
+        if "expired" in str(e).lower():
+            raise auth.ExpiredIdTokenError(str(e), e)
+        raise auth.InvalidIdTokenError(str(e))
+    if claims.get("iss") != f"https://securetoken.google.com/{project_id}":
+        raise auth.InvalidIdTokenError("Token has an incorrect issuer")
+    if not claims.get("sub") or len(claims["sub"]) > 128:
+        raise auth.InvalidIdTokenError("Token has an invalid subject")
+    claims["uid"] = claims["sub"]
+    return claims
+
+
+def create_token(claims, ttl=AUTH_TOKEN_TTL):
+    """Sign a login token carrying ``claims``, accepted by ``verify_token`` until it expires."""
+    now = int(time.time())
+    payload = {**claims, "iss": AUTH_TOKEN_ISSUER, "iat": now, "exp": now + ttl}
+    return jwt.encode(payload, AUTH_TOKEN_SECRET, algorithm="HS256")
+
+
+def _verify_login_token(token):
+    try:
+        return jwt.decode(token, AUTH_TOKEN_SECRET, algorithms=["HS256"], issuer=AUTH_TOKEN_ISSUER)
+    except jwt.ExpiredSignatureError as e:
+        raise auth.ExpiredIdTokenError(str(e), e)
+    except jwt.InvalidTokenError as e:
+        raise auth.InvalidIdTokenError(str(e))
+
+
+def _verify_uncached(token):
+    # Firebase ID tokens are RS256; HS256 ones come from create_token
+    try:
+        algorithm = google_jwt.decode_header(token).get("alg")
+    except ValueError:
+        raise auth.InvalidIdTokenError("Malformed token")
+    if algorithm == "HS256":
+        return _verify_login_token(token)
+    if not _project_id():
+        return auth.verify_id_token(token)
+    try:
+        return _verify_locally(token)
+    except (httpx.HTTPError, ValueError) as e:
+        # Couldn't get the key set; let the SDK fetch and verify instead
+        logging.warning(f"Local token verification unavailable, using the SDK: {str(e)}")
+        return auth.verify_id_token(token)
+
+
 async def verify_token(request: Request):
     try:
         # Get the Authorization header
@@ -23,21 +206,44 @@ async def verify_token(request: Request):
 
         # Extract the token
         token = auth_header.split('Bearer ')[1]
-        
+
+        # Repeat requests with the same token are a cache lookup
+        token_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        decoded_token = token_cache.get(token_key)
+        if decoded_token is not None:
+            if decoded_token["exp"] > time.time():
+                _record("hit")
+                return decoded_token
+            token_cache.invalidate(token_key)
+        _record("miss")
+
         # Verify the token with Firebase
         try:
-            decoded_token = auth.verify_id_token(token)
-            return decoded_token
-        except auth.InvalidIdTokenError:
-            raise HTTPException(status_code=401, detail="Invalid token")
+            decoded_token = await run_in_threadpool(_verify_uncached, token)
         except auth.ExpiredIdTokenError:
+            # Checked first: it subclasses InvalidIdTokenError
+            _record("invalid")
             raise HTTPException(status_code=401, detail="Token expired")
+        except auth.InvalidIdTokenError:
+            _record("invalid")
+            raise HTTPException(status_code=401, detail="Invalid token")
         except Exception as e:
             logging.error(f"Token verification error: {str(e)}")
             raise HTTPException(status_code=401, detail="Token verification failed")
-            
+
+        ttl = min(decoded_token["exp"] - time.time(), TOKEN_CACHE_MAX_TTL)
+        if ttl > 0:
+            token_cache.set(token_key, decoded_token, ttl=ttl)
+        return decoded_token
+
     except HTTPException:
         raise
     except Exception as e:
         logging.error(f"Authentication error: {str(e)}")
         raise HTTPException(status_code=401, detail="Authentication failed")
+
+
+def token_cache_stats():
+    stats = token_cache.stats()
+    stats["key_refreshes"] = firebase_keys.refreshes
+    return stats
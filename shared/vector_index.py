@@ -0,0 +1,192 @@
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(tempfile.gettempdir(), "hypersales_vectors"))
+VECTOR_DIM = int(os.getenv("VECTOR_DIM", "512"))
+# Optional sentence-transformers model name; the hashing vectorizer is used when unset
+VECTOR_MODEL = os.getenv("VECTOR_MODEL", "")
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+class HashingEmbedder:
+    """Signed feature hashing of unigrams and bigrams, L2-normalized.
+
+    Uses crc32 rather than ``hash()`` so every worker process produces the
+    same vectors for the same text.
+    """
+
+    def __init__(self, dim=VECTOR_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        words = WORD_RE.findall(text.lower())
+        features = {}
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feature.encode("utf-8"))
+            index = h % self.dim
+            sign = 1.0 if h & 0x80000000 else -1.0
+            features[index] = features.get(index, 0.0) + sign
+        return features
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for index, value in self._features(text).items():
+                # Sublinear term frequency keeps repeated boilerplate from dominating
+                matrix[row, index] = math.copysign(1.0 + math.log(abs(value)), value) if value else 0.0
+        return normalize(matrix)
+
+
+class SentenceTransformerEmbedder:
+    """Local CPU sentence-transformers model."""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), batch_size=64, convert_to_numpy=True)
+        return normalize(vectors.astype(np.float32))
+
+
+def normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+_embedder = None
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        _embedder = SentenceTransformerEmbedder(VECTOR_MODEL) if VECTOR_MODEL else HashingEmbedder()
+    return _embedder
+
+
+class VectorIndex:
+    """Row-normalized float32 chunk embeddings, usually memory-mapped."""
+
+    def __init__(self, matrix, meta):
+        self.matrix = matrix
+        self.meta = meta
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def rank(self, query_vector, top_k):
+        """Return the ids of the ``top_k`` chunks by cosine similarity."""
+        if not len(self):
+            return []
+        scores = self.matrix @ query_vector
+        if top_k < len(scores):
+            candidates = np.argpartition(scores, -top_k)[-top_k:]
+        else:
+            candidates = np.arange(len(scores))
+        return candidates[np.argsort(scores[candidates])[::-1]].tolist()
+
+
+class VectorIndexStore:
+    """Persists one ``.npy`` matrix per chatbot and memory-maps it on load.
+
+    The mapped pages live in the OS page cache, so every worker process on a
+    host shares a single copy of each index. Each matrix file is named after
+    the fingerprint and embedder it was built from, and the chatbot's
+    ``.json`` metadata names the current one. The metadata is written last,
+    so a reader never pairs it with a matrix from another version.
+    """
+
+    def __init__(self, directory=VECTOR_INDEX_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _base(self, chatbot_id):
+        return os.path.join(self.directory, str(chatbot_id))
+
+    def _matrix_paths(self, chatbot_id):
+        return glob.glob(glob.escape(self._base(chatbot_id)) + "*.npy")
+
+    def load(self, chatbot_id, fingerprint=None, embedder_name=None):
+        """Memory-map a stored index, or return None if missing or stale."""
+        try:
+            with open(self._base(chatbot_id) + ".json") as f:
+                meta = json.load(f)
+            # Metadata from before matrices were versioned names no file
+            matrix = np.load(os.path.join(self.directory, meta["matrix"]), mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            return None
+        if fingerprint is not None and meta.get("fingerprint") != fingerprint:
+            return None
+        if embedder_name is not None and meta.get("embedder") != embedder_name:
+            return None
+        return VectorIndex(matrix, meta)
+
+    def save(self, chatbot_id, matrix, fingerprint, embedder_name):
+        """Write the matrix, then the metadata pointing at it, and memory-map the result."""
+        version = hashlib.sha1(f"{fingerprint}:{embedder_name}".encode("utf-8")).hexdigest()[:16]
+        matrix_path = f"{self._base(chatbot_id)}.{version}.npy"
+        meta = {
+            "fingerprint": fingerprint,
+            "embedder": embedder_name,
+            "rows": int(matrix.shape[0]),
+            "matrix": os.path.basename(matrix_path),
+        }
+        self._atomic_write(matrix_path, lambda f: np.save(f, np.ascontiguousarray(matrix, dtype=np.float32)))
+        self._atomic_write(self._base(chatbot_id) + ".json", lambda f: f.write(json.dumps(meta).encode("utf-8")))
+        # Processes that already mapped an older matrix keep reading it after the unlink
+        for path in self._matrix_paths(chatbot_id):
+            if path != matrix_path:
+                self._remove(path)
+        return self.load(chatbot_id)
+
+    def delete(self, chatbot_id):
+        for path in [self._base(chatbot_id) + ".json"] + self._matrix_paths(chatbot_id):
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _atomic_write(self, path, write):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def get_or_build(self, chatbot_id, chunks, fingerprint):
+        """Load the chatbot's index, embedding its chunks if it is missing or stale."""
+        embedder = get_embedder()
+        index = self.load(chatbot_id, fingerprint, embedder.name)
+        if index is not None:
+            return index
+        logger.info(f"Embedding {len(chunks)} chunks for chatbot {chatbot_id} with {embedder.name}")
+        matrix = embedder.embed([chunk["text"] for chunk in chunks])
+        return self.save(chatbot_id, matrix, fingerprint, embedder.name)
+
+
+def embed_query(text):
+    return get_embedder().embed([text])[0]